@@ -0,0 +1,96 @@
+import argparse
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+from pathlib import Path
+
+SOURCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'source')
+sys.path.insert(0, SOURCE_DIR)
+from utils import getfileList, getSessionID, getSubjectID
+from telemetry import load_records, summarize
+
+def link_sessions(input_directory, target_directory, n_sessions):
+    """
+    This function creates a BIDS tree with symbolic links to the T1w and FLAIR images of the first n_sessions
+    complete sessions of a database, so that the benchmark does not touch the original derivatives.
+
+    Parameters:
+    -----------
+    input_directory : str
+        Folder of BIDS database
+    target_directory : str
+        Folder in which the linked BIDS tree is created
+    n_sessions : int
+        Number of sessions
+
+    Returns:
+    --------
+    n : int
+        Number of linked sessions
+    """
+    t1w_list = getfileList(input_directory, '*_T1w.nii.gz')
+    t1w_list = [str(x) for x in t1w_list if ('derivatives' not in str(x)) and ('GADOLINIUM' not in str(x))]
+    n = 0
+    for t1w in t1w_list:
+        flair = t1w.replace('_T1w.nii.gz', '_FLAIR.nii.gz')
+        if not os.path.exists(flair):
+            continue
+        subID, sesID = getSubjectID(t1w), getSessionID(t1w)
+        anat = os.path.join(target_directory, f'sub-{subID}', f'ses-{sesID}', 'anat')
+        Path(anat).mkdir(parents=True, exist_ok=True)
+        for path in (t1w, flair):
+            os.symlink(path, os.path.join(anat, os.path.basename(path)))
+        n += 1
+        if n == n_sessions:
+            break
+    return n
+
+def run_mode(bids_directory, engine, args):
+    """
+    This function runs run_lst_ai.py on the linked BIDS tree (CPU only) and summarizes its run log.
+    """
+    derivatives_dir = os.path.join(bids_directory, 'derivatives')
+    if os.path.exists(derivatives_dir):
+        shutil.rmtree(derivatives_dir)
+    run_log = os.path.join(bids_directory, f'runlog_{"engine" if engine else "subprocess"}.jsonl')
+    command = [sys.executable, os.path.join(SOURCE_DIR, 'run_lst_ai.py'), '-i', bids_directory, '--cpu', '--no_index', 
+               '-n', str(args.number_of_workers), '-t', str(args.threads), '--run_log', run_log, '--job_order', 'bids']
+    if engine:
+        command.append('--engine')
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+    return summarize(load_records([run_log]))
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Compare the throughput of the in-process LST-AI engine (--engine) with one "lst" process per session on CPU.')
+
+    parser.add_argument('-i', '--input_directory', 
+                        help='Folder of BIDS database with the sessions that are used for the benchmark.', 
+                        required=True)
+
+    parser.add_argument('-s', '--sessions', 
+                        help='Number of sessions (default: 8).', 
+                        type=int, 
+                        default=8)
+
+    parser.add_argument('-n', '--number_of_workers', 
+                        help='Number of parallel workers (default: 2).', 
+                        type=int, 
+                        default=2)
+
+    parser.add_argument('-t', '--threads', 
+                        help='Number of threads per worker (default: 4).', 
+                        type=int, 
+                        default=4)
+
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        n = link_sessions(os.path.abspath(args.input_directory), tmp, args.sessions)
+        print(f'Benchmark on {n} session(s) with {args.number_of_workers} worker(s) x {args.threads} thread(s) (CPU)')
+        for engine in (False, True):
+            summary = run_mode(tmp, engine, args)
+            print(f'{"engine    " if engine else "subprocess"}: {summary["processed"]} processed, {summary["failed"]} failed, '
+                  f'{summary.get("sessions_per_hour", float("nan")):.1f} sessions/hour, median LST-AI time {summary["lst"]["p50"]:.1f} s')
@@ -0,0 +1,119 @@
+import argparse
+import os
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+from collections import Counter
+from pathlib import Path
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+SOURCE_DIR = os.path.join(BENCHMARK_DIR, '..', 'source')
+sys.path.insert(0, SOURCE_DIR)
+from synthetic_bids import make_database
+from benchmark_suite import install_stub
+from telemetry import merge_logs
+from utils import isSessionComplete
+
+def run_nodes(bids_directory, manifest_file, lease, args, env):
+    """
+    This function starts one run_lst_ai.py process per node at the same time (static shards "k/N" of the manifest, or leases on
+    the whole manifest) and waits for all of them.
+
+    Returns:
+    --------
+    returncodes : list
+        Exit codes of the nodes
+    """
+    processes = []
+    for k in range(args.nodes):
+        command = [sys.executable, os.path.join(SOURCE_DIR, 'run_lst_ai.py'), '-i', bids_directory, '--cpu', '-t', '1',
+                   '-n', str(args.number_of_workers), '--manifest', manifest_file, '--shard', f'{k}/{args.nodes}', '--progress_interval', '0']
+        if lease:
+            command += ['--lease']
+        log = open(os.path.join(os.path.dirname(manifest_file), f'node-{k}.log'), 'w')
+        processes.append((subprocess.Popen(command, env=env, stdout=log, stderr=subprocess.STDOUT), log))
+    returncodes = []
+    for process, log in processes:
+        returncodes.append(process.wait())
+        log.close()
+    return returncodes
+
+def check_mode(bids_directory, lease, args, env):
+    """
+    This function runs all nodes of one mode on a fresh derivatives folder and checks that every session of the manifest was
+    processed exactly once and that its outputs exist. The run logs of the nodes are merged into one run log.
+
+    Returns:
+    --------
+    errors : list
+        Error messages (empty if the check passed)
+    """
+    derivatives_dir = os.path.join(bids_directory, 'derivatives', 'lst-ai-v1.1.0')
+    shutil.rmtree(os.path.join(bids_directory, 'derivatives'), ignore_errors=True)
+    Path(derivatives_dir).mkdir(parents=True)
+    manifest_file = os.path.join(bids_directory, 'manifest.json')
+    subprocess.run([sys.executable, os.path.join(SOURCE_DIR, 'run_lst_ai.py'), '-i', bids_directory, '--no_index',
+                    '--write_manifest', manifest_file], env=env, stdout=subprocess.DEVNULL, check=True)
+    with open(manifest_file) as f:
+        jobs = json.load(f)['jobs']
+
+    returncodes = run_nodes(bids_directory, manifest_file, lease, args, env)
+    log_files = sorted(str(x) for x in Path(derivatives_dir).glob('lst-ai_runlog.shard-*.jsonl'))
+    records = merge_logs(log_files, os.path.join(derivatives_dir, 'lst-ai_runlog.jsonl'))
+    processed = Counter(f'sub-{x["subID"]}_ses-{x["sesID"]}' for x in records if x['status'] == 'processed')
+
+    errors = [f'node {k} exited with code {x}' for k, x in enumerate(returncodes) if x != 0]
+    for job in jobs:
+        session = f'sub-{job["subID"]}_ses-{job["sesID"]}'
+        if processed[session] != 1:
+            errors.append(f'{session} processed {processed[session]} times')
+        if not isSessionComplete(derivatives_dir, job['subID'], job['sesID']):
+            errors.append(f'{session}: lesion masks missing')
+    print(f'{"lease" if lease else "shard"}: {len(jobs)} session(s), {sum(processed.values())} processed by {args.nodes} node(s), '
+          f'{len(log_files)} run log(s) merged, {"OK" if len(errors) == 0 else f"{len(errors)} error(s)"}')
+    return errors
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Check multi-node runs locally: several run_lst_ai.py processes (static shards and leases) process one manifest of a synthetic BIDS database with a stub of LST-AI; every session has to be processed exactly once.')
+
+    parser.add_argument('-s', '--subjects',
+                        help='Number of subjects of the synthetic database (default: 30).',
+                        type=int,
+                        default=30)
+
+    parser.add_argument('--nodes',
+                        help='Number of concurrent node processes (default: 4).',
+                        type=int,
+                        default=4)
+
+    parser.add_argument('-n', '--number_of_workers',
+                        help='Number of workers per node (default: 2).',
+                        type=int,
+                        default=2)
+
+    parser.add_argument('--latency',
+                        help='Time in seconds of the stub of LST-AI per session (default: 0.05).',
+                        type=float,
+                        default=0.05)
+
+    parser.add_argument('--work_directory',
+                        help='Folder in which the synthetic database is created (default: system temp folder).',
+                        default=None)
+
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.work_directory) as tmp:
+        bin_directory = os.path.join(tmp, 'bin')
+        install_stub(bin_directory)
+        env = dict(os.environ, PATH=bin_directory + os.pathsep + os.environ.get('PATH', ''), CUDA_VISIBLE_DEVICES='',
+                   LST_STUB_LATENCY=str(args.latency), LST_STUB_FAILURE_RATE='0')
+        bids_directory = os.path.join(tmp, 'bids')
+        make_database(bids_directory, args.subjects, missing_flair=0, processed=0)
+        errors = check_mode(bids_directory, False, args, env) + check_mode(bids_directory, True, args, env)
+
+    for error in errors:
+        print(f'ERROR {error}')
+    sys.exit(1 if len(errors) > 0 else 0)
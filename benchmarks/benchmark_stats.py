@@ -0,0 +1,72 @@
+import argparse
+import os
+import sys
+import tempfile
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+SOURCE_DIR = os.path.join(BENCHMARK_DIR, '..', 'source')
+sys.path.insert(0, SOURCE_DIR)
+from synthetic_bids import make_database
+from benchmark_suite import measure
+
+def benchmark_stats(bids_directory, output_directory, args):
+    """
+    This function runs collect_volumes.py on a database with the aggregation of the stats files of LST-AI (CSV) and with the
+    computation of the stats from the lesion masks, and measures the wall time and peak memory of both.
+
+    Returns:
+    --------
+    results : list
+        One result per mode and repeat (see benchmark_suite.measure)
+    """
+    collect = [sys.executable, os.path.join(SOURCE_DIR, 'collect_volumes.py'), '-i', bids_directory, '-o', output_directory, '--no_index']
+    modes = [('csv', collect), ('masks', collect + ['--from_masks'] + (['-p', str(args.processes)] if args.processes else []))]
+    results = []
+    for name, command in modes:
+        for repeat in range(args.repeat):
+            result = measure(command, os.environ)
+            result.update({'mode': name, 'repeat': repeat})
+            results.append(result)
+            print(f'  {name:6s} {result["wall"]:8.2f} s  {result["max_rss"] / 2**20:8.1f} MB  (exit code {result["returncode"]})')
+    return results
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark the lesion stats computed from the masks against the aggregation of the stats files of LST-AI on a synthetic BIDS database.')
+
+    parser.add_argument('-s', '--subjects',
+                        help='Number of subjects of the synthetic database (default: 200).',
+                        type=int,
+                        default=200)
+
+    parser.add_argument('--shape',
+                        help='Image dimensions of the synthetic masks (default: 96 96 64).',
+                        nargs=3,
+                        type=int,
+                        default=[96, 96, 64])
+
+    parser.add_argument('-p', '--processes',
+                        help='Number of worker processes of the stats computation (default: number of CPUs).',
+                        type=int,
+                        default=None)
+
+    parser.add_argument('--repeat',
+                        help='Number of repeats per mode (default: 3).',
+                        type=int,
+                        default=3)
+
+    parser.add_argument('--work_directory',
+                        help='Folder in which the synthetic database is created (default: system temp folder).',
+                        default=None)
+
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.work_directory) as tmp:
+        bids_directory = os.path.join(tmp, 'bids')
+        counts = make_database(bids_directory, args.subjects, missing_flair=0, processed=1.0, shape=tuple(args.shape))
+        print(f'{counts["processed"]} processed sessions with {"x".join(map(str, args.shape))} voxels')
+        results = benchmark_stats(bids_directory, tmp, args)
+
+    best = {name: min(x['wall'] for x in results if x['mode'] == name and x['returncode'] == 0) for name in ('csv', 'masks')}
+    print(f'Best wall time: CSV {best["csv"]:.2f} s, masks {best["masks"]:.2f} s '
+          f'({best["masks"] / max(counts["processed"], 1) * 1000:.1f} ms per session)')
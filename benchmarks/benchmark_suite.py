@@ -0,0 +1,210 @@
+import argparse
+import os
+import sys
+import json
+import time
+import socket
+import platform
+import tempfile
+import datetime
+import subprocess
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+SOURCE_DIR = os.path.join(BENCHMARK_DIR, '..', 'source')
+sys.path.insert(0, SOURCE_DIR)
+from synthetic_bids import make_database
+
+# metrics that are compared between runs (lower is better)
+METRICS = ('wall', 'max_rss')
+
+def install_stub(bin_directory):
+    """
+    This function creates an executable "lst" in bin_directory that runs the stub of LST-AI (stub_lst.py)
+    with the current Python interpreter.
+    """
+    os.makedirs(bin_directory, exist_ok=True)
+    path = os.path.join(bin_directory, 'lst')
+    with open(path, 'w') as f:
+        f.write(f'#!/bin/sh\nexec "{sys.executable}" "{os.path.join(BENCHMARK_DIR, "stub_lst.py")}" "$@"\n')
+    os.chmod(path, 0o755)
+
+def measure(command, env):
+    """
+    This function runs a command and measures its wall time, CPU time and peak memory.
+
+    Returns:
+    --------
+    result : dict
+        Exit code ('returncode'), wall time and CPU time in seconds ('wall', 'cpu_user', 'cpu_system') and the peak
+        resident memory in bytes of the largest process of the command ('max_rss')
+    """
+    t_start = time.perf_counter()
+    process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return {'returncode': process.returncode,
+            'wall': time.perf_counter() - t_start,
+            'cpu_user': usage.ru_utime,
+            'cpu_system': usage.ru_stime,
+            'max_rss': usage.ru_maxrss * 1024}
+
+def benchmark_size(n_subjects, args, env):
+    """
+    This function generates a synthetic database with n_subjects subjects and benchmarks the entry points on it:
+    run_lst_ai.py (first run with cold index, then re-runs that only retry the failed sessions), check_processed.py and collect_volumes.py.
+
+    Returns:
+    --------
+    results : list
+        One result per entry point (see measure) with the database size
+    """
+    results = []
+    with tempfile.TemporaryDirectory(dir=args.work_directory) as tmp:
+        bids_directory = os.path.join(tmp, 'bids')
+        t_start = time.perf_counter()
+        counts = make_database(bids_directory, n_subjects, args.max_sessions, args.missing_flair, args.processed, args.gadolinium, seed=args.seed)
+        print(f'{n_subjects} subjects: {counts["sessions"]} sessions generated in {time.perf_counter() - t_start:.1f} s')
+
+        run_lst_ai = [sys.executable, os.path.join(SOURCE_DIR, 'run_lst_ai.py'), '-i', bids_directory, '--cpu',
+                      '-n', str(args.number_of_workers), '-t', '1']
+        entry_points = [('run_lst_ai', run_lst_ai),
+                        ('run_lst_ai_rerun', run_lst_ai),
+                        ('check_processed', [sys.executable, os.path.join(SOURCE_DIR, 'check_processed.py'), '-i', bids_directory, '-o', tmp]),
+                        ('collect_volumes', [sys.executable, os.path.join(SOURCE_DIR, 'collect_volumes.py'), '-i', bids_directory, '-o', tmp])]
+        for name, command in entry_points:
+            for repeat in range(args.repeat if name != 'run_lst_ai' else 1):
+                result = measure(command, env)
+                result.update({'entry_point': name, 'subjects': n_subjects, 'sessions': counts['sessions'], 'repeat': repeat})
+                results.append(result)
+                print(f'  {name:16s} {result["wall"]:8.2f} s  {result["max_rss"] / 2**20:8.1f} MB  (exit code {result["returncode"]})')
+    return results
+
+def compare(results, baseline, tolerance):
+    """
+    This function compares the results with the results of a baseline run (same entry point and number of subjects,
+    best of the repeats) and returns the regressions, i.e., metrics that grew by more than the tolerance.
+
+    Returns:
+    --------
+    regressions : list
+        Tuples (entry point, subjects, metric, baseline value, current value)
+    """
+    def best(rows):
+        table = {}
+        for row in rows:
+            key = (row['entry_point'], row['subjects'])
+            for metric in METRICS:
+                table[key + (metric,)] = min(row[metric], table.get(key + (metric,), float('inf')))
+        return table
+
+    current, previous = best(results), best(baseline['results'])
+    regressions = []
+    for key, value in sorted(current.items()):
+        if key in previous and value > previous[key] * (1 + tolerance):
+            regressions.append(key + (previous[key], value))
+    return regressions
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark the discovery, scheduling, renaming and aggregation of the pipeline on synthetic BIDS databases of increasing size with a stub of LST-AI (no GPU or network needed).')
+
+    parser.add_argument('-s', '--subjects',
+                        help='Numbers of subjects of the synthetic databases (default: 10 100 1000).',
+                        nargs='+',
+                        type=int,
+                        default=[10, 100, 1000])
+
+    parser.add_argument('-n', '--number_of_workers',
+                        help='Number of parallel workers of run_lst_ai.py (default: 4).',
+                        type=int,
+                        default=4)
+
+    parser.add_argument('--max_sessions',
+                        help='Maximum number of sessions per subject (default: 3).',
+                        type=int,
+                        default=3)
+
+    parser.add_argument('--missing_flair',
+                        help='Fraction of sessions without FLAIR image (default: 0.1).',
+                        type=float,
+                        default=0.1)
+
+    parser.add_argument('--processed',
+                        help='Fraction of complete sessions with existing LST-AI derivatives (default: 0.3).',
+                        type=float,
+                        default=0.3)
+
+    parser.add_argument('--gadolinium',
+                        help='Fraction of sessions with an acq-GADOLINIUM T1w decoy (default: 0.2).',
+                        type=float,
+                        default=0.2)
+
+    parser.add_argument('--latency',
+                        help='Time in seconds of the stub of LST-AI per session (default: 0.05).',
+                        type=float,
+                        default=0.05)
+
+    parser.add_argument('--failure_rate',
+                        help='Probability that the stub of LST-AI fails (default: 0.05).',
+                        type=float,
+                        default=0.05)
+
+    parser.add_argument('--repeat',
+                        help='Number of repeats of the read-only entry points; the best repeat is compared (default: 3).',
+                        type=int,
+                        default=3)
+
+    parser.add_argument('--seed',
+                        help='Seed of the synthetic databases (default: 0).',
+                        type=int,
+                        default=0)
+
+    parser.add_argument('--work_directory',
+                        help='Folder in which the synthetic databases are created (default: system temp folder).',
+                        default=None)
+
+    parser.add_argument('-o', '--output',
+                        help='JSON file to which the results are written (default: benchmark_results.json).',
+                        default='benchmark_results.json')
+
+    parser.add_argument('--compare',
+                        help='JSON file with the results of a baseline run; exits with code 1 if a metric regressed.',
+                        default=None)
+
+    parser.add_argument('--tolerance',
+                        help='Relative increase of a metric that counts as regression (default: 0.25).',
+                        type=float,
+                        default=0.25)
+
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.work_directory) as bin_directory:
+        install_stub(bin_directory)
+        env = dict(os.environ, PATH=bin_directory + os.pathsep + os.environ.get('PATH', ''), CUDA_VISIBLE_DEVICES='',
+                   LST_STUB_LATENCY=str(args.latency), LST_STUB_FAILURE_RATE=str(args.failure_rate))
+        results = []
+        for n_subjects in args.subjects:
+            results += benchmark_size(n_subjects, args, env)
+
+    output = {'created': str(datetime.datetime.now()),
+              'host': socket.gethostname(),
+              'python': platform.python_version(),
+              'cpus': os.cpu_count(),
+              'config': vars(args),
+              'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=1)
+    print(f'Results written to {args.output}')
+
+    if any(x['returncode'] != 0 for x in results):
+        print('Some entry points failed, see the exit codes above.')
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for entry_point, subjects, metric, previous, value in regressions:
+            print(f'REGRESSION {entry_point} ({subjects} subjects) {metric}: {previous:.4g} -> {value:.4g} ({value / previous - 1:+.0%})')
+        if len(regressions) > 0:
+            sys.exit(1)
+        print(f'No regressions compared to {args.compare} (tolerance {args.tolerance:.0%}).')
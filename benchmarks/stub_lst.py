@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+Stand-in for the "lst" command of LST-AI for the benchmarks: it accepts the same arguments, waits for a configurable
+time instead of segmenting and writes small synthetic outputs with the file names of LST-AI.
+
+Environment variables:
+    LST_STUB_LATENCY        time in seconds per session (default: 0.05)
+    LST_STUB_FAILURE_RATE   probability that a session fails with exit code 1 (default: 0)
+"""
+import argparse
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from synthetic_bids import write_nifti, read_nifti_shape, write_lesion_outputs
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--t1', required=True)
+parser.add_argument('--flair', required=True)
+parser.add_argument('--output', required=True)
+parser.add_argument('--temp', default=None)
+parser.add_argument('--device', default='cpu')
+parser.add_argument('--clipping', nargs=2, default=['0.5', '99.5'])
+parser.add_argument('--threads', default='1')
+parser.add_argument('--stripped', action='store_true')
+args, _ = parser.parse_known_args()
+
+rng = random.Random()
+time.sleep(float(os.environ.get('LST_STUB_LATENCY', '0.05')))
+if rng.random() < float(os.environ.get('LST_STUB_FAILURE_RATE', '0')):
+    print('stub lst: simulated failure', file=sys.stderr)
+    sys.exit(1)
+
+try:
+    shape = read_nifti_shape(args.flair)
+except (OSError, EOFError):
+    shape = (32, 32, 16)
+write_lesion_outputs(args.output, '', shape, rng)
+if args.temp is not None:
+    for name in ('sub-X_ses-Y_space-flair_desc-stripped_T1w.nii.gz', 'sub-X_ses-Y_space-flair_desc-stripped_FLAIR.nii.gz',
+                 'sub-X_ses-Y_space-flair_T1w.nii.gz'):
+        write_nifti(os.path.join(args.temp, name), shape, datatype=4)
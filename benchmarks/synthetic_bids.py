@@ -0,0 +1,210 @@
+import argparse
+import os
+import gzip
+import json
+import random
+import struct
+from pathlib import Path
+
+def write_nifti(path, shape, data=None, datatype=2):
+    """
+    This function writes a minimal gzipped NIfTI-1 image (1 mm isotropic voxels) without nibabel.
+
+    Parameters:
+    -----------
+    path : str
+        Path of the .nii.gz file
+    shape : tuple
+        Image dimensions (x, y, z)
+    data : bytes
+        Voxel data in Fortran order (default: zeros)
+    datatype : int
+        NIfTI datatype code (2: uint8, 4: int16, 16: float32)
+    """
+    bitpix = {2: 8, 4: 16, 16: 32}[datatype]
+    header = bytearray(348)
+    struct.pack_into('<i', header, 0, 348)
+    struct.pack_into('<8h', header, 40, 3, *shape, 1, 1, 1, 1)
+    struct.pack_into('<2h', header, 70, datatype, bitpix)
+    struct.pack_into('<8f', header, 76, 1.0, 1.0, 1.0, 1.0, 0.0, 0.0, 0.0, 0.0)
+    struct.pack_into('<2f', header, 108, 352.0, 1.0)
+    struct.pack_into('<2h', header, 252, 1, 1)
+    struct.pack_into('<4f', header, 280, 1.0, 0.0, 0.0, 0.0)
+    struct.pack_into('<4f', header, 296, 0.0, 1.0, 0.0, 0.0)
+    struct.pack_into('<4f', header, 312, 0.0, 0.0, 1.0, 0.0)
+    header[344:348] = b'n+1\0'
+    if data is None:
+        data = bytes(shape[0] * shape[1] * shape[2] * bitpix // 8)
+    with gzip.open(path, 'wb', compresslevel=1) as f:
+        f.write(bytes(header) + bytes(4) + data)
+
+def read_nifti_shape(path):
+    """
+    This function reads the image dimensions from the header of a gzipped NIfTI-1 image.
+    """
+    with gzip.open(path, 'rb') as f:
+        header = f.read(348)
+    ndim, *dims = struct.unpack_from('<8h', header, 40)
+    return tuple(dims[:3])
+
+def lesion_mask(shape, n_lesions, rng, labels=(1,)):
+    """
+    This function creates the voxel data of a synthetic lesion mask with n_lesions cubic lesions at random positions.
+
+    Returns:
+    --------
+    data : bytes
+        uint8 voxel data in Fortran order (0: background, otherwise the label of the lesion)
+    """
+    nx, ny, nz = shape
+    data = bytearray(nx * ny * nz)
+    for _ in range(n_lesions):
+        size = rng.randint(1, 3)
+        x, y, z = rng.randrange(nx - size), rng.randrange(ny - size), rng.randrange(nz - size)
+        label = rng.choice(labels)
+        for k in range(z, z + size):
+            for j in range(y, y + size):
+                start = x + nx * (j + ny * k)
+                data[start:start + size] = bytes([label]) * size
+    return bytes(data)
+
+def write_lesion_outputs(anat, prefix, shape, rng):
+    """
+    This function writes the lesion masks and stats files of a session with the file names of LST-AI
+    (prefix '': LST-AI output folder) or of the BIDS derivatives (prefix 'sub-X_ses-Y').
+
+    Parameters:
+    -----------
+    anat : str
+        Output folder
+    prefix : str
+        Prefix of the file names ('' for the names written by LST-AI)
+    shape : tuple
+        Image dimensions of the masks
+    rng : random.Random
+        Random number generator
+    """
+    n_lesions = rng.randint(0, 12)
+    if prefix:
+        mask, mask_annot = f'{prefix}_space-FLAIR_label-lesion_mask.nii.gz', f'{prefix}_space-FLAIR_desc-annotated_label-lesion_mask.nii.gz'
+        stats, stats_annot = f'{prefix}_lesion_stats.csv', f'{prefix}_annotated_lesion_stats.csv'
+    else:
+        mask, mask_annot = 'space-flair_seg-lst.nii.gz', 'space-flair_desc-annotated_seg-lst.nii.gz'
+        stats, stats_annot = 'lesion_stats.csv', 'annotated_lesion_stats.csv'
+    write_nifti(os.path.join(anat, mask), shape, lesion_mask(shape, n_lesions, random.Random(rng.random())))
+    write_nifti(os.path.join(anat, mask_annot), shape, lesion_mask(shape, n_lesions, random.Random(rng.random()), labels=(1, 2, 3, 4)))
+    volumes = [round(rng.uniform(0, 5), 4) for _ in range(4)]
+    with open(os.path.join(anat, stats), 'w') as f:
+        f.write(f'Num_Lesions,Lesion_Volume\n{n_lesions},{sum(volumes):.4f}\n')
+    with open(os.path.join(anat, stats_annot), 'w') as f:
+        f.write('Region,Num_Lesions,Lesion_Volume\n')
+        for region, volume in zip(('Periventricular', 'Juxtacortical', 'Subcortical', 'Infratentorial'), volumes):
+            f.write(f'{region},{n_lesions // 4},{volume:.4f}\n')
+
+def make_database(bids_directory, n_subjects, max_sessions=3, missing_flair=0.1, processed=0.3, gadolinium=0.2,
+                  shape=(32, 32, 16), derivatives='lst-ai-v1.1.0', seed=0):
+    """
+    This function generates a synthetic BIDS database with T1w and FLAIR images (zeros) of configurable size.
+
+    Parameters:
+    -----------
+    bids_directory : str
+        Folder in which the BIDS database is created
+    n_subjects : int
+        Number of subjects
+    max_sessions : int
+        Maximum number of sessions per subject (the number of sessions is drawn uniformly from 1..max_sessions)
+    missing_flair : float
+        Fraction of sessions without FLAIR image
+    processed : float
+        Fraction of complete sessions with existing LST-AI derivatives (masks and stats files)
+    gadolinium : float
+        Fraction of sessions with an additional contrast-enhanced T1w image (acq-GADOLINIUM) as decoy
+    shape : tuple
+        Image dimensions
+    derivatives : str
+        Name of the LST-AI derivatives folder
+    seed : int
+        Seed of the random number generator (the same arguments generate the same database)
+
+    Returns:
+    --------
+    counts : dict
+        Number of subjects, sessions, sessions without FLAIR, processed sessions and decoys
+    """
+    rng = random.Random(seed)
+    counts = {'subjects': n_subjects, 'sessions': 0, 'missing_flair': 0, 'processed': 0, 'gadolinium': 0}
+    for s in range(n_subjects):
+        subID = f'{s:05d}'
+        for t in range(rng.randint(1, max_sessions)):
+            sesID = f'{t:02d}'
+            prefix = f'sub-{subID}_ses-{sesID}'
+            anat = os.path.join(bids_directory, f'sub-{subID}', f'ses-{sesID}', 'anat')
+            Path(anat).mkdir(parents=True, exist_ok=True)
+            counts['sessions'] += 1
+
+            write_nifti(os.path.join(anat, f'{prefix}_T1w.nii.gz'), shape, datatype=4)
+            if rng.random() < gadolinium:
+                write_nifti(os.path.join(anat, f'{prefix}_acq-GADOLINIUM_T1w.nii.gz'), shape, datatype=4)
+                counts['gadolinium'] += 1
+            if rng.random() < missing_flair:
+                counts['missing_flair'] += 1
+                continue
+            write_nifti(os.path.join(anat, f'{prefix}_FLAIR.nii.gz'), shape, datatype=4)
+
+            if rng.random() < processed:
+                deriv_anat = os.path.join(bids_directory, 'derivatives', derivatives, f'sub-{subID}', f'ses-{sesID}', 'anat')
+                Path(deriv_anat).mkdir(parents=True, exist_ok=True)
+                write_lesion_outputs(deriv_anat, prefix, shape, rng)
+                counts['processed'] += 1
+    return counts
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Generate a synthetic BIDS database for the benchmarks (no real images).')
+
+    parser.add_argument('-o', '--output_directory',
+                        help='Folder in which the BIDS database is created.',
+                        required=True)
+
+    parser.add_argument('-s', '--subjects',
+                        help='Number of subjects (default: 100).',
+                        type=int,
+                        default=100)
+
+    parser.add_argument('--max_sessions',
+                        help='Maximum number of sessions per subject (default: 3).',
+                        type=int,
+                        default=3)
+
+    parser.add_argument('--missing_flair',
+                        help='Fraction of sessions without FLAIR image (default: 0.1).',
+                        type=float,
+                        default=0.1)
+
+    parser.add_argument('--processed',
+                        help='Fraction of complete sessions with existing LST-AI derivatives (default: 0.3).',
+                        type=float,
+                        default=0.3)
+
+    parser.add_argument('--gadolinium',
+                        help='Fraction of sessions with an acq-GADOLINIUM T1w decoy (default: 0.2).',
+                        type=float,
+                        default=0.2)
+
+    parser.add_argument('--shape',
+                        help='Image dimensions (default: 32 32 16).',
+                        nargs=3,
+                        type=int,
+                        default=[32, 32, 16])
+
+    parser.add_argument('--seed',
+                        help='Seed of the random number generator (default: 0).',
+                        type=int,
+                        default=0)
+
+    args = parser.parse_args()
+
+    counts = make_database(args.output_directory, args.subjects, args.max_sessions, args.missing_flair, args.processed,
+                           args.gadolinium, tuple(args.shape), seed=args.seed)
+    print(json.dumps(counts))
@@ -0,0 +1,194 @@
+import os
+import sqlite3
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+from pathlib import Path
+
+# depth of the BIDS layout that is indexed below each root:
+# root/sub-*/ses-*/<datatype>/<files>
+INDEX_DEPTH = 3
+
+def open_index(db_path):
+    """
+    This function opens (and if necessary creates) the SQLite index of a BIDS database.
+    The index stores the directory listings of the subject, session and datatype folders together with the
+    modification time of each folder, so that only folders that changed since the last run have to be listed again.
+
+    Parameters:
+    -----------
+    db_path : str
+        Path of the SQLite file
+
+    Returns:
+    --------
+    conn : sqlite3.Connection
+        Connection to the index
+    """
+    Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    conn.execute('CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime INTEGER)')
+    conn.execute('CREATE TABLE IF NOT EXISTS files (dir TEXT, name TEXT, is_dir INTEGER, size INTEGER, mtime INTEGER, PRIMARY KEY (dir, name))')
+    conn.commit()
+    return conn
+
+def _keep_entry(name, level):
+    """
+    This function decides which folders are followed while indexing (only the BIDS subject/session/datatype levels).
+    """
+    if level == 0:
+        return name.startswith('sub-')
+    if level == 1:
+        return name.startswith('ses-')
+    return level < INDEX_DEPTH
+
+def _scan_dir(path, level, known, recurse=True):
+    """
+    This function lists a folder and its BIDS subfolders on the filesystem (no index access, so that subjects can be scanned
+    in parallel threads). A folder is only listed again if its modification time differs from the indexed one (known).
+
+    Returns:
+    --------
+    results : list
+        (path, mtime, entries) per folder: mtime None if the folder disappeared, entries None if the folder is unchanged
+    """
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return [(path, None, None)]
+
+    if path in known and known[path][0] == mtime:
+        results = [(path, mtime, None)]
+        subdirs = known[path][1]
+    else:
+        entries = []
+        with os.scandir(path) as it:
+            for entry in it:
+                is_dir = entry.is_dir()
+                if is_dir:
+                    entries.append((path, entry.name, 1, 0, 0))
+                else:
+                    st = entry.stat()
+                    entries.append((path, entry.name, 0, st.st_size, st.st_mtime_ns))
+        results = [(path, mtime, entries)]
+        subdirs = [x[1] for x in entries if x[2]]
+
+    if recurse and level < INDEX_DEPTH:
+        for name in subdirs:
+            if _keep_entry(name, level):
+                results += _scan_dir(os.path.join(path, name), level + 1, known)
+    return results
+
+def _apply_scan(conn, results, stats):
+    """
+    This function writes the results of _scan_dir to the index (parent folders before their subfolders).
+    """
+    for path, mtime, entries in results:
+        if mtime is None:
+            _remove_dir(conn, path)
+            continue
+        if entries is None:
+            stats['unchanged'] += 1
+            continue
+        stats['listed'] += 1
+        # remove index entries of subfolders that disappeared
+        old_subdirs = set(x[0] for x in conn.execute('SELECT name FROM files WHERE dir = ? AND is_dir = 1', (path,)))
+        for name in old_subdirs - set(x[1] for x in entries if x[2]):
+            _remove_dir(conn, os.path.join(path, name))
+
+        conn.execute('DELETE FROM files WHERE dir = ?', (path,))
+        conn.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?)', entries)
+        conn.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?)', (path, mtime))
+
+def _below(path):
+    """
+    This function returns the bounds of the paths below a folder for a range comparison ('path/' <= x < 'path0', '0' follows '/'),
+    which, unlike LIKE, neither treats '_' as a wildcard nor ignores the case.
+    """
+    path = path.rstrip('/')
+    return path + '/', path + '0'
+
+def _remove_dir(conn, path):
+    """
+    This function removes a folder and everything below it from the index.
+    """
+    conn.execute('DELETE FROM dirs WHERE path = ? OR (path >= ? AND path < ?)', (path, *_below(path)))
+    conn.execute('DELETE FROM files WHERE dir = ? OR (dir >= ? AND dir < ?)', (path, *_below(path)))
+
+def update_index(conn, roots, threads=16):
+    """
+    This function incrementally refreshes the index for the given root folders (e.g., the BIDS database and its derivatives folder).
+    The subject folders are checked in parallel with a thread pool (stat and listing calls on network storage are latency bound),
+    the index itself is only written by the calling thread.
+
+    Parameters:
+    -----------
+    conn : sqlite3.Connection
+        Connection to the index (see open_index)
+    roots : list
+        List of root folders that should be indexed
+    threads : int
+        Number of threads that check the subject folders
+
+    Returns:
+    --------
+    stats : dict
+        Number of folders that were listed again ('listed') and that were unchanged ('unchanged')
+    """
+    stats = {'listed': 0, 'unchanged': 0}
+    # modification times and subfolders of the indexed folders (read once, the threads do not access the index)
+    known = {path: (mtime, []) for path, mtime in conn.execute('SELECT path, mtime FROM dirs')}
+    for path, name in conn.execute('SELECT dir, name FROM files WHERE is_dir = 1'):
+        if path in known:
+            known[path][1].append(name)
+
+    for root in roots:
+        root = os.path.abspath(str(root))
+        if not os.path.isdir(root):
+            continue
+        _apply_scan(conn, _scan_dir(root, 0, known, recurse=False), stats)
+        sub_dirs = [os.path.join(root, x[0]) for x in conn.execute('SELECT name FROM files WHERE dir = ? AND is_dir = 1 ORDER BY name', (root,))
+                    if _keep_entry(x[0], 0)]
+        with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+            for results in executor.map(lambda x: _scan_dir(x, 1, known), sub_dirs):
+                _apply_scan(conn, results, stats)
+    conn.commit()
+    print(f'{datetime.datetime.now()} BIDS index: {stats["listed"]} folder(s) listed, {stats["unchanged"]} folder(s) unchanged.')
+    return stats
+
+def index_file_list(conn, path, suffix):
+    """
+    This function lists all indexed "*suffix"-files below the given path (index-based counterpart of utils.getfileList).
+
+    Parameters:
+    -----------
+    conn : sqlite3.Connection
+        Connection to the index
+    path : str
+        Path to directory in which we want to search for files
+    suffix : str
+        Pattern of the files we want to list (e.g., "*.nii.gz")
+
+    Returns:
+    --------
+    file_ls : list
+        Sorted list of pathlib.Path objects
+    """
+    path = os.path.abspath(str(path)).rstrip('/')
+    rows = conn.execute('SELECT dir, name FROM files WHERE is_dir = 0 AND (dir = ? OR (dir >= ? AND dir < ?))', (path, *_below(path)))
+    return sorted(Path(d, n) for d, n in rows if fnmatch(n, suffix))
+
+def index_scandir(conn, path):
+    """
+    This function returns the indexed entries of a folder with a flag for folders (index-based counterpart of os.scandir).
+    """
+    path = os.path.abspath(str(path))
+    return {x[0]: bool(x[1]) for x in conn.execute('SELECT name, is_dir FROM files WHERE dir = ?', (path,))}
+
+def index_stat(conn, path):
+    """
+    This function returns (size, mtime in ns) of an indexed file or None if the file is not in the index
+    (index-based counterpart of os.path.exists/os.stat).
+    """
+    path = os.path.abspath(str(path))
+    return conn.execute('SELECT size, mtime FROM files WHERE dir = ? AND name = ?', (os.path.dirname(path), os.path.basename(path))).fetchone()
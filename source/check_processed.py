@@ -1,62 +1,132 @@
 import argparse
 import os
-from pathlib import Path
-import pandas as pd
-
-from utils import getfileList, getSessionID, getSubjectID
-
-####################################################
-# main script
-
-parser = argparse.ArgumentParser(description='Check for missing segmentation files (e.g., when processing did not work).')
-parser.add_argument('-i', '--input_directory', help='Folder of BIDS database.', required=True)
-parser.add_argument('-o', '--output_directory', help='Destination folder for the output file.', required=True)
-
-# read the arguments
-args = parser.parse_args()
-
-# define path of the derivatives folder
-derivatives_dir = os.path.join(args.input_directory, "derivatives/lst-ai-v1.1.0")
-
-# get a list with all subject folders in the database
-T1w_list = getfileList(path = args.input_directory, 
-                       suffix = '*T1w*')
-T1w_list = [str(x) for x in T1w_list if (('.nii.gz' in str(x)) and 
-                                         (not 'derivatives' in str(x)) and
-                                         (not 'GADOLINIUM' in str(x)))]
-
-# get a list with the paths of the _seg.mgz files 
-seg_list = getfileList(derivatives_dir, '*_space-FLAIR_label-lesion_mask.nii.gz')
-
-
-# initialize empty dataframe into which we will write the IDs of missing segmentations
-df_seg_missing = pd.DataFrame(columns=['subject-ID', 'session-ID'])
-df_seg_processed = pd.DataFrame(columns=['subject-ID', 'session-ID'])
-for i in range(len(T1w_list)):
-    # get subject and session ID
-    subjectID = getSubjectID(T1w_list[i])
-    sessionID = getSessionID(T1w_list[i])
-
-    # define path of segmentation file
-    seg_path = Path(os.path.join(derivatives_dir, f'sub-{subjectID}', f'ses-{sessionID}', 'anat', f'sub-{subjectID}_ses-{sessionID}_space-FLAIR_label-lesion_mask.nii.gz'))
-
-    # check if segmentation file is in seg_list 
-    # (if not, then the segmentation must have failed and we want to write the IDs into df_seg_missing)
-    if seg_path in seg_list:
-        # write subject and session IDs in the dataframe
-        dict_proc = {df_seg_processed.columns[0]:[subjectID], df_seg_processed.columns[1]:[sessionID]}
-        df_proc = pd.DataFrame(data=dict_proc)
-        df_seg_processed = pd.concat([df_seg_processed, df_proc])
-        print(f'{subjectID}/{sessionID}: processed successfully!')
-    else:
-        # write subject and session IDs in the dataframe
-        dict_miss = {df_seg_missing.columns[0]:[subjectID], df_seg_missing.columns[1]:[sessionID]}
-        df_miss = pd.DataFrame(data=dict_miss)
-        df_seg_missing = pd.concat([df_seg_missing, df_miss])
-        print(f'{subjectID}/{sessionID}: segmentation failed!')
-
-
-# write dataframe with missing files as .csv file in chosen output directory
-df_seg_missing.to_csv(os.path.join(args.output_directory, "lst-ai_cross_missing.csv"), index=False)
-# write dataframe with processed files as .csv file in chosen output directory
-df_seg_processed.to_csv(os.path.join(args.output_directory, "lst-ai_cross_processed.csv"), index=False)
\ No newline at end of file
+
+from utils import DERIVATIVES, getfileList, getfileStat, getSessionID, getSubjectID
+from bids_index import open_index, update_index
+
+def check(input_directory, output_directory=None, derivatives=DERIVATIVES, parquet=False, use_index=True):
+    """
+    This function checks for every session of a BIDS database whether the LST-AI segmentation files exist and are up to date.
+
+    Parameters:
+    -----------
+    input_directory : str
+        Folder of BIDS database
+    output_directory : str
+        Destination folder for the output files (lst-ai_cross_missing.csv, lst-ai_cross_processed.csv); None: no output files
+    derivatives : str
+        Name of the LST-AI derivatives folder (e.g., lst-ai-v1.1.0)
+    parquet : bool
+        Boolean variable indicating if the full report is additionally written as lst-ai_cross_report.parquet
+    use_index : bool
+        Boolean variable indicating if the cached BIDS index is used (False: walk the filesystem)
+
+    Returns:
+    --------
+    df_report : dataframe
+        One row per session with the results of all checks (FLAIR, lesion-mask, annotated-lesion-mask, stats, stale)
+    """
+    import pandas as pd
+
+    # define path of the derivatives folder
+    input_dir = os.path.abspath(input_directory)
+    derivatives_dir = os.path.join(input_dir, 'derivatives', derivatives)
+
+    # refresh the cached BIDS index (only folders that changed since the last run are listed again)
+    index = None
+    if use_index:
+        index = open_index(os.path.join(derivatives_dir, 'lst-ai_index.sqlite'))
+        update_index(index, [input_dir, derivatives_dir])
+
+
+    # get a list with all subject folders in the database
+    T1w_list = getfileList(path = input_dir, 
+                           suffix = '*T1w*', 
+                           index = index)
+    T1w_list = [str(x) for x in T1w_list if (('.nii.gz' in str(x)) and 
+                                             (not 'derivatives' in str(x)) and
+                                             (not 'GADOLINIUM' in str(x)))]
+
+    # get the paths of all files in the derivatives folder and of all raw images as sets (hashed lookups instead of list searches)
+    deriv_files = set(str(x) for x in getfileList(derivatives_dir, 'sub-*', index=index))
+    raw_files = set(str(x) for x in getfileList(input_dir, '*.nii.gz', index=index))
+
+
+    # check every session and collect one row per session
+    rows = []
+    for t1w in T1w_list:
+        # get subject and session ID
+        subjectID = getSubjectID(t1w)
+        sessionID = getSessionID(t1w)
+
+        # define paths of input images and derivatives of this session
+        flair = t1w.replace('_T1w.nii.gz', '_FLAIR.nii.gz')
+        prefix = os.path.join(derivatives_dir, f'sub-{subjectID}', f'ses-{sessionID}', 'anat', f'sub-{subjectID}_ses-{sessionID}')
+        seg_path = f'{prefix}_space-FLAIR_label-lesion_mask.nii.gz'
+        seg_annot_path = f'{prefix}_space-FLAIR_desc-annotated_label-lesion_mask.nii.gz'
+        stats_paths = [f'{prefix}_lesion_stats.csv', f'{prefix}_annotated_lesion_stats.csv']
+
+        flair_available = flair in raw_files
+        seg_available = seg_path in deriv_files
+        seg_annot_available = seg_annot_path in deriv_files
+        stats_available = all(x in deriv_files for x in stats_paths)
+
+        # a segmentation is stale if the lesion mask is older than one of its input images
+        # (the files are stat'ed directly, since overwriting a file in place does not change the mtime of its folder in the index)
+        stale = False
+        if seg_available:
+            seg_mtime = getfileStat(seg_path)[1]
+            input_mtime = max(getfileStat(x)[1] for x in ([t1w, flair] if flair_available else [t1w]))
+            stale = seg_mtime < input_mtime
+
+        rows.append((subjectID, sessionID, flair_available, seg_available, seg_annot_available, stats_available, stale))
+
+        # (if the segmentation is missing, the processing must have failed or the FLAIR image is not available)
+        if not seg_available:
+            print(f'{subjectID}/{sessionID}: segmentation failed!' if flair_available else f'{subjectID}/{sessionID}: FLAIR image not available!')
+
+
+    # build the report with a single dataframe construction
+    df_report = pd.DataFrame(rows, columns=['subject-ID', 'session-ID', 'FLAIR', 'lesion-mask', 'annotated-lesion-mask', 'stats', 'stale'])
+    df_seg_processed = df_report.loc[df_report['lesion-mask'], ['subject-ID', 'session-ID']]
+    df_seg_missing = df_report.loc[~df_report['lesion-mask'], ['subject-ID', 'session-ID']]
+
+    print(f'Processed: {len(df_seg_processed)}')
+    print(f'Missing: {len(df_seg_missing)} (FLAIR not available: {(~df_report["FLAIR"]).sum()})')
+    print(f'Annotated lesion mask missing: {(df_report["lesion-mask"] & ~df_report["annotated-lesion-mask"]).sum()}')
+    print(f'Stats CSV missing: {(df_report["lesion-mask"] & ~df_report["stats"]).sum()}')
+    print(f'Stale (lesion mask older than T1w/FLAIR): {df_report["stale"].sum()}')
+
+
+    if index is not None:
+        index.close()
+
+    if output_directory is not None:
+        # write dataframe with missing files as .csv file in chosen output directory
+        df_seg_missing.to_csv(os.path.join(output_directory, "lst-ai_cross_missing.csv"), index=False)
+        # write dataframe with processed files as .csv file in chosen output directory
+        df_seg_processed.to_csv(os.path.join(output_directory, "lst-ai_cross_processed.csv"), index=False)
+        # optionally write the full report (all checks per session) as .parquet file
+        if parquet:
+            df_report.to_parquet(os.path.join(output_directory, "lst-ai_cross_report.parquet"), index=False)
+    return df_report
+
+def build_parser(parser=None):
+    """
+    This function adds the command line arguments of check_processed.py to a (sub)parser.
+    """
+    if parser is None:
+        parser = argparse.ArgumentParser(description='Check for missing segmentation files (e.g., when processing did not work).')
+    parser.add_argument('-i', '--input_directory', help='Folder of BIDS database.', required=True)
+    parser.add_argument('-o', '--output_directory', help='Destination folder for the output file.', required=True)
+    parser.add_argument('--derivatives', help=f'Name of the LST-AI derivatives folder (default: {DERIVATIVES}).', default=DERIVATIVES)
+    parser.add_argument('--parquet', help='Use the --parquet flag to additionally write the full report (FLAIR, masks, stats, stale) as lst-ai_cross_report.parquet.', action='store_true')
+    parser.add_argument('--no_index', help='Use the --no_index flag to walk the filesystem instead of using the cached BIDS index.', action='store_true')
+    parser.set_defaults(func=main)
+    return parser
+
+def main(args):
+    check(args.input_directory, args.output_directory, derivatives=args.derivatives, parquet=args.parquet, use_index=not args.no_index)
+
+if __name__ == "__main__":
+    main(build_parser().parse_args())
@@ -1,8 +1,10 @@
 import argparse
 import os
-import pandas as pd
+import json
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
-from utils import getfileList, getSessionID, getSubjectID
+from utils import DERIVATIVES, getfileList, getfileStat, getSessionID, getSessionOutputs, getSubjectID
+from bids_index import open_index, update_index
 
 def combineStats(path, subID, sesID):
     '''
@@ -25,6 +27,7 @@ def combineStats(path, subID, sesID):
     # define path of stat files and load them as dataframe
     les_path = os.path.join(path, "sub-"+subID, "ses-"+sesID, "anat", f'sub-{subID}_ses-{sesID}_lesion_stats.csv')
     annot_les_path = os.path.join(path, "sub-"+subID, "ses-"+sesID, "anat", f'sub-{subID}_ses-{sesID}_annotated_lesion_stats.csv')
+    import pandas as pd
     df_les_stat = pd.read_csv(les_path)
     df_les_stat.insert(0, "Region", "WM")
     df_annot_les_stat = pd.read_csv(annot_les_path)
@@ -37,34 +40,181 @@ def combineStats(path, subID, sesID):
 
     return df
 
-####################################################
-# main script
-
-parser = argparse.ArgumentParser(description='Read lesion data of LST-AI lesion segmentation.')
-parser.add_argument('-i', '--input_directory', help='Folder of derivatives in BIDS database.', required=True)
-parser.add_argument('-o', '--output_directory', help='Destination folder for the output table with volume stats.', default='/home/twiltgen/media/twiltgen/raid3/Tun/MR_database/Data/Database')
-
-# read the arguments
-args = parser.parse_args()
-
-# define path of the derivatives folder
-derivatives_dir = os.path.join(args.input_directory, "derivatives/lst-ai-v1.1.0")
-
-# get a list with the paths of the LST-AI lesion segmentation files 
-# (we do this because we only want subject- and session-IDs for the cases that have been successfully segmented by SAMSEG)
-seg_list = getfileList(path = derivatives_dir, 
-                       suffix = '*space-FLAIR_label-lesion_mask.nii.gz')
-# initialize empty dataframe into which we will write the stats data of all cases
-df_stat = pd.DataFrame()
-for i in range(len(seg_list)):
-    # get subject and session ID
-    subjectID = getSubjectID(seg_list[i])
-    sessionID = getSessionID(seg_list[i])
-    # get stats of current session
-    loop_stat = combineStats(derivatives_dir, subjectID, sessionID)
-    # write stats in the final dataframe
-    df_stat = pd.concat([df_stat, loop_stat])
-    print(f'sub-{subjectID}_ses-{sessionID}: stats added.')
-
-# write stats table to .csv file in chosen output directory
-df_stat.to_csv(os.path.join(args.output_directory, "lst-ai_lesion_stats.csv"), index=False)
+def statsMtimes(path, subID, sesID):
+    '''
+    This function returns the modification times of the _stats.csv files of a session. 
+
+    Parameters:
+    -----------
+    path : str
+        Path to the BIDS derivatives directory (e.g., .../Database_BIDS/derivatives/lst-ai-v1.1.0)
+    subID : str
+        Subject ID of the current session
+    sesID : str
+        Session ID of the current session
+    
+    Returns:
+    --------
+    mtimes : list 
+        Modification times (in ns) of the lesion stats and annotated lesion stats files (None if a file does not exist)
+    '''
+    anat = os.path.join(path, "sub-"+subID, "ses-"+sesID, "anat")
+    mtimes = []
+    for filename in (f'sub-{subID}_ses-{sesID}_lesion_stats.csv', f'sub-{subID}_ses-{sesID}_annotated_lesion_stats.csv'):
+        stat = getfileStat(os.path.join(anat, filename))
+        mtimes.append(None if stat is None else stat[1])
+    return mtimes
+
+def maskMtimes(path, subID, sesID):
+    '''
+    This function returns the modification times of the lesion masks of a session (None if a file does not exist). 
+    '''
+    mtimes = []
+    for mask in getSessionOutputs(path, subID, sesID):
+        stat = getfileStat(mask)
+        mtimes.append(None if stat is None else stat[1])
+    return mtimes
+
+def collect(input_directory, output_directory=None, derivatives=DERIVATIVES, threads=16, parquet=False, incremental=False, use_index=True, 
+            from_masks=False, processes=None):
+    """
+    This function collects the lesion stats of all segmented sessions of a BIDS database in one table.
+
+    Parameters:
+    -----------
+    input_directory : str
+        Folder of BIDS database
+    output_directory : str
+        Destination folder for the stats table (lst-ai_lesion_stats.csv or .parquet); None: no output file
+    derivatives : str
+        Name of the LST-AI derivatives folder (e.g., lst-ai-v1.1.0)
+    threads : int
+        Number of threads used to read the stats files
+    parquet : bool
+        Boolean variable indicating if the stats table is written as .parquet instead of .csv
+    incremental : bool
+        Boolean variable indicating if only the sessions whose stats files changed since the last run are read again
+    use_index : bool
+        Boolean variable indicating if the cached BIDS index is used (False: walk the filesystem)
+    from_masks : bool
+        Boolean variable indicating if the stats are computed from the lesion masks (see lesion_stats.py) instead of read from the
+        stats files of LST-AI; the table is written as lst-ai_lesion_stats_masks.csv (or .parquet)
+    processes : int
+        Number of processes that compute the stats from the masks (None: number of cores)
+
+    Returns:
+    --------
+    df_stat : dataframe
+        Lesion stats of all sessions (one row per session and region)
+    """
+    import pandas as pd
+
+    # define path of the derivatives folder
+    derivatives_dir = os.path.join(os.path.abspath(input_directory), 'derivatives', derivatives)
+
+    # refresh the cached BIDS index of the derivatives folder
+    index = None
+    if use_index:
+        index = open_index(os.path.join(derivatives_dir, 'lst-ai_index.sqlite'))
+        update_index(index, [derivatives_dir])
+
+    # get a list with the paths of the LST-AI lesion segmentation files 
+    # (we do this because we only want subject- and session-IDs for the cases that have been successfully segmented by SAMSEG)
+    seg_list = getfileList(path = derivatives_dir, 
+                           suffix = '*space-FLAIR_label-lesion_mask.nii.gz', 
+                           index = index)
+    # get subject and session IDs of all segmented sessions
+    sessions = [(getSubjectID(x), getSessionID(x)) for x in seg_list]
+
+    # modification times of the stats files (or masks) of each session (used to detect changes for incremental runs)
+    mtimes = maskMtimes if from_masks else statsMtimes
+    stats_mtimes = {f'sub-{subID}_ses-{sesID}': mtimes(derivatives_dir, subID, sesID) for subID, sesID in sessions}
+
+    # for incremental runs, keep the rows of all sessions whose stats files did not change since the last aggregate
+    output_file = None
+    df_previous = None
+    if output_directory is not None:
+        name = "lst-ai_lesion_stats_masks" if from_masks else "lst-ai_lesion_stats"
+        output_file = os.path.join(output_directory, f'{name}.parquet' if parquet else f'{name}.csv')
+        manifest_file = os.path.join(output_directory, f'{name}_manifest.json')
+    if incremental and output_file is not None and os.path.exists(output_file) and os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+        unchanged = set(x for x in stats_mtimes if (x in manifest) and (manifest[x] == stats_mtimes[x]))
+        if parquet:
+            df_previous = pd.read_parquet(output_file)
+        else:
+            df_previous = pd.read_csv(output_file, dtype={'sub-ID': str, 'ses-ID': str})
+        df_previous = df_previous[('sub-' + df_previous['sub-ID'] + '_ses-' + df_previous['ses-ID']).isin(unchanged)]
+        sessions = [(subID, sesID) for subID, sesID in sessions if f'sub-{subID}_ses-{sesID}' not in unchanged]
+        print(f'Incremental run: {len(unchanged)} unchanged session(s), {len(sessions)} session(s) to read.')
+
+    if from_masks:
+        # compute the stats from the lesion masks with a process pool (decompression and labeling are CPU bound)
+        from lesion_stats import try_session_stats
+        rows = []
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            for (subID, sesID), (session_rows, error) in zip(sessions, executor.map(try_session_stats, [(derivatives_dir,) + x for x in sessions], chunksize=8)):
+                if error is not None:
+                    print(f'sub-{subID}_ses-{sesID}: lesion mask cannot be read ({error}), skip session.')
+                rows += session_rows
+        df_list = [pd.DataFrame(rows, columns=['sub-ID', 'ses-ID', 'Region', 'Num_Lesions', 'Lesion_Volume'])] if rows else []
+        print(f'Stats of {len(set(x[:2] for x in rows))} session(s) computed from the lesion masks.')
+    else:
+        # read the stats files of all sessions with a thread pool (reading is I/O bound)
+        def readStats(ids):
+            try:
+                return combineStats(derivatives_dir, ids[0], ids[1])
+            except FileNotFoundError as e:
+                print(f'sub-{ids[0]}_ses-{ids[1]}: stats file not available ({e.filename}), skip session.')
+                return None
+
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            df_list = [x for x in executor.map(readStats, sessions) if x is not None]
+        print(f'Stats of {len(df_list)} session(s) added.')
+
+    # concatenate all stats once and set the column dtypes
+    if df_previous is not None:
+        df_list.insert(0, df_previous)
+    df_stat = pd.concat(df_list, ignore_index=True) if len(df_list) > 0 else pd.DataFrame(columns=['sub-ID', 'ses-ID', 'Region'])
+    df_stat = df_stat.astype({'sub-ID': str, 'ses-ID': str, 'Region': 'category'})
+    df_stat = df_stat.sort_values(['sub-ID', 'ses-ID'], kind='stable')
+
+    if index is not None:
+        index.close()
+
+    if output_file is not None:
+        # write stats table to .csv (or .parquet) file in chosen output directory
+        if parquet:
+            df_stat.to_parquet(output_file, index=False)
+        else:
+            df_stat.to_csv(output_file, index=False)
+        # remember the state of the stats files for the next incremental run
+        with open(manifest_file, 'w') as f:
+            json.dump(stats_mtimes, f)
+    return df_stat
+
+def build_parser(parser=None):
+    """
+    This function adds the command line arguments of collect_volumes.py to a (sub)parser.
+    """
+    if parser is None:
+        parser = argparse.ArgumentParser(description='Read lesion data of LST-AI lesion segmentation.')
+    parser.add_argument('-i', '--input_directory', help='Folder of derivatives in BIDS database.', required=True)
+    parser.add_argument('-o', '--output_directory', help='Destination folder for the output table with volume stats.', default='/home/twiltgen/media/twiltgen/raid3/Tun/MR_database/Data/Database')
+    parser.add_argument('--derivatives', help=f'Name of the LST-AI derivatives folder (default: {DERIVATIVES}).', default=DERIVATIVES)
+    parser.add_argument('-t', '--threads', help='Number of threads used to read the stats files (default: 16).', type=int, default=16)
+    parser.add_argument('--parquet', help='Use the --parquet flag to write the stats table as lst-ai_lesion_stats.parquet instead of .csv.', action='store_true')
+    parser.add_argument('--incremental', help='Use the --incremental flag to only re-read the sessions whose stats files changed since the last run.', action='store_true')
+    parser.add_argument('--no_index', help='Use the --no_index flag to walk the filesystem instead of using the cached BIDS index.', action='store_true')
+    parser.add_argument('--from_masks', help='Use the --from_masks flag to compute the lesion stats (number of lesions, volume in mm^3, per region) from the lesion masks instead of reading the stats files of LST-AI.', action='store_true')
+    parser.add_argument('-p', '--processes', help='Number of processes that compute the stats from the lesion masks (default: number of cores).', type=int, default=None)
+    parser.set_defaults(func=main)
+    return parser
+
+def main(args):
+    collect(args.input_directory, args.output_directory, derivatives=args.derivatives, threads=args.threads, parquet=args.parquet,
+            incremental=args.incremental, use_index=not args.no_index, from_masks=args.from_masks, processes=args.processes)
+
+if __name__ == "__main__":
+    main(build_parser().parse_args())
@@ -0,0 +1,107 @@
+import io
+import sys
+import resource
+import traceback
+import contextlib
+from collections import deque
+
+# LST-AI entry point and models that stay loaded for the lifetime of the worker process
+_lst_main = None
+_model_cache = {}
+
+def _patch_tensorflow():
+    """
+    This function keeps the segmentation models resident in the worker process: tf.keras.models.load_model is
+    memoized per model path, so that every session after the first one reuses the loaded weights.
+    The thread settings of TensorFlow can only be set once per process, so later calls are ignored.
+    The patch has to be applied before LST-AI is imported (LST-AI may import load_model by name).
+    """
+    try:
+        import tensorflow as tf
+    except ImportError:
+        return
+
+    load_model = tf.keras.models.load_model
+    def cached_load_model(filepath, *args, **kwargs):
+        key = (str(filepath), repr(args), repr(sorted(kwargs.items())))
+        if key not in _model_cache:
+            _model_cache[key] = load_model(filepath, *args, **kwargs)
+        return _model_cache[key]
+    tf.keras.models.load_model = cached_load_model
+
+    for name in ('set_intra_op_parallelism_threads', 'set_inter_op_parallelism_threads'):
+        setter = getattr(tf.config.threading, name)
+        def safe_setter(n, setter=setter):
+            try:
+                setter(n)
+            except RuntimeError:
+                pass
+        setattr(tf.config.threading, name, safe_setter)
+
+def load_engine():
+    """
+    This function imports LST-AI once per worker process and returns the function behind the "lst" command.
+
+    Returns:
+    --------
+    main : callable
+        Entry point of the LST-AI command line interface (reads its arguments from sys.argv)
+    """
+    global _lst_main
+    if _lst_main is None:
+        from importlib.metadata import entry_points
+        eps = entry_points()
+        eps = eps.select(group='console_scripts') if hasattr(eps, 'select') else eps.get('console_scripts', [])
+        eps = [ep for ep in eps if ep.name == 'lst']
+        if len(eps) == 0:
+            raise ImportError('LST-AI is not installed in this Python environment (no "lst" entry point found)')
+        _patch_tensorflow()
+        _lst_main = eps[0].load()
+    return _lst_main
+
+def run_in_process(lst_args, stderr_lines=20):
+    """
+    This function runs LST-AI inside the current (worker) process instead of starting a new "lst" process,
+    so that the interpreter start-up, the import of the deep learning libraries and the loading of the model
+    weights are paid only once per worker.
+
+    Parameters:
+    -----------
+    lst_args : list
+        Command line arguments of LST-AI (without the program name)
+    stderr_lines : int
+        Number of stderr lines that are kept
+
+    Returns:
+    --------
+    usage : dict
+        Same keys as telemetry.run_and_measure: exit code ('returncode'), CPU time in seconds ('cpu_user', 'cpu_system'),
+        peak memory in bytes of the worker process ('max_rss') and the last lines of stderr ('stderr_tail')
+    """
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    stderr = io.StringIO()
+    returncode = 0
+
+    argv = sys.argv
+    sys.argv = ['lst'] + [str(x) for x in lst_args]
+    try:
+        with contextlib.redirect_stderr(stderr):
+            main = load_engine()
+            result = main()
+            if isinstance(result, int):
+                returncode = result
+    except SystemExit as e:
+        returncode = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except Exception:
+        stderr.write(traceback.format_exc())
+        returncode = 1
+    finally:
+        sys.argv = argv
+
+    sys.stderr.write(stderr.getvalue())
+    usage_after = resource.getrusage(resource.RUSAGE_SELF)
+    return {'returncode': returncode,
+            'cpu_user': usage_after.ru_utime - usage_before.ru_utime,
+            'cpu_system': usage_after.ru_stime - usage_before.ru_stime,
+            'max_rss': usage_after.ru_maxrss * 1024,
+            'stderr_tail': list(deque(stderr.getvalue().splitlines(), maxlen=stderr_lines))}
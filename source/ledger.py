@@ -0,0 +1,138 @@
+import json
+import time
+import sqlite3
+from pathlib import Path
+
+# job states: 'queued' (waiting), 'running' (started, also left behind by crashed runs), 'done', 'failed'
+
+def _connect(ledger_file):
+    """
+    This function opens a connection to the ledger. SQLite locks the file, so that several
+    worker processes can update their jobs at the same time.
+    """
+    conn = sqlite3.connect(ledger_file, timeout=120)
+    conn.execute('CREATE TABLE IF NOT EXISTS jobs (session TEXT PRIMARY KEY, job TEXT, state TEXT, attempts INTEGER, updated REAL, error TEXT)')
+    return conn
+
+def open_ledger(ledger_file):
+    """
+    This function creates the job ledger if it does not exist yet.
+
+    Parameters:
+    -----------
+    ledger_file : str
+        Path of the SQLite ledger file
+    """
+    Path(ledger_file).parent.mkdir(parents=True, exist_ok=True)
+    _connect(ledger_file).close()
+
+def session_key(job):
+    """
+    This function returns the ledger key of a session job (e.g., 'sub-001_ses-01').
+    """
+    return f'sub-{job["subID"]}_ses-{job["sesID"]}'
+
+def add_jobs(ledger_file, jobs):
+    """
+    This function adds session jobs to the ledger. Jobs that are already in the ledger keep their state and attempt count,
+    but their stored job is replaced (e.g., the 'force' flag of the incremental mode is kept for --resume).
+
+    Parameters:
+    -----------
+    ledger_file : str
+        Path of the SQLite ledger file
+    jobs : list
+        Session jobs as returned by run_lst_ai.discover
+    """
+    conn = _connect(ledger_file)
+    with conn:
+        conn.executemany('INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (session) DO UPDATE SET job = excluded.job',
+                         [(session_key(job), json.dumps(job), 'queued', 0, time.time(), None) for job in jobs])
+    conn.close()
+
+def pending_jobs(ledger_file, max_attempts, jobs=None):
+    """
+    This function returns the jobs that still have to be processed: queued jobs, jobs that were left 'running' by an
+    interrupted run and failed jobs that have attempts left.
+
+    Parameters:
+    -----------
+    ledger_file : str
+        Path of the SQLite ledger file
+    max_attempts : int
+        Maximum number of attempts per session
+    jobs : list
+        Optional list of session jobs (e.g., from the discovery); if provided, only these jobs are considered
+        and finished jobs are handed out again (the worker skips them if their segmentation still exists)
+
+    Returns:
+    --------
+    pending : list
+        Session jobs in the order in which they were added to the ledger (or in the order of jobs)
+    """
+    conn = _connect(ledger_file)
+    rows = {x[0]: x[1:] for x in conn.execute('SELECT session, job, state, attempts FROM jobs ORDER BY rowid')}
+    conn.close()
+
+    if jobs is None:
+        return [json.loads(job) for job, state, attempts in rows.values()
+                if state != 'done' and attempts < max_attempts]
+    return [job for job in jobs
+            if (session_key(job) not in rows) or (rows[session_key(job)][1] == 'done') or (rows[session_key(job)][2] < max_attempts)]
+
+def mark_running(ledger_file, job):
+    """
+    This function marks a job as running and increments its attempt count.
+
+    Parameters:
+    -----------
+    ledger_file : str
+        Path of the SQLite ledger file
+    job : dict
+        Session job
+    """
+    conn = _connect(ledger_file)
+    with conn:
+        conn.execute('INSERT OR IGNORE INTO jobs VALUES (?, ?, ?, ?, ?, ?)', (session_key(job), json.dumps(job), 'queued', 0, time.time(), None))
+        # (a finished job that is started again, e.g. because its outputs were deleted, starts a new attempt count)
+        conn.execute("UPDATE jobs SET state = ?, attempts = CASE WHEN state = 'done' THEN 1 ELSE attempts + 1 END, updated = ?, error = NULL WHERE session = ?", ('running', time.time(), session_key(job)))
+    conn.close()
+
+def mark_finished(ledger_file, job, state, error=None):
+    """
+    This function marks a job as 'done' or 'failed'.
+
+    Parameters:
+    -----------
+    ledger_file : str
+        Path of the SQLite ledger file
+    job : dict
+        Session job
+    state : str
+        New state of the job ('done' or 'failed')
+    error : str
+        Error message of a failed job
+    """
+    conn = _connect(ledger_file)
+    with conn:
+        conn.execute('UPDATE jobs SET state = ?, updated = ?, error = ? WHERE session = ?', (state, time.time(), error, session_key(job)))
+    conn.close()
+
+def ledger_counts(ledger_file):
+    """
+    This function returns the number of jobs per state.
+
+    Parameters:
+    -----------
+    ledger_file : str
+        Path of the SQLite ledger file
+
+    Returns:
+    --------
+    counts : dict
+        Number of jobs per state (e.g., {'done': 10, 'failed': 2})
+    """
+    conn = _connect(ledger_file)
+    counts = {state: n for state, n in conn.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state')}
+    conn.close()
+    return counts
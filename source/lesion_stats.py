@@ -0,0 +1,175 @@
+import os
+
+from nifti import read_header, iter_slabs
+from utils import getSessionOutputs
+
+# labels of the annotated lesion mask of LST-AI
+REGIONS = {1: 'Periventricular', 2: 'Juxtacortical', 3: 'Subcortical', 4: 'Infratentorial'}
+
+def read_lesion_voxels(path, slab=16):
+    """
+    This function streams a lesion mask slab by slab and keeps only the lesion voxels, so that the memory use depends on
+    the lesion load and not on the image size.
+
+    Parameters:
+    -----------
+    path : str
+        Path of the lesion mask (.nii or .nii.gz)
+    slab : int
+        Number of slices that are decompressed at a time
+
+    Returns:
+    --------
+    index : numpy.ndarray
+        Sorted linear indices (Fortran order) of the lesion voxels
+    values : numpy.ndarray
+        Labels of the lesion voxels
+    header : dict
+        Header of the mask (see nifti.read_header)
+    """
+    import numpy as np
+
+    header = read_header(path)
+    if header is None or header['dtype'] is None or len(header['shape']) < 3:
+        raise ValueError(f'{path}: not a supported 3D NIfTI image')
+    nx, ny = header['shape'][:2]
+    index, values = [], []
+    for z, data in iter_slabs(path, header, slab):
+        flat = data.ravel(order='F')
+        nonzero = np.flatnonzero(flat)
+        index.append(nonzero + z * nx * ny)
+        values.append(np.rint(flat[nonzero]).astype(np.int64))
+    return np.concatenate(index), np.concatenate(values), header
+
+def label_components(index, shape, values=None):
+    """
+    This function labels the 6-connected components of a sparse set of voxels with a vectorized union-find
+    (hooking of the edges between neighboring voxels and pointer jumping). If values are given, only neighbors
+    with the same value are connected (components per region).
+
+    Parameters:
+    -----------
+    index : numpy.ndarray
+        Sorted linear indices (Fortran order) of the voxels
+    shape : tuple
+        Image dimensions
+    values : numpy.ndarray
+        Optional labels of the voxels
+
+    Returns:
+    --------
+    roots : numpy.ndarray
+        Component of every voxel (position of the representative voxel in index)
+    """
+    import numpy as np
+
+    n = len(index)
+    parent = np.arange(n)
+    if n == 0:
+        return parent
+    nx, ny = shape[0], shape[1]
+
+    # edges between neighboring voxels along x, y and z (without wrapping around the image borders)
+    edges_a, edges_b = [], []
+    for step, valid in ((1, index % nx != nx - 1), (nx, (index // nx) % ny != ny - 1), (nx * ny, np.ones(n, dtype=bool))):
+        neighbor = index + step
+        position = np.minimum(np.searchsorted(index, neighbor), n - 1)
+        found = valid & (index[position] == neighbor)
+        if values is not None:
+            found &= values[position] == values
+        edges_a.append(np.flatnonzero(found))
+        edges_b.append(position[found])
+    a, b = np.concatenate(edges_a), np.concatenate(edges_b)
+
+    # hook the larger root of every edge to the smaller one and compress the paths until all edges are inside one component
+    while True:
+        root_a, root_b = parent[a], parent[b]
+        differs = root_a != root_b
+        if not differs.any():
+            break
+        low = np.minimum(root_a[differs], root_b[differs])
+        np.minimum.at(parent, root_a[differs], low)
+        np.minimum.at(parent, root_b[differs], low)
+        while True:
+            grand = parent[parent]
+            if np.array_equal(grand, parent):
+                break
+            parent = grand
+    return parent
+
+def mask_stats(index, values, header, regions=None):
+    """
+    This function computes the number of lesions (connected components) and the lesion volume in mm^3 of a lesion mask,
+    in total or per region.
+
+    Parameters:
+    -----------
+    index : numpy.ndarray
+        Linear indices of the lesion voxels (see read_lesion_voxels)
+    values : numpy.ndarray
+        Labels of the lesion voxels
+    header : dict
+        Header of the mask
+    regions : dict
+        Labels and names of the regions (None: all lesion voxels are one region)
+
+    Returns:
+    --------
+    rows : list
+        (region, number of lesions, lesion volume) per region
+    """
+    import numpy as np
+
+    voxel_volume = float(np.prod(header['pixdim'][:3]))
+    if regions is None:
+        roots = label_components(index, header['shape'])
+        return [('WM', int(np.count_nonzero(roots == np.arange(len(roots)))), len(index) * voxel_volume)]
+
+    roots = label_components(index, header['shape'], values)
+    is_root = roots == np.arange(len(roots))
+    n_labels = max(max(regions), int(values.max(initial=0))) + 1
+    lesions = np.bincount(values[is_root], minlength=n_labels)
+    voxels = np.bincount(values, minlength=n_labels)
+    return [(name, int(lesions[label]), int(voxels[label]) * voxel_volume) for label, name in regions.items()]
+
+def session_stats(derivatives_dir, subID, sesID):
+    """
+    This function computes the lesion stats of one session from its lesion mask and annotated lesion mask
+    (same layout as the stats files of LST-AI, see collect_volumes.combineStats).
+
+    Parameters:
+    -----------
+    derivatives_dir : str
+        Path of the LST-AI derivatives folder
+    subID : str
+        Subject ID of the session
+    sesID : str
+        Session ID of the session
+
+    Returns:
+    --------
+    rows : list
+        (sub-ID, ses-ID, Region, Num_Lesions, Lesion_Volume) for the whole mask ('WM') and every region of the annotated mask
+    """
+    mask, mask_annot = getSessionOutputs(derivatives_dir, subID, sesID)
+    rows = mask_stats(*read_lesion_voxels(mask))
+    if os.path.exists(mask_annot):
+        rows += mask_stats(*read_lesion_voxels(mask_annot), regions=REGIONS)
+    return [(subID, sesID) + row for row in rows]
+
+def try_session_stats(ids):
+    """
+    This function computes the lesion stats of one session (derivatives_dir, subID, sesID) in a worker process and returns
+    the error message instead of raising it, so that one unreadable mask does not stop the other sessions.
+
+    Returns:
+    --------
+    rows : list
+        Stats of the session (see session_stats), empty if the masks cannot be read
+    error : str
+        Error message or None
+    """
+    try:
+        return session_stats(*ids), None
+    except (OSError, EOFError, ValueError) as e:
+        return [], f'{type(e).__name__}: {e}'
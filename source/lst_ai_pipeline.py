@@ -0,0 +1,108 @@
+"""
+Programmatic interface and command line of the LST-AI pipeline.
+
+The functions can be used from a long-lived Python process (e.g., a notebook or a scheduler) without starting new interpreters:
+
+    from lst_ai_pipeline import discover, plan, run, check, collect
+    jobs = discover('/path/to/bids/dataset')
+    results = run('/path/to/bids/dataset', number_of_workers=4, cpu=True)
+    df_report = check('/path/to/bids/dataset')
+    df_stat = collect('/path/to/bids/dataset')
+
+The command line combines the scripts as subcommands (python lst_ai_pipeline.py {run,plan,check,collect,report} ...).
+Heavy dependencies (pandas) are only imported by the functions that need them.
+"""
+import argparse
+
+import run_lst_ai
+import check_processed
+import collect_volumes
+import telemetry
+from utils import DERIVATIVES
+
+def run_arguments(input_directory, **options):
+    """
+    This function returns the arguments of run_lst_ai.py (defaults of the command line) with the given options,
+    e.g. run_arguments('/data/bids', number_of_workers=4, cpu=True).
+    """
+    args = run_lst_ai.build_parser().parse_args(['-i', input_directory])
+    for key, value in options.items():
+        if not hasattr(args, key):
+            raise TypeError(f'unknown option of run_lst_ai.py: {key}')
+        setattr(args, key, value)
+    return args
+
+def discover(input_directory, derivatives=DERIVATIVES, use_index=True, job_order='oldest', incremental=False, clipping=(0.5, 99.5), hash_inputs=False):
+    """
+    This function returns the session jobs of a BIDS database that still have to be segmented (see run_lst_ai.discover).
+    """
+    return run_lst_ai.discover(input_directory, derivatives=derivatives, use_index=use_index, job_order=job_order,
+                               incremental=incremental, clipping=clipping, hash_inputs=hash_inputs)
+
+def plan(input_directory, **options):
+    """
+    This function lists the sessions that would be processed and predicts the makespan of the requested and the
+    candidate worker layouts without running LST-AI (see run_lst_ai.make_plan).
+
+    Parameters:
+    -----------
+    input_directory : str
+        Folder of BIDS database
+    options : dict
+        Options of run_lst_ai.py (e.g., number_of_workers=4, threads=8, cpu=True)
+
+    Returns:
+    --------
+    plan : dict
+        Sessions that would be processed ('sessions'), predicted layouts ('layouts') and recommended layout ('recommended')
+    """
+    return run_lst_ai.run(run_arguments(input_directory, plan=True, **options))
+
+def run(input_directory, **options):
+    """
+    This function runs the LST-AI pipeline on a BIDS database (see run_lst_ai.run).
+
+    Parameters:
+    -----------
+    input_directory : str
+        Folder of BIDS database
+    options : dict
+        Options of run_lst_ai.py (e.g., number_of_workers=4, cpu=True, derivatives='lst-ai-v1.2.0')
+
+    Returns:
+    --------
+    results : list
+        Run log records of the processed sessions
+    """
+    return run_lst_ai.run(run_arguments(input_directory, **options))
+
+def check(input_directory, output_directory=None, derivatives=DERIVATIVES, parquet=False, use_index=True):
+    """
+    This function checks the segmentation files of all sessions (see check_processed.check).
+    """
+    return check_processed.check(input_directory, output_directory, derivatives=derivatives, parquet=parquet, use_index=use_index)
+
+def collect(input_directory, output_directory=None, derivatives=DERIVATIVES, threads=16, parquet=False, incremental=False, use_index=True, 
+            from_masks=False, processes=None):
+    """
+    This function collects the lesion stats of all segmented sessions (see collect_volumes.collect).
+    """
+    return collect_volumes.collect(input_directory, output_directory, derivatives=derivatives, threads=threads, parquet=parquet,
+                                   incremental=incremental, use_index=use_index, from_masks=from_masks, processes=processes)
+
+def build_parser():
+    """
+    This function builds the command line with one subcommand per script.
+    """
+    parser = argparse.ArgumentParser(description='LST-AI pipeline for BIDS databases.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_lst_ai.build_parser(subparsers.add_parser('run', help='Segment the pending sessions with LST-AI (run_lst_ai.py).'))
+    run_lst_ai.build_parser(subparsers.add_parser('plan', help='Predict the makespan of the pending sessions without running LST-AI (run_lst_ai.py --plan).')).set_defaults(plan=True)
+    check_processed.build_parser(subparsers.add_parser('check', help='Check for missing segmentation files (check_processed.py).'))
+    collect_volumes.build_parser(subparsers.add_parser('collect', help='Collect the lesion stats in one table (collect_volumes.py).'))
+    telemetry.build_parser(subparsers.add_parser('report', help='Summarize run logs (telemetry.py).'))
+    return parser
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+    args.func(args)
@@ -0,0 +1,90 @@
+import gzip
+import struct
+
+# NIfTI datatype codes and the corresponding NumPy type characters
+DATATYPES = {2: 'u1', 4: 'i2', 8: 'i4', 16: 'f4', 64: 'f8', 256: 'i1', 512: 'u2', 768: 'u4', 1024: 'i8', 1280: 'u8'}
+
+def read_header(path):
+    """
+    This function reads the header of a NIfTI-1/NIfTI-2 image (.nii or .nii.gz) without reading the voxel data
+    (only the first block of a gzipped image is decompressed).
+
+    Parameters:
+    -----------
+    path : str
+        Path of the image
+
+    Returns:
+    --------
+    header : dict
+        Image dimensions ('shape'), voxel size in mm ('pixdim'), NumPy dtype string ('dtype', e.g. '<u1'), offset of the voxel data
+        in bytes ('vox_offset') and scaling ('scl_slope', 'scl_inter'); None if the header cannot be read
+    """
+    opener = gzip.open if str(path).endswith('.gz') else open
+    try:
+        with opener(path, 'rb') as f:
+            raw = f.read(540)
+    except (OSError, EOFError):
+        return None
+
+    for endian in ('<', '>'):
+        if len(raw) >= 348 and struct.unpack_from(f'{endian}i', raw, 0)[0] == 348:
+            dims = struct.unpack_from(f'{endian}8h', raw, 40)
+            datatype = struct.unpack_from(f'{endian}h', raw, 70)[0]
+            pixdim = struct.unpack_from(f'{endian}8f', raw, 76)
+            vox_offset, scl_slope, scl_inter = struct.unpack_from(f'{endian}3f', raw, 108)
+            break
+        if len(raw) >= 540 and struct.unpack_from(f'{endian}i', raw, 0)[0] == 540:
+            datatype = struct.unpack_from(f'{endian}h', raw, 12)[0]
+            dims = struct.unpack_from(f'{endian}8q', raw, 16)
+            pixdim = struct.unpack_from(f'{endian}8d', raw, 104)
+            vox_offset, scl_slope, scl_inter = struct.unpack_from(f'{endian}q2d', raw, 168)
+            break
+    else:
+        return None
+    if not 1 <= dims[0] <= 7:
+        return None
+
+    return {'shape': tuple(max(1, x) for x in dims[1:dims[0] + 1]),
+            'pixdim': tuple(abs(x) for x in pixdim[1:dims[0] + 1]),
+            'dtype': endian + DATATYPES[datatype] if datatype in DATATYPES else None,
+            'vox_offset': int(vox_offset),
+            'scl_slope': scl_slope,
+            'scl_inter': scl_inter}
+
+def iter_slabs(path, header, slab=16):
+    """
+    This function reads the voxel data of a 3D image in slabs of a few slices along the last axis (streaming, so that the
+    complete image is never held in memory). Scaling (scl_slope/scl_inter) is not applied.
+
+    Parameters:
+    -----------
+    path : str
+        Path of the image
+    header : dict
+        Header of the image (see read_header)
+    slab : int
+        Number of slices per slab
+
+    Yields:
+    -------
+    z : int
+        Index of the first slice of the slab
+    data : numpy.ndarray
+        Voxel data of the slab with shape (x, y, slices)
+    """
+    import numpy as np
+
+    dtype = np.dtype(header['dtype'])
+    nx, ny, nz = (tuple(header['shape']) + (1, 1))[:3]
+    slice_bytes = nx * ny * dtype.itemsize
+    opener = gzip.open if str(path).endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        f.read(header['vox_offset'])
+        for z in range(0, nz, slab):
+            n = min(slab, nz - z)
+            buffer = f.read(n * slice_bytes)
+            if len(buffer) < n * slice_bytes:
+                raise EOFError(f'{path}: image data is truncated')
+            # voxels are stored in Fortran order (x fastest)
+            yield z, np.frombuffer(buffer, dtype=dtype).reshape((n, ny, nx)).transpose(2, 1, 0)
@@ -0,0 +1,150 @@
+import os
+import gzip
+import time
+import shutil
+import datetime
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import commitDirectory
+
+def scratch_inputs_dir(scratch_dir, job):
+    """
+    This function returns the folder on the local scratch disk to which the input images of a session are prefetched.
+    """
+    return os.path.join(scratch_dir, 'inputs', f'sub-{job["subID"]}_ses-{job["sesID"]}')
+
+def scratch_staging_dir(scratch_dir, job):
+    """
+    This function returns the staging folder on the local scratch disk in which LST-AI writes the outputs of a session.
+    """
+    return os.path.join(scratch_dir, 'staging', f'sub-{job["subID"]}_ses-{job["sesID"]}')
+
+def prefetch_session(job, scratch_dir, decompress=False):
+    """
+    This function copies the T1w and FLAIR images of a session from the (network) database to the local scratch disk,
+    optionally decompressed to .nii, so that LST-AI reads its inputs from local storage.
+
+    Parameters:
+    -----------
+    job : dict
+        Session job
+    scratch_dir : str
+        Folder on the local scratch disk
+    decompress : bool
+        Boolean variable indicating if the images should be stored uncompressed (.nii)
+
+    Returns:
+    --------
+    job : dict
+        Copy of the session job with the local paths of the images ('t1w_local', 'flair_local') and the prefetch time ('prefetch')
+    """
+    t_start = time.perf_counter()
+    job = dict(job)
+    target = scratch_inputs_dir(scratch_dir, job)
+    Path(target).mkdir(parents=True, exist_ok=True)
+    try:
+        for key in ('t1w', 'flair'):
+            if not os.path.exists(job[key]):
+                continue
+            if decompress and job[key].endswith('.gz'):
+                local = os.path.join(target, os.path.basename(job[key])[:-3])
+                with gzip.open(job[key], 'rb') as src, open(local, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, 1 << 20)
+            else:
+                local = os.path.join(target, os.path.basename(job[key]))
+                shutil.copyfile(job[key], local)
+            job[f'{key}_local'] = local
+    except OSError as e:
+        # LST-AI reads the images from the database instead
+        print(f'{datetime.datetime.now()} sub-{job["subID"]}_ses-{job["sesID"]}: prefetch failed ({e}), read inputs from the database.')
+        job.pop('t1w_local', None)
+        job.pop('flair_local', None)
+    job['prefetch'] = time.perf_counter() - t_start
+    return job
+
+def prefetch_jobs(jobs, scratch_dir, slots, depth, decompress=False):
+    """
+    This function is a generator that hands out the session jobs after their inputs were prefetched to the scratch disk.
+    The inputs of the next sessions are copied in background threads while the workers segment the previous sessions.
+    A session occupies one of the slots from the start of its prefetch until its outputs were written back
+    (see release_session), which bounds the space used on the scratch disk.
+
+    Parameters:
+    -----------
+    jobs : list
+        Session jobs
+    scratch_dir : str
+        Folder on the local scratch disk
+    slots : threading.Semaphore
+        Semaphore with one slot per session that may be on the scratch disk at the same time
+    depth : int
+        Number of sessions that are prefetched in parallel
+    decompress : bool
+        Boolean variable indicating if the images should be stored uncompressed (.nii)
+
+    Yields:
+    -------
+    job : dict
+        Session job with the local paths of the images (see prefetch_session)
+    """
+    with ThreadPoolExecutor(max_workers=max(1, depth)) as executor:
+        futures = []
+        jobs = iter(jobs)
+        while True:
+            # take the next session only once a slot is free (the jobs may be held back until then, see temp_store.hold_back)
+            slots.acquire()
+            job = next(jobs, None)
+            if job is None:
+                slots.release()
+                break
+            futures.append(executor.submit(prefetch_session, job, scratch_dir, decompress))
+            # hand out the oldest prefetched session as soon as it is ready and enough sessions are in flight
+            while len(futures) > depth or (len(futures) > 0 and futures[0].done()):
+                yield futures.pop(0).result()
+        for future in futures:
+            yield future.result()
+
+def write_back(record, derivatives_dir):
+    """
+    This function moves the finished outputs of a session from the scratch disk to the derivatives folder:
+    they are copied into the staging folder of the derivatives (same filesystem) and then committed with a directory rename.
+
+    Parameters:
+    -----------
+    record : dict
+        Run log record of the session with the local staging folder ('writeback')
+    derivatives_dir : str
+        Path of the LST-AI derivatives folder in the BIDS database
+
+    Returns:
+    --------
+    record : dict
+        Updated run log record (status 'failed' and error message if the write-back failed)
+    """
+    t_start = time.perf_counter()
+    subID, sesID = record['subID'], record['sesID']
+    staging_ses = os.path.join(derivatives_dir, '.staging', f'sub-{subID}_ses-{sesID}')
+    try:
+        if os.path.exists(staging_ses):
+            shutil.rmtree(staging_ses)
+        shutil.copytree(record['writeback'], staging_ses)
+        commitDirectory(staging_ses, os.path.join(derivatives_dir, f'sub-{subID}', f'ses-{sesID}'))
+        shutil.rmtree(record['writeback'])
+    except Exception as e:
+        record['status'] = 'failed'
+        record['error'] = f'{type(e).__name__}: {e}'
+        print(f'{datetime.datetime.now()} sub-{subID}_ses-{sesID}: write-back failed ({record["error"]}), the session is retried in a later run')
+    # (the write-back runs in the main process after the worker finished, so it is not part of the elapsed time of the worker)
+    record['phases']['writeback'] = time.perf_counter() - t_start
+    record['end'] = time.time()
+    return record
+
+def release_session(job, scratch_dir, slots):
+    """
+    This function removes the prefetched inputs of a session from the scratch disk and frees its slot. The staging folder
+    of a failed session or of a failed write-back is removed as well, so that the slots bound the space on the scratch disk.
+    """
+    shutil.rmtree(scratch_inputs_dir(scratch_dir, job), ignore_errors=True)
+    shutil.rmtree(scratch_staging_dir(scratch_dir, job), ignore_errors=True)
+    slots.release()
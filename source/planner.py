@@ -0,0 +1,251 @@
+import os
+import heapq
+import json
+import statistics
+
+from nifti import read_header
+from resources import plan_layout
+from utils import isSessionComplete
+
+# cost model of one session (assumptions that are replaced by measurements from the run logs when available):
+# single-thread work in seconds of a reference session (T1w + FLAIR with 256 x 256 x 176 voxels each) on GPU and CPU,
+REFERENCE_VOXELS = 2 * 256 * 256 * 176
+DEFAULT_WORK = {'gpu': 300.0, 'cpu': 3600.0}
+# fraction of the work that does not scale with the number of threads (Amdahl's law),
+SERIAL_FRACTION = 0.3
+# fraction of the GPU time that is serialized when several jobs share one device,
+GPU_SHARED_FRACTION = 0.5
+# and time in seconds per session outside of LST-AI (start-up, renaming, commit)
+DEFAULT_OVERHEAD = 5.0
+
+def session_voxels(job):
+    """
+    This function returns the number of voxels of the T1w and FLAIR images of a session (None if a header cannot be read).
+    """
+    total = 0
+    for key in ('t1w', 'flair'):
+        header = read_header(job[key])
+        if header is None:
+            return None
+        n = 1
+        for x in header['shape']:
+            n *= x
+        total += n
+    return total
+
+def speedup(threads):
+    """
+    This function returns the speedup of one session with the given number of threads (Amdahl's law).
+    """
+    return 1.0 / (SERIAL_FRACTION + (1.0 - SERIAL_FRACTION) / max(1, threads))
+
+def fit_cost_model(records):
+    """
+    This function fits the cost model to the records of previous runs: the single-thread work per voxel on GPU and CPU,
+    the overhead per session and the peak memory of one session.
+
+    Parameters:
+    -----------
+    records : list
+        Run log records (see telemetry.load_records)
+
+    Returns:
+    --------
+    model : dict
+        Work in seconds per voxel ('work_per_voxel', per mode), overhead in seconds ('overhead'), peak memory in bytes ('max_rss'),
+        single-thread work of the processed sessions ('history', per mode and session) and the number of records used ('sessions')
+    """
+    work_per_voxel = {'gpu': [], 'cpu': []}
+    history = {'gpu': {}, 'cpu': {}}
+    overheads, max_rss = [], []
+    for record in records:
+        if record.get('status') != 'processed' or 'lst' not in record.get('phases', {}):
+            continue
+        mode = 'cpu' if record.get('device') in (None, 'cpu') else 'gpu'
+        work = record['phases']['lst'] * speedup(record.get('threads') or 1)
+        history[mode][f'sub-{record["subID"]}_ses-{record["sesID"]}'] = work
+        work_per_voxel[mode].append(work / (record.get('voxels') or REFERENCE_VOXELS))
+        overheads.append(max(0.0, record['elapsed'] - record['phases']['lst']))
+        if record.get('max_rss'):
+            max_rss.append(record['max_rss'])
+
+    model = {'work_per_voxel': {}, 'history': history, 'sessions': len(overheads),
+             'overhead': statistics.median(overheads) if overheads else DEFAULT_OVERHEAD,
+             'max_rss': max(max_rss) if max_rss else None}
+    for mode in ('gpu', 'cpu'):
+        if work_per_voxel[mode]:
+            model['work_per_voxel'][mode] = statistics.median(work_per_voxel[mode])
+        else:
+            model['work_per_voxel'][mode] = DEFAULT_WORK[mode] / REFERENCE_VOXELS
+    return model
+
+def job_cost(job, voxels, model, mode, threads, jobs_per_device=1, oversubscription=1.0):
+    """
+    This function estimates the time in seconds of one session in a given layout.
+
+    Parameters:
+    -----------
+    job : dict
+        Session job
+    voxels : int
+        Number of voxels of the T1w and FLAIR images (None: reference session)
+    model : dict
+        Cost model (see fit_cost_model)
+    mode : str
+        "gpu" or "cpu"
+    threads : int
+        Number of threads per worker
+    jobs_per_device : int
+        Number of sessions that share one GPU
+    oversubscription : float
+        Ratio of the threads of all concurrent sessions to the available cores (values above 1 slow down every session)
+
+    Returns:
+    --------
+    cost : float
+        Estimated time of the session in seconds
+    """
+    session = f'sub-{job["subID"]}_ses-{job["sesID"]}'
+    work = model['history'][mode].get(session)
+    if work is None:
+        work = model['work_per_voxel'][mode] * (voxels or REFERENCE_VOXELS)
+    # (oversubscribed cores are shared by the threads of all concurrent sessions)
+    cost = work / speedup(threads) * max(1.0, oversubscription)
+    if mode == 'gpu' and jobs_per_device > 1:
+        cost *= (1 - GPU_SHARED_FRACTION) + GPU_SHARED_FRACTION * jobs_per_device
+    return cost + model['overhead']
+
+def predict_makespan(costs, n_workers):
+    """
+    This function simulates the dynamic scheduling of run_lst_ai.py (every session is handed out in queue order
+    to the next free worker) and returns the predicted wall time in seconds.
+    """
+    workers = [0.0] * max(1, n_workers)
+    for cost in costs:
+        heapq.heapreplace(workers, workers[0] + cost)
+    return max(workers)
+
+def candidate_layouts(cores, memory, devices=None, mem_per_job=None):
+    """
+    This function enumerates the worker x thread layouts that fit the machine: in CPU mode powers of two threads per worker,
+    in GPU mode one to three sessions per device.
+
+    Returns:
+    --------
+    layouts : list
+        Layouts with mode ('mode'), number of workers ('n_workers'), threads per worker ('threads') and sessions per GPU ('jobs_per_device')
+    """
+    layouts = []
+    if devices:
+        for k in (1, 2, 3):
+            n_workers, threads = plan_layout(cores, memory, device_slots=[d for d in devices for _ in range(k)], mem_per_job=mem_per_job)
+            layouts.append({'mode': 'gpu', 'n_workers': n_workers, 'threads': threads, 'jobs_per_device': -(-n_workers // len(devices))})
+    else:
+        threads = 1
+        while threads <= cores:
+            n_workers, t = plan_layout(cores, memory, threads=threads, mem_per_job=mem_per_job)
+            layouts.append({'mode': 'cpu', 'n_workers': n_workers, 'threads': t, 'jobs_per_device': 1})
+            threads *= 2
+    # drop duplicates (e.g., when the memory limits the number of workers)
+    unique = []
+    for layout in layouts:
+        if layout not in unique:
+            unique.append(layout)
+    return unique
+
+def plan_run(jobs, derivatives_dir, records, requested, cores, memory, devices=None, mem_per_job=None):
+    """
+    This function estimates the cost of every pending session (image dimensions from the NIfTI headers, runtimes of previous runs)
+    and predicts the makespan of the requested layout and of all candidate layouts, without running LST-AI.
+
+    Parameters:
+    -----------
+    jobs : list
+        Session jobs as returned by the discovery
+    derivatives_dir : str
+        Path of the LST-AI derivatives folder in the BIDS database
+    records : list
+        Run log records of previous runs
+    requested : dict
+        Requested layout ('mode', 'n_workers', 'threads', 'jobs_per_device')
+    cores : int
+        Number of available CPU cores
+    memory : int
+        Available memory in bytes
+    devices : list
+        GPU devices (None: CPU only)
+    mem_per_job : int
+        Peak memory of one session in bytes (None: from the run logs if available)
+
+    Returns:
+    --------
+    plan : dict
+        Sessions that would be processed ('sessions'), skipped ('skipped') or fail without FLAIR ('missing_flair'), cost model ('model'),
+        predicted layouts ('layouts', the requested layout first, 'oversubscribed' if the threads of all workers exceed the cores)
+        and the recommended layout ('recommended')
+    """
+    model = fit_cost_model(records)
+    if mem_per_job is None and model['max_rss']:
+        mem_per_job = int(1.2 * model['max_rss'])
+
+    # apply the skip logic of the workers (existing segmentations are skipped unless the session is forced)
+    pending, skipped, missing_flair = [], [], []
+    for job in jobs:
+        if (not job.get('force')) and isSessionComplete(derivatives_dir, job['subID'], job['sesID']):
+            skipped.append(job)
+        elif not os.path.exists(job['flair']):
+            missing_flair.append(job)
+        else:
+            pending.append(job)
+    voxels = [session_voxels(job) for job in pending]
+
+    layouts = [dict(requested, requested=True)]
+    layouts += [dict(x, requested=False) for x in candidate_layouts(cores, memory, devices, mem_per_job) if x != requested]
+    for layout in layouts:
+        n_workers = min(layout['n_workers'], max(1, len(pending)))
+        oversubscription = n_workers * layout['threads'] / max(1, cores)
+        costs = [job_cost(job, n, model, layout['mode'], layout['threads'], layout['jobs_per_device'], oversubscription) for job, n in zip(pending, voxels)]
+        layout['oversubscribed'] = oversubscription > 1
+        layout['makespan'] = predict_makespan(costs, n_workers)
+        layout['sessions_per_hour'] = 3600 * len(pending) / layout['makespan'] if layout['makespan'] > 0 else None
+        layout['cpu_hours'] = sum(costs) * layout['threads'] / max(1.0, oversubscription) / 3600
+
+    # oversubscribed layouts are only recommended if no layout fits the cores
+    fitting = [x for x in layouts if not x['oversubscribed']] or layouts
+    recommended = min(fitting, key=lambda x: (round(x['makespan'], 3), x['n_workers'] * x['threads']))
+    return {'sessions': [dict(job, voxels=n) for job, n in zip(pending, voxels)],
+            'skipped': len(skipped),
+            'missing_flair': [f'sub-{x["subID"]}_ses-{x["sesID"]}' for x in missing_flair],
+            'model': {key: value for key, value in model.items() if key != 'history'},
+            'mem_per_job': mem_per_job,
+            'layouts': layouts,
+            'recommended': recommended}
+
+def write_plan(plan, plan_file):
+    """
+    This function writes a plan (see plan_run) to a JSON file.
+    """
+    with open(plan_file, 'w') as f:
+        json.dump(plan, f, indent=1)
+
+def print_plan(plan):
+    """
+    This function prints the predicted makespan of all layouts of a plan (see plan_run).
+    """
+    voxels = [x['voxels'] for x in plan['sessions'] if x['voxels']]
+    print(f'Sessions to process: {len(plan["sessions"])} (skipped: {plan["skipped"]}, FLAIR not available: {len(plan["missing_flair"])})')
+    if voxels:
+        print(f'Image size (T1w + FLAIR): median {statistics.median(voxels)/1e6:.1f} Mvoxel, max {max(voxels)/1e6:.1f} Mvoxel')
+    model = plan['model']
+    print(f'Cost model: {model["sessions"]} session(s) of previous runs' if model['sessions'] > 0 else 'Cost model: no previous runs, default runtimes')
+    if plan['mem_per_job']:
+        print(f'Memory per session: {plan["mem_per_job"]/2**30:.2f} GiB')
+    print(f'{"layout":34s} {"makespan":>12s} {"sessions/h":>11s} {"CPU hours":>10s}')
+    for layout in plan['layouts']:
+        name = f'{layout["mode"]}: {layout["n_workers"]} worker(s) x {layout["threads"]} thread(s)'
+        if layout['mode'] == 'gpu':
+            name += f', {layout["jobs_per_device"]}/GPU'
+        flags = (' (requested)' if layout['requested'] else '') + (' (oversubscribed)' if layout['oversubscribed'] else '')
+        flags += ' <- recommended' if layout is plan['recommended'] else ''
+        rate = f'{layout["sessions_per_hour"]:.1f}' if layout['sessions_per_hour'] else '-'
+        print(f'{name:34s} {layout["makespan"]/3600:10.2f} h {rate:>11s} {layout["cpu_hours"]:10.1f}{flags}')
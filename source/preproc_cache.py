@@ -0,0 +1,205 @@
+import os
+import json
+import fcntl
+import shutil
+import sqlite3
+import hashlib
+from pathlib import Path
+
+from provenance import sha256_file
+
+# skull-stripped images in FLAIR space that LST-AI writes to its temp folder;
+# they can be passed back to LST-AI with --stripped to skip the skull-stripping
+CACHED_FILES = {'t1w': '*space-flair_desc-stripped_T1w.nii.gz',
+                'flair': '*space-flair_desc-stripped_FLAIR.nii.gz'}
+
+# lock file of a cache entry: readers hold a shared lock while LST-AI reads the images, the eviction needs an exclusive lock
+LOCK_FILE = '.lock'
+
+def file_hash(path, cache_dir):
+    """
+    This function returns the SHA-256 hash of a file. The file is read in chunks (streaming) and the hash is
+    memoized together with the size and modification time of the file, so that unchanged files are not read again.
+
+    Parameters:
+    -----------
+    path : str
+        Path of the file
+    cache_dir : str
+        Path of the cache folder (the memo is stored in hashes.sqlite)
+
+    Returns:
+    --------
+    digest : str
+        Hexadecimal SHA-256 hash of the file content
+    """
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(cache_dir, 'hashes.sqlite'), timeout=120)
+    conn.execute('CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, sha256 TEXT)')
+    row = conn.execute('SELECT sha256 FROM hashes WHERE path = ? AND size = ? AND mtime = ?', (path, st.st_size, st.st_mtime_ns)).fetchone()
+    if row is not None:
+        conn.close()
+        return row[0]
+
+    digest = sha256_file(path)
+    with conn:
+        conn.execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)', (path, st.st_size, st.st_mtime_ns, digest))
+    conn.close()
+    return digest
+
+def cache_key(t1w, flair, params, cache_dir):
+    """
+    This function computes the content address of the preprocessed images of a session from the hashes
+    of the input images and the parameters that affect the preprocessing.
+
+    Parameters:
+    -----------
+    t1w : str
+        Path of the T1w image
+    flair : str
+        Path of the FLAIR image
+    params : dict
+        Parameters that affect the preprocessing (e.g., LST-AI version)
+    cache_dir : str
+        Path of the cache folder
+
+    Returns:
+    --------
+    key : str
+        Hexadecimal key of the cache entry
+    """
+    sha = hashlib.sha256()
+    sha.update(file_hash(t1w, cache_dir).encode())
+    sha.update(file_hash(flair, cache_dir).encode())
+    sha.update(json.dumps(params, sort_keys=True).encode())
+    return sha.hexdigest()
+
+def cache_lookup(cache_dir, key):
+    """
+    This function returns the cached preprocessed images of a key and marks the entry as recently used.
+    The entry is protected from eviction (also by other processes and nodes) until the returned lock is released
+    with cache_release, e.g. after LST-AI has read the images.
+
+    Parameters:
+    -----------
+    cache_dir : str
+        Path of the cache folder
+    key : str
+        Key of the cache entry (see cache_key)
+
+    Returns:
+    --------
+    files : dict
+        Paths of the cached images ('t1w', 'flair') or None if the key is not in the cache
+    lock : int
+        File descriptor that holds the shared lock of the entry (None if the key is not in the cache)
+    """
+    entry = os.path.join(cache_dir, key)
+    files = {name: os.path.join(entry, f'{name}.nii.gz') for name in CACHED_FILES}
+    try:
+        lock = os.open(os.path.join(entry, LOCK_FILE), os.O_CREAT | os.O_RDWR)
+    except (FileNotFoundError, NotADirectoryError):
+        return None, None
+    fcntl.flock(lock, fcntl.LOCK_SH)
+    # the entry may have been evicted while waiting for the lock
+    if not all(os.path.exists(x) for x in files.values()):
+        os.close(lock)
+        return None, None
+    # the modification time of the entry folder is used as last access time for the LRU eviction
+    os.utime(entry)
+    return files, lock
+
+def cache_release(lock):
+    """
+    This function releases the lock of a cache entry (see cache_lookup).
+    """
+    if lock is not None:
+        os.close(lock)
+
+def cache_store(cache_dir, key, temp_dir, max_size):
+    """
+    This function copies the preprocessed images from the LST-AI temp folder into the cache and evicts the
+    least recently used entries if the cache grows beyond its size limit.
+
+    Parameters:
+    -----------
+    cache_dir : str
+        Path of the cache folder
+    key : str
+        Key of the cache entry (see cache_key)
+    temp_dir : str
+        Path of the LST-AI temp folder of the session
+    max_size : int
+        Maximum size of the cache in bytes
+
+    Returns:
+    --------
+    stored : bool
+        True if the images were found and stored
+    """
+    sources = {}
+    for name, pattern in CACHED_FILES.items():
+        found = sorted(Path(temp_dir).glob(pattern))
+        if len(found) == 0:
+            return False
+        sources[name] = found[0]
+
+    # copy into a private folder first and move it into place with a directory rename
+    entry = os.path.join(cache_dir, key)
+    tmp_entry = f'{entry}.tmp-{os.getpid()}'
+    Path(tmp_entry).mkdir(parents=True, exist_ok=True)
+    for name, src in sources.items():
+        shutil.copyfile(src, os.path.join(tmp_entry, f'{name}.nii.gz'))
+    try:
+        os.rename(tmp_entry, entry)
+    except OSError:
+        # another worker stored the same entry in the meantime
+        shutil.rmtree(tmp_entry)
+
+    evict(cache_dir, max_size)
+    return True
+
+def evict(cache_dir, max_size):
+    """
+    This function removes the least recently used cache entries until the cache is smaller than max_size.
+    Entries that are in use (see cache_lookup) are not removed.
+
+    Parameters:
+    -----------
+    cache_dir : str
+        Path of the cache folder
+    max_size : int
+        Maximum size of the cache in bytes
+    """
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_dir() and '.tmp-' not in entry.name and '.evict-' not in entry.name:
+            size = sum(x.stat().st_size for x in os.scandir(entry.path))
+            entries.append((entry.stat().st_mtime, size, entry.path))
+
+    total = sum(x[1] for x in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        # entries that are read by a running session (shared lock) are skipped
+        try:
+            lock = os.open(os.path.join(path, LOCK_FILE), os.O_CREAT | os.O_RDWR)
+        except FileNotFoundError:
+            continue
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(lock)
+            continue
+        # move the entry away while the lock is held, so that later lookups miss it
+        evicted = f'{path}.evict-{os.getpid()}'
+        try:
+            os.rename(path, evicted)
+        except OSError:
+            os.close(lock)
+            continue
+        os.close(lock)
+        shutil.rmtree(evicted, ignore_errors=True)
+        total -= size
@@ -0,0 +1,206 @@
+import os
+import json
+import time
+import queue
+import datetime
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# progress events that the workers put on the event queue (one 'start' and one 'finish' event per session):
+# (kind, session, worker pid, time, status); sessions with a pending write-back finish with status 'writeback' and are
+# finished again by the main process (worker pid None) once their outputs were written back
+
+def send_event(events, kind, record, status=None, pid=None):
+    """
+    This function puts a progress event of a session on the event queue (no-op without queue); workers pass their pid.
+    """
+    if events is not None:
+        events.put((kind, f'sub-{record["subID"]}_ses-{record["sesID"]}', pid, time.time(), status))
+
+def make_progress(total):
+    """
+    This function creates the state of the progress of a run with total queued sessions.
+    """
+    return {'total': total, 'start': time.time(), 'counts': {'processed': 0, 'skipped': 0, 'failed': 0},
+            'running': {}, 'writeback': 0, 'busy': {}, 'first_seen': {}, 'lock': threading.Lock()}
+
+def apply_event(state, event):
+    """
+    This function updates the progress state with one event (see send_event).
+    """
+    kind, session, pid, t, status = event
+    with state['lock']:
+        if kind == 'start':
+            state['running'][pid] = (session, t)
+            state['first_seen'].setdefault(pid, t)
+        elif pid is None:
+            state['writeback'] -= 1
+            state['counts'][status] += 1
+        else:
+            started = state['running'].pop(pid, None)
+            if started is not None:
+                state['busy'][pid] = state['busy'].get(pid, 0.0) + t - started[1]
+            if status == 'writeback':
+                state['writeback'] += 1
+            else:
+                state['counts'][status] += 1
+
+def progress_snapshot(state):
+    """
+    This function returns the current progress of a run.
+
+    Returns:
+    --------
+    snapshot : dict
+        Counts of the finished sessions ('processed', 'skipped', 'failed'), running sessions ('running'), sessions in write-back
+        ('writeback'), queued sessions ('queued'), throughput ('sessions_per_hour', processed sessions), estimated time to
+        completion in seconds ('eta', from the rate of all finished sessions), utilization of every worker ('workers', fraction of the
+        time since its first session in which it processed a session) and the elapsed time in seconds ('elapsed')
+    """
+    now = time.time()
+    with state['lock']:
+        counts = dict(state['counts'])
+        running = {pid: (session, now - t) for pid, (session, t) in state['running'].items()}
+        busy = dict(state['busy'])
+        first_seen = dict(state['first_seen'])
+        writeback = state['writeback']
+    elapsed = now - state['start']
+    finished = sum(counts.values())
+    queued = state['total'] - finished - len(running) - writeback
+
+    workers = {}
+    for pid, t in first_seen.items():
+        active = busy.get(pid, 0.0) + (running[pid][1] if pid in running else 0.0)
+        workers[pid] = active / (now - t) if now > t else 0.0
+
+    rate = finished / elapsed if elapsed > 0 else 0.0
+    return dict(counts, running=len(running), writeback=writeback, queued=queued, elapsed=elapsed,
+                sessions_per_hour=3600 * counts['processed'] / elapsed if elapsed > 0 else 0.0,
+                eta=(state['total'] - finished) / rate if rate > 0 else None,
+                workers=workers, sessions={str(pid): session for pid, (session, _) in running.items()},
+                updated=str(datetime.datetime.now()))
+
+def format_progress(snapshot):
+    """
+    This function formats a progress snapshot as one line for the terminal.
+    """
+    eta = str(datetime.timedelta(seconds=int(snapshot['eta']))) if snapshot['eta'] is not None else '-'
+    utilization = ' '.join(f'{100*x:.0f}%' for _, x in sorted(snapshot['workers'].items()))
+    line = (f'{datetime.datetime.now()} Progress: {snapshot["processed"]} processed, {snapshot["failed"]} failed, {snapshot["skipped"]} skipped, '
+            f'{snapshot["running"]} running, {snapshot["queued"]} queued')
+    if snapshot['writeback'] > 0:
+        line += f', {snapshot["writeback"]} in write-back'
+    return line + f' | {snapshot["sessions_per_hour"]:.1f} sessions/h, ETA {eta} | workers: {utilization if utilization else "-"}'
+
+def format_metrics(snapshot):
+    """
+    This function formats a progress snapshot in the text format of Prometheus.
+    """
+    lines = ['# TYPE lst_ai_sessions gauge']
+    for state in ('processed', 'skipped', 'failed', 'running', 'writeback', 'queued'):
+        lines.append(f'lst_ai_sessions{{state="{state}"}} {snapshot[state]}')
+    lines += ['# TYPE lst_ai_sessions_per_hour gauge', f'lst_ai_sessions_per_hour {snapshot["sessions_per_hour"]:.3f}',
+              '# TYPE lst_ai_eta_seconds gauge', f'lst_ai_eta_seconds {snapshot["eta"] if snapshot["eta"] is not None else "NaN"}',
+              '# TYPE lst_ai_elapsed_seconds gauge', f'lst_ai_elapsed_seconds {snapshot["elapsed"]:.1f}',
+              '# TYPE lst_ai_worker_utilization gauge']
+    for pid, utilization in sorted(snapshot['workers'].items()):
+        lines.append(f'lst_ai_worker_utilization{{pid="{pid}"}} {utilization:.4f}')
+    return '\n'.join(lines) + '\n'
+
+def write_status(status_file, snapshot):
+    """
+    This function writes a progress snapshot to a JSON status file (written to a temporary file and renamed, so that readers never see a partial file).
+    """
+    tmp_file = f'{status_file}.tmp-{os.getpid()}'
+    with open(tmp_file, 'w') as f:
+        json.dump(dict(snapshot, workers={str(pid): x for pid, x in snapshot['workers'].items()}), f, indent=1)
+    os.replace(tmp_file, status_file)
+
+def serve_metrics(state, port):
+    """
+    This function serves the progress of a run in the text format of Prometheus on http://127.0.0.1:port/metrics (background thread).
+
+    Returns:
+    --------
+    server : ThreadingHTTPServer
+        Running server (stop with server.shutdown())
+    """
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = format_metrics(progress_snapshot(state)).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def start_progress(events, total, interval=60, status_file=None, metrics_port=None):
+    """
+    This function starts the progress monitor of a run in a background thread of the main process: it applies the events of the workers
+    and prints the progress (and refreshes the status file) every interval seconds. The workers only put two events per session
+    on the queue, so the monitor does not slow them down.
+
+    Parameters:
+    -----------
+    events : queue proxy
+        Shared queue on which the workers put their progress events (see send_event)
+    total : int
+        Number of queued sessions
+    interval : float
+        Interval in seconds between two progress lines (0: no progress lines)
+    status_file : str
+        Path of the JSON status file that is refreshed every interval (None: no status file)
+    metrics_port : int
+        Local port of the Prometheus endpoint (None: no endpoint)
+
+    Returns:
+    --------
+    stop : callable
+        Function that applies the remaining events, prints the final progress and stops the monitor
+    """
+    state = make_progress(total)
+    server = serve_metrics(state, metrics_port) if metrics_port else None
+    period = interval if interval > 0 else 60
+    done = threading.Event()
+
+    def report():
+        snapshot = progress_snapshot(state)
+        if interval > 0:
+            print(format_progress(snapshot))
+        if status_file is not None:
+            write_status(status_file, snapshot)
+
+    def monitor():
+        next_report = time.monotonic() + period
+        while True:
+            try:
+                event = events.get(timeout=max(0.0, next_report - time.monotonic()))
+                if event is None:
+                    break
+                apply_event(state, event)
+            except queue.Empty:
+                pass
+            if time.monotonic() >= next_report:
+                report()
+                next_report = time.monotonic() + period
+        report()
+        done.set()
+
+    threading.Thread(target=monitor, daemon=True).start()
+
+    def stop():
+        events.put(None)
+        done.wait()
+        if server is not None:
+            server.shutdown()
+    return stop
@@ -0,0 +1,145 @@
+import os
+import json
+import hashlib
+import datetime
+
+def getLstVersion():
+    """
+    This function returns the version of the installed LST-AI package (None if it cannot be determined).
+    """
+    try:
+        from importlib.metadata import version, PackageNotFoundError
+    except ImportError:
+        return None
+    try:
+        return version('LST-AI')
+    except PackageNotFoundError:
+        return None
+
+def sha256_file(path):
+    """
+    This function computes the SHA-256 hash of a file by reading it in chunks (streaming).
+
+    Parameters:
+    -----------
+    path : str
+        Path of the file
+
+    Returns:
+    --------
+    digest : str
+        Hexadecimal SHA-256 hash of the file content
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def input_fingerprint(t1w, flair, use_hash=False):
+    """
+    This function computes the fingerprint of the input images of a session.
+
+    Parameters:
+    -----------
+    t1w : str
+        Path of the T1w image
+    flair : str
+        Path of the FLAIR image
+    use_hash : bool
+        Boolean variable indicating if the SHA-256 hash of the images should be included (reads the complete files)
+
+    Returns:
+    --------
+    fingerprint : dict
+        Size, modification time (in ns) and optionally hash of the T1w and FLAIR images
+    """
+    fingerprint = {}
+    for name, path in (('t1w', t1w), ('flair', flair)):
+        st = os.stat(path)
+        fingerprint[name] = {'size': st.st_size, 'mtime': st.st_mtime_ns}
+        if use_hash:
+            fingerprint[name]['sha256'] = sha256_file(path)
+    return fingerprint
+
+def provenance_file(derivatives_dir, subID, sesID):
+    """
+    This function returns the path of the JSON sidecar of the lesion mask, in which the provenance of the segmentation is stored.
+    """
+    return os.path.join(derivatives_dir, f'sub-{subID}', f'ses-{sesID}', 'anat', f'sub-{subID}_ses-{sesID}_space-FLAIR_label-lesion_mask.json')
+
+def write_provenance(path, job, fingerprint, params):
+    """
+    This function writes the JSON sidecar of the lesion mask with the input fingerprint, the LST-AI version and the parameters.
+
+    Parameters:
+    -----------
+    path : str
+        Path of the JSON sidecar
+    job : dict
+        Session job
+    fingerprint : dict
+        Fingerprint of the input images (see input_fingerprint)
+    params : dict
+        LST-AI version and parameters that affect the segmentation (see lst_params)
+    """
+    sidecar = {'Sources': [job['t1w'], job['flair']],
+               'InputFingerprint': fingerprint,
+               'LST-AI': params,
+               'GeneratedOn': str(datetime.datetime.now())}
+    with open(path, 'w') as f:
+        json.dump(sidecar, f, indent=2)
+
+def lst_params(derivatives_dir, clipping):
+    """
+    This function collects the LST-AI version and the parameters that affect the segmentation.
+    """
+    return {'Version': getLstVersion(),
+            'Pipeline': os.path.basename(derivatives_dir),
+            'Clipping': [float(x) for x in clipping]}
+
+def needs_update(job, derivatives_dir, params, use_hash=False):
+    """
+    This function checks if the segmentation of a session is out of date, i.e., if the input images, the LST-AI version or the
+    parameters changed since the segmentation was generated.
+    Sessions without sidecar (generated by an earlier version of this pipeline) are considered out of date if the lesion mask
+    is older than one of the input images.
+
+    Parameters:
+    -----------
+    job : dict
+        Session job
+    derivatives_dir : str
+        Path of the LST-AI derivatives folder in the BIDS database
+    params : dict
+        Current LST-AI version and parameters (see lst_params)
+    use_hash : bool
+        Boolean variable indicating if the hashes of the images should be compared if size or modification time differ
+
+    Returns:
+    --------
+    changed : bool
+        True if the session should be processed again
+    """
+    sidecar_path = provenance_file(derivatives_dir, job['subID'], job['sesID'])
+    if not os.path.exists(sidecar_path):
+        mask = sidecar_path.replace('.json', '.nii.gz')
+        mask_mtime = os.stat(mask).st_mtime_ns
+        return any(os.stat(job[x]).st_mtime_ns > mask_mtime for x in ('t1w', 'flair'))
+
+    with open(sidecar_path) as f:
+        sidecar = json.load(f)
+    if sidecar.get('LST-AI') != params:
+        return True
+
+    current = input_fingerprint(job['t1w'], job['flair'])
+    for name in ('t1w', 'flair'):
+        stored = sidecar['InputFingerprint'][name]
+        if (stored['size'], stored['mtime']) == (current[name]['size'], current[name]['mtime']):
+            continue
+        # size or modification time changed: with hashes, only a changed content counts (e.g., files that were copied again)
+        if use_hash and ('sha256' in stored) and stored['size'] == current[name]['size']:
+            if sha256_file(job[name]) == stored['sha256']:
+                continue
+        return True
+    return False
@@ -0,0 +1,159 @@
+import os
+import json
+import datetime
+
+def get_available_resources():
+    """
+    This function reads the CPU cores and the memory that are available to the current process.
+
+    Returns:
+    --------
+    resources : dict
+        Dictionary with the number of usable cores ('cores') and the available memory in bytes ('memory')
+    """
+    # number of cores the process is allowed to run on (respects taskset/cgroup affinity)
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+
+    # available memory (MemAvailable accounts for reclaimable page cache)
+    memory = None
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    memory = int(line.split()[1]) * 1024
+                    break
+    except OSError:
+        pass
+    if memory is None:
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+    return {'cores': cores, 'memory': memory}
+
+def plan_layout(cores, memory, device_slots=None, threads=None, mem_per_job=None, mem_reserve=0.1):
+    """
+    This function chooses the number of workers and the number of threads per worker so that neither
+    the cores nor the memory of the machine are oversubscribed.
+    In GPU mode, one worker is started per device slot and the cores are shared between these workers.
+    In CPU mode, the number of workers follows from the number of threads per worker.
+    If the peak memory of a job is known (e.g., from a calibration run), the number of workers is capped
+    so that all concurrently running jobs fit into the available memory.
+
+    Parameters:
+    -----------
+    cores : int
+        Number of available CPU cores
+    memory : int
+        Available memory in bytes
+    device_slots : list
+        List of GPU device slots (e.g., ['0', '0', '1'] for two jobs on GPU 0 and one job on GPU 1); None for CPU-only processing
+    threads : int
+        Requested number of threads per worker in CPU mode (None: choose automatically)
+    mem_per_job : int
+        Peak memory of a single job in bytes (None: unknown, memory is not taken into account)
+    mem_reserve : float
+        Fraction of the available memory that is kept free
+
+    Returns:
+    --------
+    n_workers : int
+        Number of parallel workers
+    threads : int
+        Number of threads per worker
+    """
+    cores = max(1, cores)
+    if device_slots:
+        n_workers = min(len(device_slots), cores)
+    else:
+        if threads is None:
+            threads = min(8, cores)
+        n_workers = max(1, cores // max(1, threads))
+
+    # do not start more workers than fit into memory
+    if mem_per_job:
+        n_workers = max(1, min(n_workers, int(memory * (1 - mem_reserve) // mem_per_job)))
+
+    # share the cores between the workers
+    threads = max(1, cores // n_workers)
+    return n_workers, threads
+
+def calibrate(jobs, run_job, calibration_file=None):
+    """
+    This function runs a few jobs one after another and records the LST-AI runtime and the
+    peak memory (maximum resident set size) of the LST-AI child processes.
+    The results are written to a JSON file so that later runs can reuse them.
+
+    Parameters:
+    -----------
+    jobs : list
+        Session jobs that are used for the calibration (they are fully processed)
+    run_job : callable
+        Function that processes one job and returns its run log record (see process_lst_ai)
+    calibration_file : str
+        Path of the JSON file in which the calibration results are stored (None: do not store)
+
+    Returns:
+    --------
+    calibration : dict
+        Dictionary with the peak memory in bytes ('peak_rss'), the mean runtime of the processed jobs in seconds ('runtime')
+        and the results of the calibration jobs ('results')
+    """
+    results = [run_job(job) for job in jobs]
+    processed = [x for x in results if x['status'] == 'processed']
+    runtimes = [x['phases']['lst'] for x in processed]
+
+    # peak memory of the LST-AI child processes (measured with wait4, see telemetry.run_and_measure)
+    peak_rss = max([x['max_rss'] for x in processed if x['max_rss'] is not None], default=0)
+    calibration = {'peak_rss': peak_rss,
+                   'runtime': sum(runtimes) / len(runtimes) if runtimes else None,
+                   'sessions': len(runtimes),
+                   'date': str(datetime.datetime.now())}
+
+    if calibration_file is not None and runtimes:
+        with open(calibration_file, 'w') as f:
+            json.dump(calibration, f, indent=2)
+    calibration['results'] = results
+    return calibration
+
+def load_calibration(calibration_file):
+    """
+    This function loads the results of a previous calibration run.
+
+    Parameters:
+    -----------
+    calibration_file : str
+        Path of the JSON file written by calibrate
+
+    Returns:
+    --------
+    calibration : dict
+        Dictionary with the calibration results or None if no calibration is available
+    """
+    if not os.path.exists(calibration_file):
+        return None
+    with open(calibration_file) as f:
+        return json.load(f)
+
+def make_device_pool(manager, device_slots):
+    """
+    This function creates a token pool with one token per device slot. A worker takes a token before it
+    starts LST-AI and puts it back afterwards, so that no device slot is used by two jobs at the same time.
+
+    Parameters:
+    -----------
+    manager : multiprocessing.managers.SyncManager
+        Manager that owns the shared queue
+    device_slots : list
+        List of device slots (e.g., ['0', '1'] or ['cpu', 'cpu'])
+
+    Returns:
+    --------
+    pool : queue proxy
+        Shared queue that holds the free device tokens
+    """
+    pool = manager.Queue()
+    for slot in device_slots:
+        pool.put(slot)
+    return pool
@@ -2,142 +2,437 @@ import argparse
 import os
 import shutil
 import datetime
-import subprocess
+import time
+import queue
+import shlex
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 import multiprocessing
-from utils import getSessionID, getSubjectID, split_list, getfileList, availability_check
-
-def process_lst_ai(dirs, derivatives_dir, clipping, remove_temp=False, use_cpu=False, threads=8):
+from utils import DERIVATIVES, commitDirectory, getSessionOutputs, isSessionComplete, scanSessions, sortSessionJobs
+from bids_index import open_index, update_index
+from ledger import open_ledger, add_jobs, pending_jobs, mark_running, mark_finished, ledger_counts
+from provenance import getLstVersion, input_fingerprint, lst_params, needs_update, provenance_file, write_provenance
+from preproc_cache import cache_key, cache_lookup, cache_release, cache_store
+from sharding import write_manifest, load_manifest, parse_shard, select_shard, claim_lease, release_lease, lease_attempts, count_attempt, clear_attempts
+from engine import run_in_process
+from pipeline import prefetch_jobs, write_back, release_session, scratch_staging_dir
+from planner import session_voxels, plan_run, print_plan, write_plan
+from telemetry import run_and_measure, write_record, load_records
+from resources import get_available_resources, plan_layout, calibrate, load_calibration, make_device_pool
+from progress import send_event, start_progress
+from temp_store import compact_temp, folder_size, open_temp_store, register_temp, enforce_budget, temp_store_size, staging_size, disk_space, hold_back
+
+def process_lst_ai(job, derivatives_dir, clipping, remove_temp=False, use_cpu=False, threads=8, device_pool=None, ledger_file=None, cache_dir=None, cache_size=100*2**30, hash_inputs=False, lease_dir=None, lease_timeout=48*3600, max_attempts=None, engine=False, scratch_dir=None, temp_keep=None, temp_compress=False, timeout=None, max_memory=None, events=None):
     """
-    This function applies LST-AI lesion segmentation and also applies required pre-processing steps of the T1w and FLAIR images. 
+    This function applies LST-AI lesion segmentation to a single session and also applies required pre-processing steps of the T1w and FLAIR images. 
     Pre-processing includes skull-stripping and image registration. 
     We use the original T1w and FLAIR images as input.
-    Next, we check if SAMSEG segmentation was successful by making sure that the space-orig_seg-lst.nii.gz file was generated.
+    Next, we check if LST-AI segmentation was successful by making sure that the space-flair_seg-lst.nii.gz file was generated.
     All resulting files are saved to a temp folder and the segmentation files are save to anat folderin derivatives. 
     In order to be compliant with BIDS convention, we rename the output files. 
-    Optionally, the output folder can be deleted (e.g., to clean up if it is not needed anymore)
+    LST-AI writes into a staging folder, which is moved to the derivatives folder with a directory rename once all outputs are renamed, 
+    so that an interrupted run never leaves a half-renamed session behind. 
+    Optionally, the temp folder can be omitted (e.g., if it is not needed anymore)
 
     Parameters:
     -----------
-    dirs : list
-        List with all subject IDs for which we want to generate LST-AI lesion segmentations
+    job : dict
+        Session job as returned by discover (keys: 'subID', 'sesID', 't1w', 'flair'); jobs with 'force' set are processed even if the segmentation exists
     derivatives_dir : str
         Path of the LST-AI derivatives folder in the BIDS database
+    clipping : tuple
+        Lower and upper percentile for the standardization of image intensities
     remove_temp : bool
         Boolean variable indicating if the temp folder should be removed after segmentation files were generated
     use_cpu : bool
         Boolean variable indicating if CPU or GPU should be used for processing
+    threads : int
+        Number of threads that are passed to LST-AI
+    device_pool : queue proxy
+        Shared queue with free device slots (e.g., '0', '1' or 'cpu'); if provided, LST-AI runs on the device of the token taken from the pool
+    ledger_file : str
+        Path of the job ledger (see ledger.py) in which the state of the session is recorded (None: no ledger)
+    cache_dir : str
+        Path of the preprocessing cache (see preproc_cache.py); if provided, skull-stripped images of previous runs with identical inputs are reused (None: no cache)
+    cache_size : int
+        Maximum size of the preprocessing cache in bytes (least recently used entries are evicted)
+    hash_inputs : bool
+        Boolean variable indicating if the SHA-256 hashes of the input images are stored in the input fingerprint
+    lease_dir : str
+        Folder with the lease files of a multi-node run (see sharding.py); if provided, the session is only processed if its lease can be claimed
+    lease_timeout : float
+        Age in seconds after which the lease of another node is considered abandoned
+    max_attempts : int
+        Maximum number of attempts of the session on all nodes of a multi-node run with leases (None: no limit)
+    engine : bool
+        Boolean variable indicating if LST-AI runs inside the worker process (see engine.py) instead of a separate "lst" process
+    scratch_dir : str
+        Folder on a local scratch disk (see pipeline.py); if provided, the outputs are staged on the scratch disk and the record
+        contains the staging folder ('writeback') that still has to be written back to the derivatives folder
+    temp_keep : list
+        Glob patterns of the auxiliary files that are kept in the temp folder (None: all files are kept, see temp_store.compact_temp)
+    temp_compress : bool
+        Boolean variable indicating if uncompressed auxiliary images are re-encoded with gzip level 1
+    timeout : float
+        Wall time limit in seconds of LST-AI; the process group of LST-AI is killed when it is exceeded (None: no limit)
+    max_memory : int
+        Limit of the address space in bytes of LST-AI (None: no limit)
+    events : queue proxy
+        Shared queue to which the start and finish of the session are reported (see progress.py, None: no progress events)
     
     Returns:
     --------
-    None 
-        This function produces LST-AI lesion segmentation files
+    record : dict 
+        Run log record of the session with subject ID, session ID, status ('processed', 'skipped', 'failed'), elapsed time (in seconds), 
+        wall time per phase ('discovery', 'lst', 'rename', 'cleanup'), exit code, CPU time and peak memory of LST-AI, log file and 
+        its last lines, input image sizes, size of the kept temp folder and error message
     """
-    # iterate through all subject folders
-    for dir in dirs:
-
-        # assemble T1w file lists
-        # since we need T1w AND FLAIR images, we can first list all T1w images and then check if FLAIR image also exists
-        t1w = getfileList(path = dir, 
-                          suffix = '*T1w*')
-        t1w = [str(x) for x in t1w if (('.nii.gz' in str(x)) and 
-                                       (not 'GADOLINIUM' in str(x)))]
+    subID = job['subID']
+    sesID = job['sesID']
+    t1w = job['t1w']
+    flair = job['flair']
+
+    # record of this session for the run log
+    record = {'subID': subID, 'sesID': sesID, 'status': 'failed', 'start': time.time(), 'phases': {}, 
+              'returncode': None, 'cpu_user': None, 'cpu_system': None, 'max_rss': None, 'stderr_tail': [], 
+              'input_size': {}, 'error': None, 'pid': os.getpid(), 'prefetch': job.get('prefetch')}
+    t_start = time.perf_counter()
+    t_phase = t_start
+    leased = False
+    cache_lock = None
+    # staging folder of the session in the derivatives (outputs of a failed attempt are kept there until the next attempt)
+    derivatives_staging = os.path.join(derivatives_dir, '.staging', f'sub-{subID}_ses-{sesID}')
+
+    try:
+        # skip to next case if segmentation already exist (same completeness rule as the discovery; the session may have been
+        # finished by another run or node since the discovery)
+        seg_file, seg_file_annot = getSessionOutputs(derivatives_dir, subID, sesID)
+        if isSessionComplete(derivatives_dir, subID, sesID) and not job.get('force', False):
+            print(f'{datetime.datetime.now()} sub-{subID}_ses-{sesID}: LST-AI lesion segmentation already exists, skip and proceed to next case...')
+            record['status'] = 'skipped'
+            if ledger_file is not None:
+                mark_finished(ledger_file, job, 'done')
+            # (in a multi-node run, the staging folder may belong to another node until the lease is claimed)
+            if lease_dir is None:
+                shutil.rmtree(derivatives_staging, ignore_errors=True)
+            return record
+
+        # claim the session in a multi-node run (check again afterwards, another node may have just finished it)
+        # (a session claimed by another node stays queued in the ledger of this node, --resume checks it again)
+        if lease_dir is not None:
+            if not claim_lease(lease_dir, job, lease_timeout):
+                print(f'{datetime.datetime.now()} sub-{subID}_ses-{sesID}: claimed by another node, skip and proceed to next case...')
+                record['status'] = 'skipped'
+                return record
+            leased = True
+            if isSessionComplete(derivatives_dir, subID, sesID) and not job.get('force', False):
+                record['status'] = 'skipped'
+                if ledger_file is not None:
+                    mark_finished(ledger_file, job, 'done')
+                shutil.rmtree(derivatives_staging, ignore_errors=True)
+                return record
+            # the attempts of all nodes are counted next to the lease (the ledger of every node only counts its own attempts)
+            # (a session that reached the maximum is released again, a later run may allow more attempts)
+            attempts = lease_attempts(lease_dir, job)
+            if max_attempts is not None and attempts >= max_attempts:
+                print(f'{datetime.datetime.now()} sub-{subID}_ses-{sesID}: failed {attempts} time(s) on all nodes, skip and proceed to next case...')
+                release_lease(lease_dir, job)
+                leased = False
+                record['status'] = 'skipped'
+                return record
+            count_attempt(lease_dir, job)
+
+        if ledger_file is not None:
+            mark_running(ledger_file, job)
+        send_event(events, 'start', job, pid=os.getpid())
+
+        # check availability of files
+        if not os.path.exists(flair):
+            raise ValueError(f'sub-{subID}_ses-{sesID}: FLAIR image not available!!')
+        record['input_size'] = {'t1w': os.path.getsize(t1w), 'flair': os.path.getsize(flair)}
+        record['voxels'] = session_voxels(job)
+        # fingerprint of the inputs before LST-AI reads them (stored next to the lesion mask for incremental runs)
+        fingerprint = input_fingerprint(t1w, flair, use_hash=hash_inputs)
+
+        # LST-AI writes into a staging folder, which replaces the session folder in derivatives once all outputs are renamed
+        # (leftovers of an interrupted or failed attempt are removed first)
+        # (with a scratch disk, the staging folder is on the scratch disk and written back to the derivatives by the main process;
+        # it is removed when the slot of the session is released, also if the session failed)
+        if scratch_dir is not None:
+            staging_ses = scratch_staging_dir(scratch_dir, job)
+        else:
+            staging_ses = derivatives_staging
+        if os.path.exists(staging_ses):
+            shutil.rmtree(staging_ses)
+        staging_anat = os.path.join(staging_ses, 'anat')
+        staging_temp = os.path.join(staging_ses, 'temp')
+        Path(staging_anat).mkdir(parents=True, exist_ok=True)
+        Path(staging_temp).mkdir(parents=True, exist_ok=True)
+        record['phases']['discovery'], t_phase = time.perf_counter() - t_phase, time.perf_counter()
         
 
-        # get subject ID of current subject
-        subID = getSubjectID(path = t1w[0])
-
-
-        # iterate over all sessions with T1w images and check if FLAIR files are available and if lesion segmentation already exists
-        for i in range(len(t1w)):
-            try:
-
-                # get session ID of current T1w image
-                sesID = getSessionID(path = t1w[i])
-
-
-                # check availability of files and folders (create folders if necessary)
-                flair = str(t1w[i]).replace('_T1w.nii.gz', '_FLAIR.nii.gz')
-                if not os.path.exists(flair):
-                    raise ValueError(f'sub-{subID}_ses-{sesID}: FLAIR image not available!!')
-                
-                temp_dir = os.path.join(derivatives_dir, f'sub-{subID}', f'ses-{sesID}', 'temp')
-                if not os.path.exists(temp_dir):
-                    Path(temp_dir).mkdir(parents=True, exist_ok=True)
-                
-                deriv_ses = os.path.join(derivatives_dir, f'sub-{subID}', f'ses-{sesID}', 'anat')
-                if not os.path.exists(deriv_ses):
-                    Path(deriv_ses).mkdir(parents=True, exist_ok=True)
-                
-
-                # skip to next case if segmentation already exist
-                seg_file = os.path.join(deriv_ses, f'sub-{subID}_ses-{sesID}_space-FLAIR_label-lesion_mask.nii.gz')
-                seg_file_annot = os.path.join(deriv_ses, f'sub-{subID}_ses-{sesID}_space-FLAIR_desc-annotated_label-lesion_mask.nii.gz')
-                if os.path.exists(seg_file) and os.path.exists(seg_file_annot):
-                    print(f'{datetime.datetime.now()} sub-{subID}_ses-{sesID}: LST-AI lesion segmentation already exists, skip and proceed to next case...')
-                    continue
-                
-
-                # define command line for LST-AI
-                if remove_temp and use_cpu:
-                    command = f'lst --t1 {t1w[i]} --flair {flair} --output {deriv_ses} --device cpu --clipping {clipping[0]} {clipping[1]} --threads {threads}'
-                elif remove_temp:
-                    command = f'lst --t1 {t1w[i]} --flair {flair} --output {deriv_ses} --device 0 --clipping {clipping[0]} {clipping[1]} --threads {threads}'
-                elif use_cpu:
-                    command = f'lst --t1 {t1w[i]} --flair {flair} --output {deriv_ses} --temp {temp_dir} --device cpu --clipping {clipping[0]} {clipping[1]} --threads {threads}'
-                else:
-                    command = f'lst --t1 {t1w[i]} --flair {flair} --output {deriv_ses} --temp {temp_dir} --device 0 --clipping {clipping[0]} {clipping[1]} --threads {threads}'
-                print(command)
-                # run LST-AI
-                subprocess.run(command, shell=True)
-
-
-                # check if folder contains *seg-lst.nii.gz files, indicating that LST-AI successfully finished, and rename files
-                output_anat_files = os.listdir(deriv_ses)
-                les_vol_file = os.path.join(deriv_ses, f'sub-{subID}_ses-{sesID}_lesion_stats.csv')
-                les_vol_annot_file = os.path.join(deriv_ses, f'sub-{subID}_ses-{sesID}_annotated_lesion_stats.csv')
-
-                if ('space-flair_seg-lst.nii.gz' in output_anat_files) and ('space-flair_desc-annotated_seg-lst.nii.gz' in output_anat_files):
-                    
-                    print(f'{datetime.datetime.now()} sub-{subID}_ses-{sesID}: Rename LST-AI lesion mask (BIDS)...')
-                    os.rename(os.path.join(deriv_ses,'space-flair_seg-lst.nii.gz'), seg_file)
-                    os.rename(os.path.join(deriv_ses,'space-flair_desc-annotated_seg-lst.nii.gz'), seg_file_annot)
-                    os.rename(os.path.join(deriv_ses,'lesion_stats.csv'), les_vol_file)
-                    os.rename(os.path.join(deriv_ses,'annotated_lesion_stats.csv'), les_vol_annot_file)
-                    if os.path.exists(seg_file) and os.path.exists(seg_file_annot):
-                        print(f'{datetime.datetime.now()} sub-{subID}_ses-{sesID}: Rename LST-AI lesion mask (BIDS) DONE!')
-
-                    # also rename auxiliary files if they are available
-                    output_temp_files = os.listdir(temp_dir)
-                    if (len(output_temp_files)>0):
-                        print(f'{datetime.datetime.now()} sub-{subID}_ses-{sesID}: Rename LST-AI auxiliary files (BIDS)...')
-                        # iterate over all output files and rename to BIDS
-                        for filename in output_temp_files:
-                            if ('sub-X_ses-Y' in filename):
-                                os.rename(os.path.join(temp_dir, filename), os.path.join(temp_dir, str(filename).replace('sub-X_ses-Y', f'sub-{subID}_ses-{sesID}')))
-                            else:
-                                os.rename(os.path.join(temp_dir, filename), os.path.join(temp_dir, f'sub-{subID}_ses-{sesID}_{filename}'))
-                        print(f'{datetime.datetime.now()} sub-{subID}_ses-{sesID}: Rename LST-AI auxiliary files (BIDS) DONE!')
-                else:
-                    print(f'{datetime.datetime.now()} sub-{subID}_ses-{sesID}: failed to generate segmentation, delete ouput folder...')
-                    shutil.rmtree(str(Path(deriv_ses).parent))
-                    if os.path.exists(deriv_ses) or os.path.exists(temp_dir):
-                        raise ValueError(f'{datetime.datetime.now()} sub-{subID}_ses-{sesID}: failed to delete the derivatives folder(s)!')
+        # reuse the skull-stripped images of a previous run with the same inputs (content-addressed preprocessing cache)
+        # (inputs that were prefetched to the scratch disk are read from there)
+        t1w_input, flair_input, stripped = job.get('t1w_local', t1w), job.get('flair_local', flair), False
+        if cache_dir is not None:
+            # (the skull-stripping depends on the input images and the LST-AI version, not on the clipping or the derivatives folder;
+            # without a known version, the name of the derivatives folder stands in for it; the entry is locked until LST-AI has read it)
+            version = getLstVersion()
+            key = cache_key(t1w, flair, {'step': 'skull-stripping', 'version': version if version is not None else os.path.basename(derivatives_dir)}, cache_dir)
+            cached, cache_lock = cache_lookup(cache_dir, key)
+            if cached is not None:
+                t1w_input, flair_input, stripped = cached['t1w'], cached['flair'], True
+            record['cache'] = 'hit' if stripped else 'miss'
+
+        # take a free device slot from the token pool (if the scheduler provides one)
+        if device_pool is not None:
+            device = device_pool.get()
+        elif use_cpu:
+            device = 'cpu'
+        else:
+            device = '0'
+        record['device'] = device
+        record['threads'] = threads
+
+        try:
+            # define command line arguments for LST-AI
+            lst_args = ['--t1', t1w_input, '--flair', flair_input, '--output', staging_anat]
+            if stripped:
+                lst_args += ['--stripped']
+            # (the temp folder is also needed to fill the cache)
+            if (not remove_temp) or (cache_dir is not None and not stripped):
+                lst_args += ['--temp', staging_temp]
+            lst_args += ['--device', device, '--clipping', str(clipping[0]), str(clipping[1]), '--threads', str(threads)]
+            print(shlex.join(['lst'] + lst_args))
+            # run LST-AI (in this worker process or as separate process) and measure exit code, CPU time and peak memory
+            # (the output of the separate process is written to the log file of the session)
+            if engine:
+                record.update(run_in_process(lst_args))
+            else:
+                Path(derivatives_dir, 'logs').mkdir(exist_ok=True)
+                record['log'] = os.path.join(derivatives_dir, 'logs', f'sub-{subID}_ses-{sesID}_lst-ai.log')
+                record.update(run_and_measure(['lst'] + lst_args, log_file=record['log'], timeout=timeout, max_memory=max_memory))
+        finally:
+            if device_pool is not None:
+                device_pool.put(device)
+            cache_release(cache_lock)
+            cache_lock = None
+        record['phases']['lst'], t_phase = time.perf_counter() - t_phase, time.perf_counter()
+        if record.get('timed_out'):
+            raise TimeoutError(f'LST-AI was stopped after {timeout:.0f} s{", outputs are kept in " + staging_ses if scratch_dir is None else ""}')
+
+
+        # check if folder contains *seg-lst.nii.gz files, indicating that LST-AI successfully finished, and rename files
+        output_anat_files = os.listdir(staging_anat)
+
+        if (record['returncode'] == 0) and ('space-flair_seg-lst.nii.gz' in output_anat_files) and ('space-flair_desc-annotated_seg-lst.nii.gz' in output_anat_files):
+            
+            print(f'{datetime.datetime.now()} sub-{subID}_ses-{sesID}: Rename LST-AI lesion mask (BIDS)...')
+            os.rename(os.path.join(staging_anat,'space-flair_seg-lst.nii.gz'), os.path.join(staging_anat, os.path.basename(seg_file)))
+            os.rename(os.path.join(staging_anat,'space-flair_desc-annotated_seg-lst.nii.gz'), os.path.join(staging_anat, os.path.basename(seg_file_annot)))
+            os.rename(os.path.join(staging_anat,'lesion_stats.csv'), os.path.join(staging_anat, f'sub-{subID}_ses-{sesID}_lesion_stats.csv'))
+            os.rename(os.path.join(staging_anat,'annotated_lesion_stats.csv'), os.path.join(staging_anat, f'sub-{subID}_ses-{sesID}_annotated_lesion_stats.csv'))
+
+            # store input fingerprint, LST-AI version and parameters in the JSON sidecar of the lesion mask
+            write_provenance(os.path.join(staging_anat, os.path.basename(provenance_file(derivatives_dir, subID, sesID))), 
+                             job, fingerprint, lst_params(derivatives_dir, clipping))
+            record['phases']['rename'], t_phase = time.perf_counter() - t_phase, time.perf_counter()
+
+            # store the skull-stripped images in the cache and remove the temp folder if it is not kept
+            if cache_dir is not None and not stripped:
+                cache_store(cache_dir, key, staging_temp, cache_size)
+            if remove_temp:
+                shutil.rmtree(staging_temp)
+                Path(staging_temp).mkdir()
+
+            # also rename auxiliary files if they are available
+            output_temp_files = os.listdir(staging_temp)
+            if (len(output_temp_files)>0):
+                print(f'{datetime.datetime.now()} sub-{subID}_ses-{sesID}: Rename LST-AI auxiliary files (BIDS)...')
+                # iterate over all output files and rename to BIDS
+                for filename in output_temp_files:
+                    if ('sub-X_ses-Y' in filename):
+                        os.rename(os.path.join(staging_temp, filename), os.path.join(staging_temp, str(filename).replace('sub-X_ses-Y', f'sub-{subID}_ses-{sesID}')))
                     else:
-                        print(f'{datetime.datetime.now()} sub-{subID}_ses-{sesID}: successfully deleted the derivatives folder(s)!')
-                        continue
+                        os.rename(os.path.join(staging_temp, filename), os.path.join(staging_temp, f'sub-{subID}_ses-{sesID}_{filename}'))
+                print(f'{datetime.datetime.now()} sub-{subID}_ses-{sesID}: Rename LST-AI auxiliary files (BIDS) DONE!')
+                # keep only the selected auxiliary files and compress the uncompressed images
+                if temp_keep is not None or temp_compress:
+                    size, compacted = compact_temp(staging_temp, keep=temp_keep, compress=temp_compress)
+                    print(f'{datetime.datetime.now()} sub-{subID}_ses-{sesID}: Auxiliary files compacted ({size/2**20:.1f} MB -> {compacted/2**20:.1f} MB)')
+            if len(os.listdir(staging_temp)) > 0:
+                record['temp_size'] = folder_size(staging_temp)
+            else:
+                os.rmdir(staging_temp)
+            record['phases']['cleanup'], t_phase = time.perf_counter() - t_phase, time.perf_counter()
+
+            # commit the session folder with an atomic directory rename (or leave it to the write-back stage)
+            if scratch_dir is not None:
+                record['writeback'] = staging_ses
+                seg_file = os.path.join(staging_anat, os.path.basename(seg_file))
+                seg_file_annot = os.path.join(staging_anat, os.path.basename(seg_file_annot))
+            else:
+                commitDirectory(staging_ses, os.path.join(derivatives_dir, f'sub-{subID}', f'ses-{sesID}'))
+            if os.path.exists(seg_file) and os.path.exists(seg_file_annot):
+                print(f'{datetime.datetime.now()} sub-{subID}_ses-{sesID}: Rename LST-AI lesion mask (BIDS) DONE!')
+                record['status'] = 'processed'
+            # (the commit of the session folder is part of the rename phase)
+            record['phases']['rename'] += time.perf_counter() - t_phase
+        else:
+            # the derivatives folder of the session is left untouched, the staging folder is kept for inspection until the next attempt
+            print(f'{datetime.datetime.now()} sub-{subID}_ses-{sesID}: failed to generate segmentation (exit code {record["returncode"]}{", log: " + record["log"] if "log" in record else ""}){", outputs are kept in " + staging_ses if scratch_dir is None else ""}')
+
+    except Exception as e:
+        record['error'] = f'{type(e).__name__}: {e}'
+        print(f'{datetime.datetime.now()} sub-{subID}_ses-{sesID}: Error occured during processing ({record["error"]}), proceeding with next case.')
+
+    finally:
+        cache_release(cache_lock)
+        record['end'] = time.time()
+        record['elapsed'] = time.perf_counter() - t_start
+        if ledger_file is not None and record['status'] != 'skipped' and 'writeback' not in record:
+            mark_finished(ledger_file, job, 'done' if record['status'] == 'processed' else 'failed', record['error'])
+        # release the lease of a failed session, so that it can be retried (finished sessions keep their lease)
+        if leased and record['status'] == 'failed':
+            release_lease(lease_dir, job)
+        elif leased and record['status'] == 'processed':
+            clear_attempts(lease_dir, job)
+        send_event(events, 'finish', job, 'writeback' if 'writeback' in record else record['status'], pid=os.getpid())
+
+    return record
+
+def discover(input_path, derivatives=DERIVATIVES, use_index=True, job_order='oldest', incremental=False, clipping=(0.5, 99.5), hash_inputs=False, threads=16):
+    """
+    This function finds the sessions of a BIDS database that have to be segmented by LST-AI.
 
-            except:
-                print(f'{datetime.datetime.now()} sub-{subID}_ses-{sesID}: Error occured during processing, proceeding with next case.')
-            
-if __name__ == "__main__":
+    Parameters:
+    -----------
+    input_path : str
+        Folder of BIDS database
+    derivatives : str
+        Name of the LST-AI derivatives folder (e.g., lst-ai-v1.1.0)
+    use_index : bool
+        Boolean variable indicating if the cached BIDS index is used (False: walk the filesystem)
+    job_order : str
+        Order of the jobs: "oldest", "cheapest" or "bids" (see utils.sortSessionJobs)
+    incremental : bool
+        Boolean variable indicating if segmented sessions with changed inputs or parameters are included (see provenance.needs_update)
+    clipping : tuple
+        Clipping for standardization of image intensities (compared with the parameters of existing segmentations in incremental mode)
+    hash_inputs : bool
+        Boolean variable indicating if the hashes of the input images are compared in incremental mode
+    threads : int
+        Number of threads that scan the subject folders (or refresh the BIDS index)
+
+    Returns:
+    --------
+    jobs : list
+        Session jobs with subject ID ('subID'), session ID ('sesID'), paths of the images ('t1w', 'flair'), their total size ('size')
+        and newest modification time ('mtime') and, in incremental mode, 'force' for segmented sessions that have to be processed again
+    """
+    input_path = os.path.abspath(input_path)
+    derivatives_dir = os.path.join(input_path, 'derivatives', derivatives)
+    Path(derivatives_dir).mkdir(parents=True, exist_ok=True)
+
+    # refresh the cached BIDS index (only folders that changed since the last run are listed again)
+    index = None
+    if use_index:
+        index = open_index(os.path.join(derivatives_dir, 'lst-ai_index.sqlite'))
+        update_index(index, [input_path, derivatives_dir], threads=threads)
+
+    # scan all sessions once (subjects in parallel) and apply one completeness rule (lesion mask and annotated lesion mask exist)
+    t_start = time.perf_counter()
+    sessions, errors = scanSessions(input_path, derivatives_dir, threads=threads, index=index)
+    for sub_dir, error in errors.items():
+        print(f'{os.path.basename(sub_dir)}: discovery failed ({error}), skip subject.')
+    for x in sessions:
+        if len(x['extra_t1w']) > 0:
+            print(f'sub-{x["subID"]}_ses-{x["sesID"]}: {len(x["extra_t1w"])} additional T1w image(s) not processed ({", ".join(os.path.basename(t) for t in x["extra_t1w"])}), using {os.path.basename(x["t1w"])}.')
+    complete = [x for x in sessions if x['complete']]
+    missing = [x for x in sessions if not x['complete']]
+    print(f'Discovery: {len(sessions)} session(s) of {len(set(x["subID"] for x in sessions))} subject(s) in {time.perf_counter() - t_start:.1f} s')
+    print(f'Number of complete sessions: {len(complete)}')
+    print(f'Number of incomplete sessions: {len(missing)} (FLAIR not available: {sum(not x["flair_available"] for x in missing)})')
+
+    # the jobs are all incomplete sessions with T1w and FLAIR image
+    # (in incremental mode, the complete sessions are checked for changed inputs or parameters as well)
+    jobs = [x for x in missing if x['flair_available']]
+    if incremental:
+        params = lst_params(derivatives_dir, clipping)
+        jobs_changed = [x for x in complete if x['flair_available'] and needs_update(x, derivatives_dir, params, use_hash=hash_inputs)]
+        for job in jobs_changed:
+            job['force'] = True
+        print(f'Number of sessions with changed inputs or parameters: {len(jobs_changed)}')
+        jobs += jobs_changed
+
+    # only the fields of the job are passed on (manifest, ledger, workers)
+    jobs = [{key: job[key] for key in ('subID', 'sesID', 't1w', 'flair', 'size', 'mtime', 'force') if key in job} for job in jobs]
+    sortSessionJobs(jobs, job_order)
+    if index is not None:
+        index.close()
+    return jobs
+
+def make_plan(args, jobs, derivatives_dir, run_log):
+    """
+    This function predicts the makespan of the queued sessions for the requested layout (-n/--threads or --auto_resources)
+    and for the candidate layouts of this machine (see planner.plan_run). The cost model is fitted to the run logs in the derivatives folder.
 
-    parser = argparse.ArgumentParser(description='Run LST-AI Pipeline on cohort.')
+    Parameters:
+    -----------
+    args : argparse.Namespace
+        Arguments of run_lst_ai.py
+    jobs : list
+        Queued session jobs
+    derivatives_dir : str
+        Path of the LST-AI derivatives folder in the BIDS database
+    run_log : str
+        Path of the run log of this run
+
+    Returns:
+    --------
+    plan : dict
+        Plan as returned by planner.plan_run
+    """
+    available = get_available_resources()
+    devices = None if args.cpu else args.devices
+    if args.auto_resources:
+        device_slots = None if args.cpu else [d for d in args.devices for _ in range(args.jobs_per_device)]
+        n_workers, threads = plan_layout(cores=available['cores'], memory=available['memory'], device_slots=device_slots, threads=args.threads)
+        jobs_per_device = 1 if args.cpu else -(-n_workers // len(args.devices))
+    else:
+        # (without --auto_resources, all workers share GPU 0)
+        n_workers, threads = max(1, args.number_of_workers), args.threads
+        jobs_per_device = 1 if args.cpu else n_workers
+    requested = {'mode': 'cpu' if args.cpu else 'gpu', 'n_workers': n_workers, 'threads': threads, 'jobs_per_device': jobs_per_device}
+
+    # runtimes and peak memory of previous runs (all run logs of the derivatives folder)
+    log_files = sorted(str(x) for x in Path(derivatives_dir).glob('lst-ai_runlog*.jsonl'))
+    if os.path.exists(run_log) and run_log not in log_files:
+        log_files.append(run_log)
+    calibration = load_calibration(os.path.join(derivatives_dir, 'lst-ai_calibration.json'))
+    mem_per_job = int(1.2 * calibration['peak_rss']) if calibration is not None and calibration.get('peak_rss') else None
+
+    return plan_run(jobs, derivatives_dir, load_records(log_files), requested, available['cores'], available['memory'], 
+                    devices=devices, mem_per_job=mem_per_job)
+
+def build_parser(parser=None):
+    """
+    This function adds the command line arguments of run_lst_ai.py to a (sub)parser.
+    """
+    if parser is None:
+        parser = argparse.ArgumentParser(description='Run LST-AI Pipeline on cohort.')
 
     parser.add_argument('-i', '--input_directory', 
                         help='Folder of derivatives in BIDS database.', 
                         required=True)
 
+    parser.add_argument('--derivatives',
+                        help=f'Name of the LST-AI derivatives folder (default: {DERIVATIVES}).',
+                        default=DERIVATIVES)
+
     parser.add_argument('-n', '--number_of_workers', 
                         help='Number of parallel processing cores.', 
                         type=int, 
@@ -162,10 +457,173 @@ if __name__ == "__main__":
                         nargs='+',
                         type=float,
                         default=(0.5, 99.5))
-    
-    # read the arguments
-    args = parser.parse_args()
 
+    parser.add_argument('--plan',
+                        help='Use the --plan flag to list the sessions that would be processed and to predict the makespan of the requested and the candidate worker layouts (from NIfTI headers and previous run logs) without running LST-AI.',
+                        action='store_true')
+
+    parser.add_argument('--discovery_threads',
+                        help='Number of threads that scan the subject folders (or refresh the BIDS index) during the discovery (default: 16).',
+                        type=int,
+                        default=16)
+
+    parser.add_argument('--job_order',
+                        help='Order in which sessions are queued: "oldest" (input images with the oldest modification time first), "cheapest" (smallest input images first) or "bids" (sorted by subject and session ID).',
+                        choices=['oldest', 'cheapest', 'bids'],
+                        default='oldest')
+
+    parser.add_argument('--auto_resources',
+                        help='Use the --auto_resources flag to choose the number of workers and threads from the available cores, memory and device slots (overrides -n).',
+                        action='store_true')
+
+    parser.add_argument('--devices',
+                        help='GPU devices that are used in --auto_resources mode (default: 0).',
+                        nargs='+',
+                        default=['0'])
+
+    parser.add_argument('--jobs_per_device',
+                        help='Number of concurrent LST-AI jobs per GPU device in --auto_resources mode (default: 1).',
+                        type=int,
+                        default=1)
+
+    parser.add_argument('--calibrate',
+                        help='Number of sessions that are processed one after another before the parallel run to measure peak memory and runtime in --auto_resources mode (default: 0, reuse a previous calibration if available).',
+                        type=int,
+                        default=0)
+
+    parser.add_argument('--no_index',
+                        help='Use the --no_index flag to walk the filesystem instead of using the cached BIDS index (lst-ai_index.sqlite in the derivatives folder).',
+                        action='store_true')
+
+    parser.add_argument('--run_log',
+                        help='JSON-lines file to which one record per session (timing, peak memory, exit status) is appended (default: lst-ai_runlog.jsonl in the derivatives folder).',
+                        default=None)
+
+    parser.add_argument('--resume',
+                        help='Use the --resume flag to continue the unfinished sessions of the job ledger (lst-ai_ledger.sqlite in the derivatives folder) without a new discovery.',
+                        action='store_true')
+
+    parser.add_argument('--max_attempts',
+                        help='Maximum number of attempts per session before it is no longer retried; with --lease, the attempts of all nodes are counted (default: 3).',
+                        type=int,
+                        default=3)
+
+    parser.add_argument('--cache_dir',
+                        help='Folder of the preprocessing cache. If provided, the skull-stripped images are cached (keyed on the input image hashes) and reused in later runs, e.g. for --clipping sweeps (default: no cache).',
+                        default=None)
+
+    parser.add_argument('--cache_size',
+                        help='Maximum size of the preprocessing cache in GB; least recently used entries are evicted (default: 100).',
+                        type=float,
+                        default=100)
+
+    parser.add_argument('--incremental',
+                        help='Use the --incremental flag to also process sessions whose input images, LST-AI version or parameters changed since their segmentation was generated.',
+                        action='store_true')
+
+    parser.add_argument('--hash_inputs',
+                        help='Use the --hash_inputs flag to store SHA-256 hashes of the input images, so that --incremental ignores files whose modification time changed but whose content did not.',
+                        action='store_true')
+
+    parser.add_argument('--write_manifest',
+                        help='Only run the discovery and write the session jobs to this manifest file for a multi-node run.',
+                        default=None)
+
+    parser.add_argument('--manifest',
+                        help='Process the session jobs of this manifest (written with --write_manifest) instead of running the discovery.',
+                        default=None)
+
+    parser.add_argument('--shard',
+                        help='Shard "k/N" (0 <= k < N) of the manifest that is processed by this node (default: derived from SLURM_ARRAY_TASK_ID/SLURM_ARRAY_TASK_COUNT if available).',
+                        default=None)
+
+    parser.add_argument('--lease',
+                        help='Use the --lease flag to let all nodes claim sessions of the whole manifest with lease files in the derivatives folder instead of static shards.',
+                        action='store_true')
+
+    parser.add_argument('--lease_timeout',
+                        help='Age in hours after which the lease of a session is considered abandoned (e.g., by a crashed node) (default: 48).',
+                        type=float,
+                        default=48)
+
+    parser.add_argument('--engine',
+                        help='Use the --engine flag to run LST-AI inside the worker processes (imported once per worker, models stay loaded) instead of starting one "lst" process per session.',
+                        action='store_true')
+
+    parser.add_argument('--scratch_dir',
+                        help='Folder on a local scratch disk. If provided, the inputs of the next sessions are prefetched to it while the previous sessions are segmented, and the outputs are written back to the derivatives folder in the background (default: no scratch disk).',
+                        default=None)
+
+    parser.add_argument('--prefetch_depth',
+                        help='Number of sessions that are prefetched ahead of the workers (default: 2).',
+                        type=int,
+                        default=2)
+
+    parser.add_argument('--prefetch_decompress',
+                        help='Use the --prefetch_decompress flag to store the prefetched images uncompressed (.nii) on the scratch disk.',
+                        action='store_true')
+
+    parser.add_argument('--temp_keep',
+                        help='Glob patterns of the auxiliary files that are kept in the temp folder, e.g. "*desc-stripped*" (default: all files are kept).',
+                        nargs='+',
+                        default=None)
+
+    parser.add_argument('--temp_compress',
+                        help='Use the --temp_compress flag to re-encode uncompressed auxiliary images (.nii) in the temp folder with gzip level 1.',
+                        action='store_true')
+
+    parser.add_argument('--temp_budget',
+                        help='Maximum total size in GB of the temp folders in the derivatives folder; the oldest temp folders are removed when it is exceeded (default: no limit).',
+                        type=float,
+                        default=None)
+
+    parser.add_argument('--min_free_space',
+                        help='Minimum free space in GB on the filesystems of the derivatives folder and the scratch disk; new sessions are held back while the free space is lower (default: no limit).',
+                        type=float,
+                        default=None)
+
+    parser.add_argument('--timeout',
+                        help='Wall time limit in minutes per session; LST-AI and all of its child processes are killed when it is exceeded (not with --engine, default: no limit).',
+                        type=float,
+                        default=None)
+
+    parser.add_argument('--max_memory',
+                        help='Limit of the address space (virtual memory) in GB of every LST-AI process; GPU runs reserve a large address space and need a generous limit (not with --engine, default: no limit).',
+                        type=float,
+                        default=None)
+
+    parser.add_argument('--progress_interval',
+                        help='Interval in seconds between two progress lines with the done/failed/running sessions, throughput, ETA and worker utilization (default: 60, 0: no progress lines).',
+                        type=float,
+                        default=60)
+
+    parser.add_argument('--status_file',
+                        help='JSON file to which the progress is written every --progress_interval seconds (default: no status file).',
+                        default=None)
+
+    parser.add_argument('--metrics_port',
+                        help='Local port on which the progress is served in the text format of Prometheus (http://127.0.0.1:PORT/metrics, default: no endpoint).',
+                        type=int,
+                        default=None)
+
+    parser.set_defaults(func=main)
+    return parser
+
+def run(args):
+    """
+    This function runs the LST-AI pipeline with the command line arguments of run_lst_ai.py (see build_parser):
+    discovery (or manifest/ledger), resource planning and the parallel segmentation of all queued sessions.
+
+    Parameters:
+    -----------
+    args : argparse.Namespace
+        Arguments as returned by build_parser().parse_args()
+
+    Returns:
+    --------
+    results : list
+        Run log records of the processed sessions (see process_lst_ai), or the plan in --plan mode (see planner.plan_run)
+    """
     if args.cpu:
         use_cpu = True
     else:
@@ -176,41 +634,292 @@ if __name__ == "__main__":
     else:
         remove_temp = False
     
-    input_path = args.input_directory
+    input_path = os.path.abspath(args.input_directory)
     n_workers = args.number_of_workers
 
+    # the limits are enforced on the separate "lst" process, LST-AI inside the worker processes cannot be limited
+    if args.engine and (args.timeout is not None or args.max_memory is not None):
+        raise ValueError('--timeout and --max_memory cannot be combined with --engine')
+
 
     # generate derivatives
-    derivatives_dir = os.path.join(input_path, "derivatives/lst-ai-v1.1.0")
+    derivatives_dir = os.path.join(input_path, 'derivatives', args.derivatives)
     if not os.path.exists(derivatives_dir):
         Path(derivatives_dir).mkdir(parents=True, exist_ok=True)
 
     
-    # generate list with subject folders for multiprocessing
-    data_root = Path(os.path.join(input_path))
-    dirs = sorted(list(data_root.glob('*')))
-    dirs = [str(x) for x in dirs]
-    dirs = [x for x in dirs if "sub-" in x]
-
-    # check which files have already been processed
-    dirs_missing, dirs_processed = availability_check(sub_dirs=dirs,
-                                                      deriv_dir=derivatives_dir,
-                                                      file_suffix='space-FLAIR_label-lesion_mask.nii.gz')
-    print(f'Number of incomplete subjects: {len(dirs_missing)}')
-    print(f'Number of complete subjects: {len(dirs_processed)}')
-
-    # only split the list of subjects with missing LST-AI lesion segmentation for multiprocessing
-    files = split_list(alist = dirs_missing, 
-                       splits = n_workers)
-
-
-    # initialize multithreading
-    pool = multiprocessing.Pool(processes=n_workers)
-    # call samseg processing function in multiprocessing setting
-    for x in range(0, n_workers):
-        pool.apply_async(process_lst_ai, args=(files[x], derivatives_dir, args.clipping, remove_temp, use_cpu, args.threads))
-
-    pool.close()
-    pool.join()
-
-    print('DONE!')
\ No newline at end of file
+    # shard of this node in a multi-node run; every node keeps its own ledger and run log (merge with telemetry.py --merge)
+    shard = parse_shard(args.shard) if args.manifest else None
+    if shard is not None:
+        node_suffix = f'.shard-{shard[0]}'
+    elif args.manifest and args.lease:
+        node_suffix = f'.{socket.gethostname()}-{os.getpid()}'
+    else:
+        node_suffix = ''
+
+    # job ledger with the state of every session (queued/running/done/failed)
+    ledger_file = os.path.join(derivatives_dir, f'lst-ai_ledger{node_suffix}.sqlite')
+    open_ledger(ledger_file)
+
+    lease_dir = None
+    if args.manifest:
+        # multi-node run: process the jobs of this shard of the manifest (or claim sessions of the whole manifest with leases)
+        manifest = load_manifest(args.manifest)
+        jobs = manifest['jobs']
+        if args.lease:
+            lease_dir = os.path.join(derivatives_dir, '.leases', manifest['id'])
+            if shard is not None:
+                # start at a different position on every node to avoid contention on the same leases
+                offset = shard[0] * len(jobs) // shard[1]
+                jobs = jobs[offset:] + jobs[:offset]
+        elif shard is not None:
+            jobs = select_shard(jobs, shard[0], shard[1])
+        print(f'Manifest {manifest["id"]}: {len(manifest["jobs"])} session(s), shard {shard if shard else "-"}, leases: {args.lease}')
+        if not args.plan:
+            add_jobs(ledger_file, jobs)
+        jobs = pending_jobs(ledger_file, args.max_attempts, jobs)
+    else:
+        # resume the unfinished jobs of a previous run without repeating the discovery
+        jobs = pending_jobs(ledger_file, args.max_attempts) if args.resume else []
+        if len(jobs) > 0:
+            print(f'Resume {len(jobs)} unfinished session(s) from the job ledger.')
+        else:
+            jobs = discover(input_path, 
+                            derivatives=args.derivatives, 
+                            use_index=not args.no_index, 
+                            job_order=args.job_order, 
+                            incremental=args.incremental, 
+                            clipping=args.clipping, 
+                            hash_inputs=args.hash_inputs, 
+                            threads=args.discovery_threads)
+
+            # only write the job list for a multi-node run (see --manifest)
+            if args.write_manifest:
+                write_manifest(args.write_manifest, jobs, derivatives_dir)
+                print(f'Manifest with {len(jobs)} session(s) written to {args.write_manifest}')
+                return []
+
+            # register the jobs in the ledger (not in a dry run) and drop sessions that failed too often
+            if not args.plan:
+                add_jobs(ledger_file, jobs)
+            jobs = pending_jobs(ledger_file, args.max_attempts, jobs)
+    print(f'Number of queued sessions: {len(jobs)}')
+    if len(jobs) == 0:
+        print('DONE!')
+        return []
+
+    # run log with one record per session
+    run_log = args.run_log if args.run_log else os.path.join(derivatives_dir, f'lst-ai_runlog{node_suffix}.jsonl')
+
+    # dry run: estimate the cost of the queued sessions and predict the makespan of the layouts without running LST-AI
+    if args.plan:
+        plan = make_plan(args, jobs, derivatives_dir, run_log)
+        print_plan(plan)
+        write_plan(plan, os.path.join(derivatives_dir, f'lst-ai_plan{node_suffix}.json'))
+        return plan
+
+    # limits of every LST-AI process
+    timeout = args.timeout*60 if args.timeout is not None else None
+    max_memory = int(args.max_memory*2**30) if args.max_memory is not None else None
+
+    if args.cache_dir and getLstVersion() is None:
+        print('Warning: the LST-AI version cannot be determined, cached skull-stripped images are keyed on the derivatives folder and not invalidated when LST-AI is upgraded.')
+
+    # plan the worker x thread layout from the available resources
+    threads = args.threads
+    device_pool = None
+    manager = None
+    calibrated, t_calibration = [], 0.0
+    if args.auto_resources:
+        available = get_available_resources()
+        device_slots = None if use_cpu else [d for d in args.devices for _ in range(args.jobs_per_device)]
+        n_workers, threads = plan_layout(cores=available['cores'], 
+                                         memory=available['memory'], 
+                                         device_slots=device_slots, 
+                                         threads=args.threads)
+
+        # run (or load) the calibration to learn the peak memory of one job
+        calibration_file = os.path.join(derivatives_dir, 'lst-ai_calibration.json')
+        if args.calibrate > 0:
+            print(f'{datetime.datetime.now()} Calibrate on {min(args.calibrate, len(jobs))} session(s)...')
+            t_calibration = time.perf_counter()
+            calibration_pool = queue.Queue()
+            calibration_pool.put('cpu' if use_cpu else device_slots[0])
+            calibration = calibrate(jobs=jobs[:args.calibrate], 
+                                    run_job=partial(process_lst_ai, 
+                                                    derivatives_dir=derivatives_dir, 
+                                                    clipping=args.clipping, 
+                                                    remove_temp=remove_temp, 
+                                                    use_cpu=use_cpu, 
+                                                    threads=threads, 
+                                                    device_pool=calibration_pool, 
+                                                    ledger_file=ledger_file, 
+                                                    cache_dir=args.cache_dir, 
+                                                    cache_size=int(args.cache_size*2**30), 
+                                                    hash_inputs=args.hash_inputs, 
+                                                    lease_dir=lease_dir, 
+                                                    lease_timeout=args.lease_timeout*3600, 
+                                                    max_attempts=args.max_attempts, 
+                                                    temp_keep=args.temp_keep, 
+                                                    temp_compress=args.temp_compress, 
+                                                    timeout=timeout, 
+                                                    max_memory=max_memory),
+                                    calibration_file=calibration_file)
+            t_calibration = time.perf_counter() - t_calibration
+            jobs = jobs[args.calibrate:]
+            # (the calibration sessions count towards the summary of the run)
+            calibrated = calibration['results']
+            for record in calibrated:
+                write_record(run_log, record)
+        else:
+            calibration = load_calibration(calibration_file)
+
+        mem_per_job = None
+        if calibration is not None and calibration['runtime'] is not None:
+            # keep a safety margin on top of the measured peak memory
+            mem_per_job = int(1.2 * calibration['peak_rss'])
+            print(f'Calibration: peak memory {calibration["peak_rss"]/2**30:.2f} GiB, runtime {calibration["runtime"]:.1f} s per session')
+        n_workers, threads = plan_layout(cores=available['cores'], 
+                                         memory=available['memory'], 
+                                         device_slots=device_slots, 
+                                         threads=args.threads, 
+                                         mem_per_job=mem_per_job)
+        print(f'Available resources: {available["cores"]} cores, {available["memory"]/2**30:.1f} GiB memory, device slots: {device_slots if device_slots else "cpu"}')
+        print(f'Layout: {n_workers} worker(s) x {threads} thread(s)')
+
+        manager = multiprocessing.Manager()
+        device_pool = make_device_pool(manager, device_slots if device_slots else ['cpu'] * n_workers)
+
+    # the workers report the start and finish of every session to the progress monitor of the main process
+    events = None
+    if args.progress_interval > 0 or args.status_file or args.metrics_port:
+        if manager is None:
+            manager = multiprocessing.Manager()
+        events = manager.Queue()
+
+    # hand out the sessions one at a time to the next free worker (dynamic scheduling)
+    worker = partial(process_lst_ai, 
+                     derivatives_dir=derivatives_dir, 
+                     clipping=args.clipping, 
+                     remove_temp=remove_temp, 
+                     use_cpu=use_cpu, 
+                     threads=threads, 
+                     device_pool=device_pool, 
+                     ledger_file=ledger_file, 
+                     cache_dir=args.cache_dir, 
+                     cache_size=int(args.cache_size*2**30), 
+                     hash_inputs=args.hash_inputs, 
+                     lease_dir=lease_dir, 
+                     lease_timeout=args.lease_timeout*3600, 
+                     max_attempts=args.max_attempts, 
+                     engine=args.engine, 
+                     scratch_dir=args.scratch_dir, 
+                     temp_keep=args.temp_keep, 
+                     temp_compress=args.temp_compress, 
+                     timeout=timeout, 
+                     max_memory=max_memory, 
+                     events=events)
+    n_workers = max(1, min(n_workers, len(jobs)))
+    t_wall = time.perf_counter()
+    results = []
+
+    # temp store with the kept temp folders of the derivatives folder (the oldest are removed beyond the size budget)
+    temp_store = None
+    if args.temp_budget is not None:
+        temp_store = os.path.join(derivatives_dir, 'lst-ai_temp.sqlite')
+        open_temp_store(temp_store, derivatives_dir)
+        n, freed = enforce_budget(temp_store, int(args.temp_budget*2**30))
+        if n > 0:
+            print(f'Temp budget: removed {n} temp folder(s) of earlier runs ({freed/2**30:.1f} GiB)')
+
+    # filesystems whose free and used space are reported (and checked with --min_free_space)
+    disks = [derivatives_dir]
+    if args.scratch_dir:
+        Path(args.scratch_dir).mkdir(parents=True, exist_ok=True)
+        disks.append(args.scratch_dir)
+
+    # finish a session: update ledger, run log, temp store and progress, free its slot
+    lock = threading.Lock()
+    def finish(result):
+        with lock:
+            if 'writeback' in result:
+                mark_finished(ledger_file, result, 'done' if result['status'] == 'processed' else 'failed', result['error'])
+                if lease_dir is not None and result['status'] == 'failed':
+                    release_lease(lease_dir, result)
+                send_event(events, 'finish', result, result['status'])
+            if args.scratch_dir:
+                release_session(result, args.scratch_dir, slots)
+            elif slots is not None:
+                slots.release()
+            if temp_store is not None and result['status'] == 'processed' and result.get('temp_size'):
+                register_temp(temp_store, os.path.join(derivatives_dir, f'sub-{result["subID"]}', f'ses-{result["sesID"]}', 'temp'), result['temp_size'])
+                enforce_budget(temp_store, int(args.temp_budget*2**30))
+            result['disk_free'] = {path: disk_space(path)[0] for path in disks}
+            results.append(result)
+            write_record(run_log, result)
+            processed = sum(x['status'] == 'processed' for x in results)
+            rate = 3600 * processed / (time.perf_counter() - t_wall)
+            free = ', '.join(f'{free/2**30:.1f} GiB' for free in result['disk_free'].values())
+            print(f'{datetime.datetime.now()} sub-{result["subID"]}_ses-{result["sesID"]}: {result["status"]} after {result["elapsed"]:.1f} s ({len(results)}/{len(jobs)} sessions, {rate:.1f} sessions/h, free space: {free})')
+
+    # with a scratch disk, the inputs of the next sessions are prefetched and the outputs are written back in background threads
+    # (at most n_workers + prefetch_depth sessions are on the scratch disk at the same time)
+    # with --min_free_space, new sessions are held back while the free space is too low (at most n_workers sessions in flight)
+    job_iter = jobs
+    writeback_pool = None
+    slots = None
+    if args.min_free_space is not None:
+        min_free = int(args.min_free_space*2**30)
+        if not args.scratch_dir:
+            slots = threading.Semaphore(n_workers)
+        job_iter = hold_back(jobs, disks, min_free, finished=lambda: len(results), slots=slots)
+    if args.scratch_dir:
+        slots = threading.Semaphore(n_workers + args.prefetch_depth)
+        job_iter = prefetch_jobs(job_iter, args.scratch_dir, slots, args.prefetch_depth, decompress=args.prefetch_decompress)
+        writeback_pool = ThreadPoolExecutor(max_workers=2)
+
+    stop_progress = None
+    if events is not None:
+        stop_progress = start_progress(events, len(jobs), args.progress_interval, args.status_file, args.metrics_port)
+
+    with multiprocessing.Pool(processes=n_workers) as pool:
+        for result in pool.imap_unordered(worker, job_iter, chunksize=1):
+            if 'writeback' in result:
+                writeback_pool.submit(write_back, result, derivatives_dir).add_done_callback(lambda future: finish(future.result()))
+            else:
+                finish(result)
+    if writeback_pool is not None:
+        writeback_pool.shutdown(wait=True)
+    if stop_progress is not None:
+        stop_progress()
+    t_wall = time.perf_counter() - t_wall
+
+    # report how well the workers were kept busy (the calibration sessions ran one after another before the pool was started)
+    results = calibrated + results
+    t_jobs = sum(x['elapsed'] for x in results)
+    capacity = t_calibration + t_wall * n_workers
+    t_wall += t_calibration
+    utilization = t_jobs / capacity if capacity > 0 else 0.0
+    throughput = 3600 * sum(x['status'] == 'processed' for x in results) / t_wall if t_wall > 0 else 0.0
+    print(f'Processed: {sum(x["status"] == "processed" for x in results)}, skipped: {sum(x["status"] == "skipped" for x in results)}, failed: {sum(x["status"] == "failed" for x in results)}')
+    print(f'Wall time: {t_wall:.1f} s, sum of job times: {t_jobs:.1f} s, workers: {n_workers}, throughput: {throughput:.1f} sessions/h')
+    print(f'Worker utilization: {100*utilization:.1f} % (idle fraction: {100*(1-utilization):.1f} %)')
+    for path in disks:
+        free, used = disk_space(path)
+        print(f'Disk space of {path}: {free/2**30:.1f} GiB free, {used/2**30:.1f} GiB used')
+    if temp_store is not None:
+        n, size = temp_store_size(temp_store)
+        print(f'Temp folders: {n} session(s), {size/2**30:.2f} GiB (budget: {args.temp_budget:.1f} GiB)')
+    n, size = staging_size(derivatives_dir)
+    if n > 0:
+        print(f'Staging folders of failed sessions: {n} session(s), {size/2**30:.2f} GiB in {os.path.join(derivatives_dir, ".staging")} (removed when the session is processed)')
+    print(f'Job ledger: {ledger_counts(ledger_file)}')
+
+    print('DONE!')
+    return results
+
+def main(args):
+    run(args)
+
+if __name__ == "__main__":
+    main(build_parser().parse_args())
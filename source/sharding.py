@@ -0,0 +1,222 @@
+import os
+import json
+import time
+import uuid
+import socket
+import datetime
+from pathlib import Path
+
+def write_manifest(manifest_file, jobs, derivatives_dir):
+    """
+    This function writes the list of session jobs to a manifest, so that several nodes (or SLURM array tasks)
+    can process the same job list without repeating the discovery.
+
+    Parameters:
+    -----------
+    manifest_file : str
+        Path of the JSON manifest
+    jobs : list
+        Session jobs as returned by run_lst_ai.discover
+    derivatives_dir : str
+        Path of the LST-AI derivatives folder in the BIDS database
+    """
+    manifest = {'id': uuid.uuid4().hex,
+                'created': str(datetime.datetime.now()),
+                'derivatives_dir': derivatives_dir,
+                'jobs': jobs}
+    tmp_file = f'{manifest_file}.tmp-{os.getpid()}'
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_file, manifest_file)
+
+def load_manifest(manifest_file):
+    """
+    This function reads a manifest written by write_manifest.
+
+    Returns:
+    --------
+    manifest : dict
+        Dictionary with the manifest ID ('id'), the derivatives folder ('derivatives_dir') and the session jobs ('jobs')
+    """
+    with open(manifest_file) as f:
+        return json.load(f)
+
+def parse_shard(shard=None):
+    """
+    This function determines the shard of the current process, either from a "k/N" string or from the
+    SLURM array environment variables (SLURM_ARRAY_TASK_ID, SLURM_ARRAY_TASK_MIN, SLURM_ARRAY_TASK_COUNT).
+
+    Parameters:
+    -----------
+    shard : str
+        Shard as "k/N" with 0 <= k < N (None: use the SLURM environment)
+
+    Returns:
+    --------
+    shard : tuple
+        (k, N) or None if no shard is defined
+    """
+    if shard is not None:
+        k, n = [int(x) for x in shard.split('/')]
+    elif 'SLURM_ARRAY_TASK_ID' in os.environ and 'SLURM_ARRAY_TASK_COUNT' in os.environ:
+        k = int(os.environ['SLURM_ARRAY_TASK_ID']) - int(os.environ.get('SLURM_ARRAY_TASK_MIN', 0))
+        n = int(os.environ['SLURM_ARRAY_TASK_COUNT'])
+    else:
+        return None
+    if not 0 <= k < n:
+        raise ValueError(f'invalid shard {k}/{n}')
+    return (k, n)
+
+def select_shard(jobs, k, n):
+    """
+    This function deterministically selects the jobs of shard k out of n (round robin over the manifest order,
+    so that cheap and expensive sessions are spread over all shards).
+    """
+    return jobs[k::n]
+
+def lease_path(lease_dir, job):
+    """
+    This function returns the path of the lease file of a session job.
+    """
+    return os.path.join(lease_dir, f'sub-{job["subID"]}_ses-{job["sesID"]}.lease')
+
+def claim_lease(lease_dir, job, timeout):
+    """
+    This function tries to claim a session for the current process by exclusively creating its lease file
+    (O_CREAT | O_EXCL, which is atomic on local filesystems and NFSv3+). Leases that are older than the timeout
+    (e.g., of a node that crashed) are broken.
+
+    Parameters:
+    -----------
+    lease_dir : str
+        Folder with the lease files of the manifest (on the shared derivatives folder)
+    job : dict
+        Session job
+    timeout : float
+        Age in seconds after which a lease is considered abandoned
+
+    Returns:
+    --------
+    claimed : bool
+        True if the current process owns the session
+    """
+    Path(lease_dir).mkdir(parents=True, exist_ok=True)
+    path = lease_path(lease_dir, job)
+    for _ in range(2):
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                age = time.time() - os.stat(path).st_mtime
+            except FileNotFoundError:
+                continue
+            if age < timeout:
+                return False
+            if not break_lease(path, timeout):
+                return False
+            continue
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'host': socket.gethostname(), 'pid': os.getpid(), 'time': str(datetime.datetime.now())}, f)
+        return True
+    return False
+
+def break_lease(path, timeout):
+    """
+    This function removes an abandoned lease file. Only one process at a time may break the lease of a session (break lock
+    created with O_CREAT | O_EXCL), the lease is checked again while the lock is held, and a lease that was replaced between
+    the check and the rename (e.g., a fresh lease of another node) is put back, so that a valid lease is never broken.
+
+    Parameters:
+    -----------
+    path : str
+        Path of the lease file
+    timeout : float
+        Age in seconds after which a lease is considered abandoned
+
+    Returns:
+    --------
+    broken : bool
+        True if the lease file was removed (or did not exist anymore)
+    """
+    lock = f'{path}.break'
+    try:
+        os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        # another process is breaking the lease (a break lock that is older than the timeout was left by a crashed process)
+        try:
+            if time.time() - os.stat(lock).st_mtime > timeout:
+                os.remove(lock)
+        except FileNotFoundError:
+            pass
+        return False
+    try:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return True
+        if time.time() - st.st_mtime < timeout:
+            return False
+        broken = f'{path}.broken-{socket.gethostname()}-{os.getpid()}'
+        try:
+            os.rename(path, broken)
+        except FileNotFoundError:
+            return True
+        moved = os.stat(broken)
+        if (moved.st_ino, moved.st_mtime_ns) != (st.st_ino, st.st_mtime_ns):
+            # the lease was replaced in the meantime: put it back (link does not overwrite a lease created since the rename)
+            try:
+                os.link(broken, path)
+            except FileExistsError:
+                pass
+            os.remove(broken)
+            return False
+        os.remove(broken)
+        return True
+    finally:
+        os.remove(lock)
+
+def release_lease(lease_dir, job):
+    """
+    This function releases the lease of a session (e.g., after a failed attempt, so that another node can retry it).
+    """
+    try:
+        os.remove(lease_path(lease_dir, job))
+    except FileNotFoundError:
+        pass
+
+def lease_attempts(lease_dir, job):
+    """
+    This function returns the number of attempts of a session on all nodes (stored next to its lease file).
+    """
+    try:
+        with open(f'{lease_path(lease_dir, job)}.attempts') as f:
+            return int(f.read().strip() or 0)
+    except FileNotFoundError:
+        return 0
+
+def count_attempt(lease_dir, job):
+    """
+    This function increments the number of attempts of a session on all nodes. It is only called by the owner of the lease,
+    so that no two nodes update the count at the same time (written to a temporary file and renamed).
+
+    Returns:
+    --------
+    attempts : int
+        Number of attempts including the current one
+    """
+    attempts = lease_attempts(lease_dir, job) + 1
+    path = f'{lease_path(lease_dir, job)}.attempts'
+    tmp_file = f'{path}.tmp-{socket.gethostname()}-{os.getpid()}'
+    with open(tmp_file, 'w') as f:
+        f.write(str(attempts))
+    os.replace(tmp_file, path)
+    return attempts
+
+def clear_attempts(lease_dir, job):
+    """
+    This function resets the number of attempts of a session on all nodes (e.g., after it was processed).
+    """
+    try:
+        os.remove(f'{lease_path(lease_dir, job)}.attempts')
+    except FileNotFoundError:
+        pass
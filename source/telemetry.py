@@ -0,0 +1,277 @@
+import argparse
+import os
+import sys
+import json
+import signal
+import resource
+import threading
+import subprocess
+
+def tail_lines(path, n=20, block=1 << 16):
+    """
+    This function returns the last n lines of a (log) file without reading the whole file.
+    """
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(0, size - block))
+        data = f.read()
+    return [line.decode(errors='replace') for line in data.splitlines()[-n:]]
+
+def run_and_measure(command, log_file=None, timeout=None, max_memory=None, stderr_lines=20, grace=30):
+    """
+    This function runs a command (argument list, no shell) and measures the resources used by the child process.
+    The child runs in its own session (process group); on timeout, Ctrl-C or termination of the calling process, the whole
+    process group is killed. stdout and stderr are streamed to a log file (nothing is buffered in memory) and the last lines
+    of the log file are kept for the run log.
+
+    Parameters:
+    -----------
+    command : list
+        Program and arguments that should be executed
+    log_file : str
+        Path of the log file to which stdout and stderr are written (None: passed through to the console)
+    timeout : float
+        Wall time limit in seconds (None: no limit)
+    max_memory : int
+        Limit of the address space in bytes of the child and its children (RLIMIT_AS, None: no limit)
+    stderr_lines : int
+        Number of lines of the log file that are kept
+    grace : float
+        Time in seconds between SIGTERM and SIGKILL when the process group is killed
+
+    Returns:
+    --------
+    usage : dict
+        Dictionary with the exit code ('returncode', negative signal number if killed), the child CPU time in seconds
+        ('cpu_user', 'cpu_system'), the peak memory in bytes ('max_rss'), the last lines of the log file ('stderr_tail')
+        and whether the time limit was exceeded ('timed_out')
+    """
+    def limit_memory():
+        resource.setrlimit(resource.RLIMIT_AS, (max_memory, max_memory))
+
+    def kill_group(sig):
+        try:
+            os.killpg(process.pid, sig)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    log = open(log_file, 'wb') if log_file is not None else None
+    try:
+        process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT if log is not None else None,
+                                   start_new_session=True, preexec_fn=limit_memory if max_memory else None)
+    finally:
+        if log is not None:
+            log.close()
+
+    # on timeout, SIGTERM the process group (LST-AI can clean up) and SIGKILL it if the child did not exit within the grace period
+    timed_out, exited = threading.Event(), threading.Event()
+    def on_timeout():
+        timed_out.set()
+        kill_group(signal.SIGTERM)
+        if not exited.wait(grace):
+            kill_group(signal.SIGKILL)
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, on_timeout)
+        timer.daemon = True
+        timer.start()
+
+    # the termination of the calling process (e.g., a pool worker at pool.terminate()) also kills the process group
+    previous_handler = None
+    if threading.current_thread() is threading.main_thread():
+        previous_handler = signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    try:
+        # wait4 returns the resource usage of the child (including its own waited-for children)
+        _, status, rusage = os.wait4(process.pid, 0)
+    except BaseException:
+        # Ctrl-C or termination: the child runs in its own session and does not receive the signal itself
+        kill_group(signal.SIGTERM)
+        try:
+            process.wait(grace)
+        except subprocess.TimeoutExpired:
+            pass
+        kill_group(signal.SIGKILL)
+        process.wait()
+        raise
+    finally:
+        exited.set()
+        if timer is not None:
+            timer.cancel()
+        if previous_handler is not None:
+            signal.signal(signal.SIGTERM, previous_handler)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # processes of the group that outlived the child (e.g., helpers that ignored SIGTERM) are not left behind
+    kill_group(signal.SIGKILL)
+
+    return {'returncode': process.returncode,
+            'cpu_user': rusage.ru_utime,
+            'cpu_system': rusage.ru_stime,
+            'max_rss': rusage.ru_maxrss * 1024,
+            'stderr_tail': tail_lines(log_file, stderr_lines) if log_file is not None else [],
+            'timed_out': timed_out.is_set()}
+
+def write_record(log_file, record):
+    """
+    This function appends a record as one JSON line to the run log.
+
+    Parameters:
+    -----------
+    log_file : str
+        Path of the JSON-lines run log
+    record : dict
+        Record of one session (see process_lst_ai)
+    """
+    with open(log_file, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+def load_records(log_files):
+    """
+    This function reads the records of one or more JSON-lines run logs.
+
+    Parameters:
+    -----------
+    log_files : list
+        Paths of the run logs
+
+    Returns:
+    --------
+    records : list
+        List of record dictionaries
+    """
+    records = []
+    for log_file in log_files:
+        with open(log_file) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    records.append(json.loads(line))
+    return records
+
+def merge_logs(log_files, output_file):
+    """
+    This function merges the run logs of several nodes or shards into one run log (sorted by start time).
+
+    Parameters:
+    -----------
+    log_files : list
+        Paths of the run logs
+    output_file : str
+        Path of the merged run log
+    """
+    records = sorted(load_records(log_files), key=lambda x: x['start'])
+    with open(output_file, 'w') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+    return records
+
+def percentile(values, q):
+    """
+    This function returns the q-th percentile (0-100) of a list of values with linear interpolation.
+    """
+    values = sorted(values)
+    if len(values) == 0:
+        return float('nan')
+    pos = (len(values) - 1) * q / 100
+    lower = int(pos)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (pos - lower)
+
+def summarize(records, n_slowest=10):
+    """
+    This function computes throughput, latency percentiles and the slowest sessions from run log records.
+
+    Parameters:
+    -----------
+    records : list
+        List of record dictionaries (see load_records)
+    n_slowest : int
+        Number of slowest sessions that are reported
+
+    Returns:
+    --------
+    summary : dict
+        Dictionary with the number of sessions per status, the throughput in processed sessions per hour,
+        latency percentiles of the whole session and of the LST-AI run and the slowest sessions
+    """
+    ran = [x for x in records if x['status'] != 'skipped']
+    processed = [x for x in ran if x['status'] == 'processed']
+    summary = {'sessions': len(records),
+               'processed': len(processed),
+               'failed': sum(x['status'] == 'failed' for x in records),
+               'skipped': len(records) - len(ran)}
+
+    # throughput over the time span in which sessions were running
+    if len(ran) > 0:
+        span = max(x['end'] for x in ran) - min(x['start'] for x in ran)
+        summary['span_hours'] = span / 3600
+        summary['sessions_per_hour'] = len(processed) / (span / 3600) if span > 0 else float('nan')
+
+    for key, values in (('elapsed', [x['elapsed'] for x in ran]),
+                        ('lst', [x['phases']['lst'] for x in ran if 'lst' in x['phases']])):
+        summary[key] = {f'p{q}': percentile(values, q) for q in (50, 90, 99)}
+        summary[key]['max'] = max(values) if values else float('nan')
+
+    peak_rss = [x['max_rss'] for x in ran if x.get('max_rss') is not None]
+    summary['max_rss'] = max(peak_rss) if peak_rss else None
+    summary['slowest'] = [{'session': f'sub-{x["subID"]}_ses-{x["sesID"]}', 'status': x['status'], 'elapsed': x['elapsed']}
+                          for x in sorted(ran, key=lambda x: x['elapsed'], reverse=True)[:n_slowest]]
+    return summary
+
+def print_summary(summary):
+    """
+    This function prints the summary of the run logs.
+    """
+    print(f'Sessions: {summary["sessions"]} (processed: {summary["processed"]}, failed: {summary["failed"]}, skipped: {summary["skipped"]})')
+    if 'sessions_per_hour' in summary:
+        print(f'Throughput: {summary["sessions_per_hour"]:.1f} sessions/hour over {summary["span_hours"]:.2f} hours')
+    for key, label in (('elapsed', 'Session wall time'), ('lst', 'LST-AI run time')):
+        print(f'{label} [s]: p50 {summary[key]["p50"]:.1f}, p90 {summary[key]["p90"]:.1f}, p99 {summary[key]["p99"]:.1f}, max {summary[key]["max"]:.1f}')
+    if summary['max_rss'] is not None:
+        print(f'Peak memory of LST-AI: {summary["max_rss"]/2**30:.2f} GiB')
+    print('Slowest sessions:')
+    for x in summary['slowest']:
+        print(f'  {x["session"]}: {x["elapsed"]:.1f} s ({x["status"]})')
+
+def build_parser(parser=None):
+    """
+    This function adds the command line arguments of telemetry.py to a (sub)parser.
+    """
+    if parser is None:
+        parser = argparse.ArgumentParser(description='Summarize the run logs of the LST-AI pipeline (throughput, latencies, slowest sessions).')
+
+    parser.add_argument('-i', '--input',
+                        help='Run log(s) written by run_lst_ai.py (JSON lines).',
+                        nargs='+',
+                        required=True)
+
+    parser.add_argument('--slowest',
+                        help='Number of slowest sessions that are reported (default: 10).',
+                        type=int,
+                        default=10)
+
+    parser.add_argument('--json',
+                        help='Use the --json flag to print the summary as JSON.',
+                        action='store_true')
+
+    parser.add_argument('--merge',
+                        help='Merge the run logs (e.g., of the shards of a multi-node run) into this file before summarizing them.',
+                        default=None)
+
+    parser.set_defaults(func=main)
+    return parser
+
+def main(args):
+    if args.merge:
+        records = merge_logs(args.input, args.merge)
+        print(f'{len(records)} record(s) of {len(args.input)} run log(s) merged into {args.merge}')
+    else:
+        records = load_records(args.input)
+    summary = summarize(records, n_slowest=args.slowest)
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print_summary(summary)
+
+if __name__ == "__main__":
+    main(build_parser().parse_args())
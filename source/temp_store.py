@@ -0,0 +1,201 @@
+import os
+import gzip
+import time
+import shutil
+import sqlite3
+import datetime
+from pathlib import Path
+
+# gzip level of re-encoded auxiliary images (much faster than the default level 9, the auxiliary files are rarely read again)
+COMPRESS_LEVEL = 1
+
+def folder_size(path):
+    """
+    This function returns the total size in bytes of the files in a folder (not recursive, as the LST-AI temp folder).
+    """
+    return sum(x.stat().st_size for x in os.scandir(path) if x.is_file())
+
+def compact_temp(temp_dir, keep=None, compress=False):
+    """
+    This function reduces the size of the LST-AI temp folder of a session after the BIDS rename: auxiliary files that do not match
+    one of the keep patterns are removed, and uncompressed images (.nii) are re-encoded with gzip level 1.
+
+    Parameters:
+    -----------
+    temp_dir : str
+        Path of the temp folder of the session
+    keep : list
+        Glob patterns of the auxiliary files that are kept (None: all files are kept)
+    compress : bool
+        Boolean variable indicating if uncompressed images are re-encoded as .nii.gz
+
+    Returns:
+    --------
+    sizes : tuple
+        Size of the temp folder in bytes before and after compaction
+    """
+    size = folder_size(temp_dir)
+    for entry in list(os.scandir(temp_dir)):
+        if keep is not None and not any(Path(entry.name).match(pattern) for pattern in keep):
+            if entry.is_dir():
+                shutil.rmtree(entry.path)
+            else:
+                os.remove(entry.path)
+        elif compress and entry.is_file() and entry.name.endswith('.nii'):
+            # streaming re-encode, the image is never held in memory
+            with open(entry.path, 'rb') as src, gzip.open(f'{entry.path}.gz', 'wb', compresslevel=COMPRESS_LEVEL) as dst:
+                shutil.copyfileobj(src, dst, 1 << 20)
+            os.remove(entry.path)
+    return size, folder_size(temp_dir)
+
+def staging_size(derivatives_dir):
+    """
+    This function returns the number of session folders in the staging folder of the derivatives (outputs of failed or
+    interrupted sessions, kept until the next attempt) and their total size in bytes.
+    """
+    staging = os.path.join(derivatives_dir, '.staging')
+    if not os.path.isdir(staging):
+        return 0, 0
+    n, total = 0, 0
+    for entry in os.scandir(staging):
+        if entry.is_dir():
+            n += 1
+            total += sum(os.path.getsize(os.path.join(root, x)) for root, _, files in os.walk(entry.path) for x in files)
+    return n, total
+
+def _connect(store_file):
+    """
+    This function opens a connection to the temp store with one row per kept temp folder.
+    """
+    conn = sqlite3.connect(store_file, timeout=120)
+    conn.execute('CREATE TABLE IF NOT EXISTS temp (path TEXT PRIMARY KEY, size INTEGER, created REAL)')
+    return conn
+
+def open_temp_store(store_file, derivatives_dir):
+    """
+    This function creates the temp store of a derivatives folder. On creation, the temp folders of earlier runs are registered
+    (oldest modification time first), so that the size budget also covers them.
+
+    Parameters:
+    -----------
+    store_file : str
+        Path of the SQLite file of the temp store
+    derivatives_dir : str
+        Path of the LST-AI derivatives folder
+    """
+    new = not os.path.exists(store_file)
+    conn = _connect(store_file)
+    if new:
+        rows = []
+        for temp_dir in Path(derivatives_dir).glob('sub-*/ses-*/temp'):
+            rows.append((str(temp_dir), folder_size(temp_dir), temp_dir.stat().st_mtime))
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO temp VALUES (?, ?, ?)', rows)
+    conn.close()
+
+def register_temp(store_file, temp_dir, size):
+    """
+    This function adds the committed temp folder of a session to the temp store (a re-processed session replaces its old entry).
+    """
+    conn = _connect(store_file)
+    with conn:
+        conn.execute('INSERT OR REPLACE INTO temp VALUES (?, ?, ?)', (temp_dir, size, time.time()))
+    conn.close()
+
+def enforce_budget(store_file, budget):
+    """
+    This function removes the oldest temp folders of the temp store until their total size is within the budget.
+
+    Parameters:
+    -----------
+    store_file : str
+        Path of the SQLite file of the temp store
+    budget : int
+        Maximum total size of the temp folders in bytes
+
+    Returns:
+    --------
+    evicted : tuple
+        Number of removed temp folders and freed bytes
+    """
+    conn = _connect(store_file)
+    rows = conn.execute('SELECT path, size FROM temp ORDER BY created').fetchall()
+    total = sum(x[1] for x in rows)
+    n, freed = 0, 0
+    with conn:
+        for path, size in rows:
+            if total <= budget:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            conn.execute('DELETE FROM temp WHERE path = ?', (path,))
+            total -= size
+            n, freed = n + 1, freed + size
+    conn.close()
+    return n, freed
+
+def temp_store_size(store_file):
+    """
+    This function returns the number of temp folders in the temp store and their total size in bytes.
+    """
+    conn = _connect(store_file)
+    n, total = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM temp').fetchone()
+    conn.close()
+    return n, total
+
+def disk_space(path):
+    """
+    This function returns the free and used space in bytes of the filesystem of a path.
+    """
+    usage = shutil.disk_usage(path)
+    return usage.free, usage.used
+
+def hold_back(jobs, paths, min_free, finished, slots=None, poll=10):
+    """
+    This function is a generator that hands out the session jobs only while the filesystems of the given paths have enough free space.
+    If the free space drops below the threshold, new sessions are held back until running sessions finish and space is freed
+    (e.g., by the temp budget or the write-back). If no session is running and the space is still too low, the remaining sessions
+    are not handed out (they stay queued in the job ledger for --resume).
+
+    Parameters:
+    -----------
+    jobs : iterable
+        Session jobs
+    paths : list
+        Paths whose filesystems are checked (e.g., derivatives folder and scratch disk)
+    min_free : int
+        Minimum free space in bytes
+    finished : callable
+        Function that returns the number of finished sessions
+    slots : threading.Semaphore
+        Semaphore with one slot per running session (None: the caller bounds the sessions in flight, see pipeline.prefetch_jobs)
+    poll : float
+        Interval in seconds between the checks of the free space
+
+    Yields:
+    -------
+    job : dict
+        Session job
+    """
+    handed_out = 0
+    for job in jobs:
+        if slots is not None:
+            slots.acquire()
+        held = False
+        while True:
+            low = [f'{path}: {free/2**30:.1f} GiB' for path in paths for free in [disk_space(path)[0]] if free < min_free]
+            if len(low) == 0:
+                break
+            message = f'{datetime.datetime.now()} Free space below {min_free/2**30:.1f} GiB ({", ".join(low)})'
+            if handed_out == finished():
+                print(f'{message} and no session running, stop handing out sessions.')
+                if slots is not None:
+                    slots.release()
+                return
+            if not held:
+                print(f'{message}, hold back new sessions...')
+                held = True
+            time.sleep(poll)
+        if held:
+            print(f'{datetime.datetime.now()} Free space above {min_free/2**30:.1f} GiB, continue.')
+        handed_out += 1
+        yield job
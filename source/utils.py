@@ -2,6 +2,12 @@ import os
 import shutil
 from pathlib import Path
 import re
+from concurrent.futures import ThreadPoolExecutor
+
+from bids_index import index_file_list, index_scandir, index_stat
+
+# default name of the LST-AI derivatives folder (derivatives/<name> in the BIDS database)
+DERIVATIVES = 'lst-ai-v1.1.0'
 
 # bids helpers
 def getSubjectID(path):
@@ -94,7 +100,37 @@ def CopyandCheck(src, dst):
     else:
         raise Warning(f'File {os.path.basename(src)} does not exist in original folder!')
 
-def getfileList(path, suffix):
+def commitDirectory(src, dst):
+    """
+    This function moves a completely written directory (src) to its final location (dst) with a directory rename, 
+    so that dst either contains the previous or the new content, but never a partially written state. 
+    A previously existing dst is moved aside first and removed after the new directory is in place. 
+    Both directories have to be on the same filesystem.
+
+    Parameters:
+    -----------
+    src : str
+        Path of the staging directory
+    dst : str 
+        Path of the final directory
+
+    Returns:
+    --------
+    None
+        The function moves src to dst
+    """
+    Path(dst).parent.mkdir(parents=True, exist_ok=True)
+    old = None
+    if os.path.exists(dst):
+        old = f'{src.rstrip("/")}.old'
+        if os.path.exists(old):
+            shutil.rmtree(old)
+        os.rename(dst, old)
+    os.rename(src, dst)
+    if old is not None:
+        shutil.rmtree(old)
+
+def getfileList(path, suffix, index=None):
     """
     This function lists all "*suffix"-files that are in the given path. 
 
@@ -104,71 +140,200 @@ def getfileList(path, suffix):
         Path to directory in which we want to search for files
     suffix : str
         Suffix of the files we want to list (e.g., "*.nii.gz")
+    index : sqlite3.Connection
+        Optional BIDS index (see bids_index.py); if provided, the index is queried instead of walking the filesystem
     
     Returns:
     --------
     file_ls : list
         Return the lists of "*suffix"-files.
     """
+    if index is not None:
+        return index_file_list(index, path, suffix)
     file_ls = sorted(list(Path(path).rglob(suffix)))
     return file_ls
 
-def availability_check(sub_dirs, deriv_dir, file_suffix):
+def getfileStat(path, index=None):
     """
-    This function checks availability of files with a specific suffix (e.g., "_space-T1w_seg.nii.gz") within a derivatives folder for each subject in the provided list and outputs two lists, 
-    one with subjects with missing files and one with subjects fow hich all fuiles are available. First, the function iterates over all subjects, and for each subject it lists all available 
-    sessions and then checks the availability of files for each session in the provided derivatives folder.
+    This function returns the size and the modification time of a file.
 
     Parameters:
     -----------
-    sub_dirs : list
-        List with all subject IDs for which availability of files should be checked
-    deriv_dir : str
-        Path of derivatives folder in which availability of files should be checked
-    file_suffix : str
-        Suffix of files for which availability should be checked
+    path : str
+        Path of the file
+    index : sqlite3.Connection
+        Optional BIDS index (see bids_index.py); if provided, the index is queried instead of the filesystem
     
     Returns:
     --------
-    sub_missing : list
-        List with subjects for which one or more files are missing
-    sub_available : list 
-        List with subjects for which all files are available
-    """
-    # initialize empty lists
-    sub_missing = []
-    sub_available = []
-
-    # iterate through all subject folders
-    for sub_dir in sub_dirs:
-        # get subject ID
-        sub_ID = getSubjectID(sub_dir)
-
-        # list all sessions
-        ses_dirs = sorted(list(Path(sub_dir).glob('*')))
-        ses_dirs = [str(x) for x in ses_dirs if "ses-" in str(x)]
-        
-        # initialize availability list 
-        any_missing = []
-
-        # iterate through all sessions
-        for ses_dir in ses_dirs:
-            # get session ID
-            ses_ID = getSessionID(ses_dir)
-
-            # check availability of file for this session
-            file_path = os.path.join(deriv_dir, f'sub-{sub_ID}', f'ses-{ses_ID}', 'anat', f'sub-{sub_ID}_ses-{ses_ID}_{file_suffix}')
-            t1_path = os.path.join(ses_dir, 'anat', f'sub-{sub_ID}_ses-{ses_ID}_T1w.nii.gz')
-            flair_path = os.path.join(ses_dir, 'anat', f'sub-{sub_ID}_ses-{ses_ID}_FLAIR.nii.gz')
-            if (not os.path.exists(file_path)) and os.path.exists(t1_path) and os.path.exists(flair_path):
-                any_missing.append(True)
-            else:
-                any_missing.append(False)
-        
-        # check if files are missing for any of the sessions and add subject to sub_missing or sub_available accordingly
-        if any(any_missing):
-            sub_missing.append(sub_dir)
-        else:
-            sub_available.append(sub_dir)
-    
-    return sub_missing, sub_available
\ No newline at end of file
+    stat : tuple
+        (size in bytes, modification time in ns) or None if the file does not exist
+    """
+    if index is not None:
+        return index_stat(index, path)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_size, st.st_mtime_ns)
+
+def getSessionOutputs(deriv_dir, subID, sesID):
+    """
+    This function returns the paths of the LST-AI lesion mask and annotated lesion mask of a session.
+    """
+    prefix = os.path.join(deriv_dir, f'sub-{subID}', f'ses-{sesID}', 'anat', f'sub-{subID}_ses-{sesID}')
+    return (f'{prefix}_space-FLAIR_label-lesion_mask.nii.gz', f'{prefix}_space-FLAIR_desc-annotated_label-lesion_mask.nii.gz')
+
+def isSessionComplete(deriv_dir, subID, sesID, index=None):
+    """
+    This function checks if a session is completely segmented, i.e., if the lesion mask AND the annotated lesion mask exist.
+    The same rule is used by the discovery, the workers and the planner.
+    """
+    return all(getfileStat(x, index) is not None for x in getSessionOutputs(deriv_dir, subID, sesID))
+
+def scanFolder(path, index=None):
+    """
+    This function lists the entries of a folder with os.scandir (no stat calls).
+
+    Parameters:
+    -----------
+    path : str
+        Path of the folder
+    index : sqlite3.Connection
+        Optional BIDS index (see bids_index.py); if provided, the index is queried instead of the filesystem
+
+    Returns:
+    --------
+    entries : dict
+        Entry names with a boolean value indicating if the entry is a folder (empty if the folder does not exist)
+    """
+    if index is not None:
+        return index_scandir(index, path)
+    try:
+        with os.scandir(path) as it:
+            return {entry.name: entry.is_dir() for entry in it}
+    except (FileNotFoundError, NotADirectoryError):
+        return {}
+
+def scanSubject(sub_dir, deriv_dir, index=None):
+    """
+    This function scans the sessions of one subject: T1w and FLAIR images (size and modification time) and the completeness
+    of the LST-AI outputs. Every session defines one session job (sessions with several T1w images, except acq-GADOLINIUM,
+    use the canonical sub-X_ses-Y_T1w.nii.gz image or the first T1w image with FLAIR image).
+
+    Parameters:
+    -----------
+    sub_dir : str
+        Path of the subject folder
+    deriv_dir : str
+        Path of the LST-AI derivatives folder
+    index : sqlite3.Connection
+        Optional BIDS index (see bids_index.py); if provided, the index is queried instead of the filesystem
+
+    Returns:
+    --------
+    sessions : list
+        List of dictionaries with the keys 'subID', 'sesID', 't1w', 'flair', 'size' (T1w + FLAIR in bytes), 'mtime' (newest
+        modification time in ns), 'flair_available', 'complete' (see isSessionComplete) and the T1w images that are not
+        processed ('extra_t1w')
+    """
+    sessions = []
+    subID = getSubjectID(sub_dir)
+    for ses_name, is_dir in sorted(scanFolder(sub_dir, index).items()):
+        if not (is_dir and ses_name.startswith('ses-')):
+            continue
+        anat = os.path.join(sub_dir, ses_name, 'anat')
+        anat_files = scanFolder(anat, index)
+
+        # the outputs are named by subject and session only, so every session defines exactly one job:
+        # the canonical sub-X_ses-Y_T1w.nii.gz (or the first T1w with FLAIR image), further acq-/run- pairs are reported
+        candidates = {}
+        for name in sorted(anat_files):
+            if name.endswith('_T1w.nii.gz') and ('GADOLINIUM' not in name):
+                candidates.setdefault(getSessionID(os.path.join(anat, name)), []).append(name)
+        for sesID, names in candidates.items():
+            with_flair = [x for x in names if x.replace('_T1w.nii.gz', '_FLAIR.nii.gz') in anat_files]
+            canonical = f'sub-{subID}_ses-{sesID}_T1w.nii.gz'
+            name = canonical if canonical in names else (with_flair + names)[0]
+            t1w = os.path.join(anat, name)
+            flair = t1w.replace('_T1w.nii.gz', '_FLAIR.nii.gz')
+            t1w_stat = getfileStat(t1w, index)
+            if t1w_stat is None:
+                # the T1w image was removed after the folder was listed
+                continue
+            flair_stat = getfileStat(flair, index) if os.path.basename(flair) in anat_files else None
+            stats = [x for x in (t1w_stat, flair_stat) if x is not None]
+            sessions.append({'subID': subID, 
+                             'sesID': sesID, 
+                             't1w': t1w, 
+                             'flair': flair, 
+                             'size': sum(x[0] for x in stats), 
+                             'mtime': max(x[1] for x in stats), 
+                             'flair_available': flair_stat is not None, 
+                             'complete': isSessionComplete(deriv_dir, subID, sesID, index), 
+                             'extra_t1w': [os.path.join(anat, x) for x in names if x != name]})
+    return sessions
+
+def scanSessions(input_dir, deriv_dir, threads=16, index=None):
+    """
+    This function scans all subjects of a BIDS database once and returns a flat list of sessions. Without index, the subject
+    folders are scanned in parallel with a thread pool (listing folders on network storage is latency bound). Errors of a subject
+    (e.g., permission denied) are reported and do not stop the discovery of the other subjects.
+
+    Parameters:
+    -----------
+    input_dir : str
+        Folder of BIDS database
+    deriv_dir : str
+        Path of the LST-AI derivatives folder
+    threads : int
+        Number of threads of the scan (the index is queried sequentially)
+    index : sqlite3.Connection
+        Optional BIDS index (see bids_index.py); if provided, the index is queried instead of the filesystem
+
+    Returns:
+    --------
+    sessions : list
+        Sessions in BIDS order (see scanSubject)
+    errors : dict
+        Subject folders that could not be scanned with their error message
+    """
+    sub_dirs = sorted(os.path.join(input_dir, name) for name, is_dir in scanFolder(input_dir, index).items() if is_dir and name.startswith('sub-'))
+
+    def scan(sub_dir):
+        try:
+            return scanSubject(sub_dir, deriv_dir, index), None
+        except OSError as e:
+            return [], f'{type(e).__name__}: {e}'
+
+    if index is not None or threads <= 1:
+        results = [scan(x) for x in sub_dirs]
+    else:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            results = list(executor.map(scan, sub_dirs))
+
+    sessions, errors = [], {}
+    for sub_dir, (sub_sessions, error) in zip(sub_dirs, results):
+        sessions += sub_sessions
+        if error is not None:
+            errors[sub_dir] = error
+    return sessions, errors
+
+def sortSessionJobs(jobs, order='bids'):
+    """
+    This function sorts session jobs (see scanSubject) in place.
+
+    Parameters:
+    -----------
+    jobs : list
+        Session jobs in BIDS order
+    order : str
+        "bids" (sorted by subject and session ID), "oldest" (oldest T1w/FLAIR modification time first) 
+        or "cheapest" (smallest T1w+FLAIR file size first)
+    """
+    if order == 'oldest':
+        jobs.sort(key=lambda job: job['mtime'])
+    elif order == 'cheapest':
+        jobs.sort(key=lambda job: job['size'])
+    elif order != 'bids':
+        raise ValueError(f'unknown job order: {order}')